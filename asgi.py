@@ -0,0 +1,5 @@
+from asgiref.wsgi import WsgiToAsgi
+from flaskr import create_app
+
+# Optional ASGI entry point, served with e.g. `uvicorn asgi:app`.
+app = WsgiToAsgi(create_app())
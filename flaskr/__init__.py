@@ -1,37 +1,84 @@
-from flaskr import pages
+from flaskr import api, bulk, compression, listings, loadtest, logs, monitoring, pages, passwords, profiling, serialization, tenants
 from unittest.mock import MagicMock
 from .backend import Backend
+from .cache import ImageCache
+from .passwords import PasswordHasher
 from .tracker import Tracker
 from flask import Flask
 
-import logging
-
-logging.basicConfig(level=logging.DEBUG)
-
 
 # The flask terminal command inside "run-flask.sh" searches for
 # this method inside of __init__.py (containing flaskr module
 # properties) as we set "FLASK_APP=flaskr" before running "flask".
-def create_app(test_config=None):
-    # Create and configure the app.
+def create_app(test_config=None, tenant=None, pool=None):
+    # Create and configure the app. Tenant apps serve another wiki from the
+    # same process, sharing the default app's client pool.
     app = Flask(__name__, instance_relative_config=True)
 
     # This is the default secret key used for login sessions
     # By default the dev environment uses the key 'dev'
     app.config.from_mapping(SECRET_KEY='dev',)
+
+    # Drop the whitespace that template tags leave in rendered pages.
+    app.jinja_env.trim_blocks = True
+    app.jinja_env.lstrip_blocks = True
     backend = None
     if test_config is None:
         # Load the instance config, if it exists, when not testing.
         # This file is not committed. Place it in production deployments.
         app.config.from_pyfile('config.py', silent=True)
-        backend = Backend(tracker=Tracker())
+        tenants.partition_budgets(app.config, tenant)
+        tenants.isolate_sessions(app.config, tenant)
+        if pool is None:
+            pool = tenants.ClientPool(
+                app.config.get('DATASTORE_PROJECT', tenants.DEFAULT_PROJECT))
+        namespace = tenant.namespace if tenant else None
+        bucket_prefix = tenant.bucket_prefix if tenant else ''
+        client = pool.datastore(namespace)
+        password_hasher = PasswordHasher(
+            app.config.get('PASSWORD_KDF', 'scrypt'),
+            app.config.get('PASSWORD_WORK_FACTOR'),
+            app.config.get('PASSWORD_HASH_WORKERS', 4))
+        # Images are kept in memory and, if IMAGE_CACHE_DIR is set, on disk.
+        image_cache = ImageCache(
+            app.config.get('IMAGE_CACHE_MEMORY_BYTES', 32 * 2**20),
+            app.config.get('IMAGE_CACHE_DIR'),
+            app.config.get('IMAGE_CACHE_DISK_BYTES', 512 * 2**20))
+        backend = Backend(tracker=Tracker(client),
+                          client=client,
+                          content_bucket=pool.bucket(
+                              app.config.get('CONTENT_BUCKET',
+                                             tenants.DEFAULT_CONTENT_BUCKET),
+                              bucket_prefix),
+                          users_bucket=pool.bucket(
+                              app.config.get('USERS_BUCKET',
+                                             tenants.DEFAULT_USERS_BUCKET),
+                              bucket_prefix),
+                          password_hasher=password_hasher,
+                          image_cache=image_cache)
     else:
         # Load the test config if passed in.
         mock_tracker = Tracker(MagicMock(), MagicMock())
         backend = Backend(mock_tracker, MagicMock(), MagicMock(), MagicMock())
         app.config.from_mapping(test_config)
+        tenants.partition_budgets(app.config, tenant)
+        tenants.isolate_sessions(app.config, tenant)
 
     # TODO(Project 1): Make additional modifications here for logging in, backends
     # and additional endpoints.
+    # Tracing and profiling hooks go first, so they cover the other hooks too.
+    logs.init_app(app)
+    profiling.init_app(app)
+    monitoring.init_app(app, backend)
     pages.make_endpoints(app, backend)
+    api.make_endpoints(app, backend)
+    compression.init_app(app)
+    bulk.register_commands(app, backend)
+    listings.register_commands(app, backend)
+    loadtest.register_commands(app)
+    passwords.register_commands(app)
+    serialization.register_commands(app)
+    if tenant is None:
+        tenants.init_app(app,
+                         lambda tenant: create_app(test_config, tenant, pool))
     return app
@@ -0,0 +1,46 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import contextvars
+import functools
+""" Provides async access to the backend of the Super Smash Bros. wiki project """
+
+
+class AsyncProxy:
+    """Exposes the methods of a `Backend` or `Tracker` as coroutines.
+
+    The Datastore and GCS clients are blocking, so each call runs in a
+    bounded thread pool while the event loop stays free. Async route
+    handlers can then await several backend calls at once with
+    `asyncio.gather` instead of making them one after another. Calls run
+    in a copy of the caller's context, so context variables such as the
+    request's trace ID carry over to the pool's threads.
+
+    Attributes that are not methods, except `tracker`, are returned as is.
+    The `tracker` attribute is wrapped too, sharing the same thread pool.
+
+    Attributes:
+        target:
+            The `Backend` or `Tracker` whose methods are proxied.
+    """
+
+    def __init__(self, target, executor: ThreadPoolExecutor = None) -> None:
+        self.target = target
+        self._executor = executor or ThreadPoolExecutor(
+            max_workers=64, thread_name_prefix='backend-io')
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self.target, name)
+        if name == 'tracker':
+            return AsyncProxy(attribute, self._executor)
+        if not callable(attribute):
+            return attribute
+
+        @functools.wraps(attribute)
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            context = contextvars.copy_context()
+            return await loop.run_in_executor(
+                self._executor,
+                functools.partial(context.run, attribute, *args, **kwargs))
+
+        return call
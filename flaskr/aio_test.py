@@ -0,0 +1,37 @@
+import pytest, asyncio, threading
+from unittest.mock import MagicMock
+from .aio import AsyncProxy
+
+
+def test_calls_run_concurrently():
+    # Each call blocks until all three are running, so they must overlap.
+    barrier = threading.Barrier(3, timeout=5)
+
+    def wait_for_others(result):
+        barrier.wait()
+        return result
+
+    backend = MagicMock()
+    backend.get_wiki_page.side_effect = wait_for_others
+    backend.tracker.get_upvotes.side_effect = lambda name: wait_for_others(3)
+    async_backend = AsyncProxy(backend)
+
+    async def gather():
+        return await asyncio.gather(async_backend.get_wiki_page("Mario"),
+                                    async_backend.get_wiki_page("Link"),
+                                    async_backend.tracker.get_upvotes("Mario"))
+
+    results = asyncio.run(gather())
+    assert results == ["Mario", "Link", 3]
+    backend.tracker.get_upvotes.assert_called_once_with("Mario")
+
+
+def test_errors_and_attributes():
+    backend = MagicMock()
+    backend.get_worlds.side_effect = RuntimeError("Datastore unavailable")
+    backend.content_bucket_name = "nbs-wiki-content"
+    async_backend = AsyncProxy(backend)
+
+    assert async_backend.content_bucket_name == "nbs-wiki-content"
+    with pytest.raises(RuntimeError):
+        asyncio.run(async_backend.get_worlds())
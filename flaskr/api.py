@@ -0,0 +1,140 @@
+from flask import jsonify, request, url_for
+from concurrent.futures import ThreadPoolExecutor
+from .aio import AsyncProxy
+from .records import PageStats
+import asyncio
+""" Provides a versioned JSON read API for the Super Smash Bros. wiki project """
+
+API_PREFIX = "/api/v1"
+
+# Fields a page can be requested with, in the order they are returned.
+PAGE_FIELDS = ("info", "world", "image", "upvotes", "uploader", "comment_count")
+
+
+def make_endpoints(app, backend):
+    """Registers the JSON API's endpoints.
+
+    Pages are returned as objects with their "name" and the requested
+    fields, selected with a comma-separated "fields" query parameter (or
+    a "fields" list in batch requests) and defaulting to all of them. Any
+    number of pages up to API_BATCH_LIMIT is read with a Character lookup
+    and a lookup of the stats kinds the fields need, run concurrently, so
+    a batch costs one round trip however many pages it has.
+
+    Args:
+        app: The Flask app to add the endpoints to.
+        backend: The `Backend` the pages are read from.
+    """
+    app.config.setdefault("API_BATCH_LIMIT", 500)
+    async_backend = app.extensions.get("async_backend") or AsyncProxy(
+        backend,
+        ThreadPoolExecutor(max_workers=app.config.get("BACKEND_IO_WORKERS", 64),
+                           thread_name_prefix="backend-io"))
+
+    async def get_pages(names, fields):
+        """Returns the found pages, in request order, and the missing names."""
+        stats_fields = [field for field in PageStats._fields if field in fields]
+        lookups = [async_backend.get_wiki_pages(names)]
+        if stats_fields:
+            lookups.append(
+                async_backend.tracker.get_pages_stats(names, stats_fields))
+        characters, *pages_stats = await asyncio.gather(*lookups)
+        pages_stats = pages_stats[0] if pages_stats else {}
+
+        found, missing = [], []
+        for name in names:
+            character = characters.get(name)
+            if character is None:
+                missing.append(name)
+                continue
+            values = dict(
+                pages_stats[name]._asdict() if stats_fields else {},
+                info=character.info,
+                world=character.world,
+                image=url_for("show_image", image_name=character.image)
+                if character.image else None)
+            page = {"name": name}
+            page.update((field, values[field]) for field in fields)
+            found.append(page)
+        return found, missing
+
+    @app.route(API_PREFIX + "/pages/<page_name>")
+    async def api_page(page_name):
+        """Returns one page."""
+        fields, error = _parse_fields(request.args.get("fields"))
+        if error:
+            return error
+        found, _ = await get_pages([page_name], fields)
+        if not found:
+            return _error(404, f"Page {page_name!r} not found.")
+        return _conditional(jsonify(found[0]))
+
+    @app.route(API_PREFIX + "/pages")
+    async def api_pages():
+        """Returns the pages named in the comma-separated "names" parameter."""
+        names = [
+            name for name in request.args.get("names", "").split(",") if name
+        ]
+        return await batch(names, request.args.get("fields"))
+
+    @app.route(API_PREFIX + "/pages/batch", methods=["POST"])
+    async def api_pages_batch():
+        """Returns the pages named in a JSON body of {"names", "fields"}."""
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict) or not isinstance(body.get("names"),
+                                                        list):
+            return _error(400, 'Expected a JSON object with a "names" list.')
+        return await batch(body["names"], body.get("fields"))
+
+    async def batch(names, requested_fields):
+        fields, error = _parse_fields(requested_fields)
+        if error:
+            return error
+        if not all(isinstance(name, str) for name in names):
+            return _error(400, "Page names must be strings.")
+        names = list(dict.fromkeys(names))
+        if len(names) > app.config["API_BATCH_LIMIT"]:
+            return _error(
+                400, f"At most {app.config['API_BATCH_LIMIT']} pages "
+                "can be requested at once.")
+        found, missing = await get_pages(names, fields)
+        response = jsonify({"pages": found, "missing": missing})
+        return _conditional(response) if request.method == "GET" else response
+
+
+def _parse_fields(requested_fields):
+    """Validates the requested fields.
+
+    Args:
+        requested_fields: A comma-separated string or a list of field
+            names, or None for all fields.
+
+    Returns:
+        A tuple with the list of fields, in `PAGE_FIELDS` order, and None;
+        or None and an error response if a field is unknown.
+    """
+    if requested_fields is None:
+        return list(PAGE_FIELDS), None
+    if isinstance(requested_fields, str):
+        requested_fields = [
+            field.strip() for field in requested_fields.split(",")
+        ]
+    unknown = [
+        field for field in requested_fields
+        if not isinstance(field, str) or field not in PAGE_FIELDS
+    ]
+    if unknown:
+        return None, _error(
+            400, f"Unknown fields {unknown}; "
+            f"choose from {', '.join(PAGE_FIELDS)}.")
+    return [field for field in PAGE_FIELDS if field in requested_fields], None
+
+
+def _error(status, message):
+    return jsonify({"error": message}), status
+
+
+def _conditional(response):
+    """Tags a response with an ETag, answering 304 if the client has it."""
+    response.add_etag()
+    return response.make_conditional(request)
@@ -0,0 +1,112 @@
+import pytest
+from flask import Flask
+from unittest.mock import MagicMock
+from flaskr import api, pages
+from flaskr.records import Character, PageStats
+
+MARIO = Character("Mario", "Plumber", "Super Mario Bros.", "a" * 64 + ".png")
+LINK = Character("Link", "Hero", "The Legend of Zelda")
+
+
+@pytest.fixture
+def mock_backend():
+    backend = MagicMock()
+    backend.get_wiki_pages.side_effect = lambda names: {
+        character.name: character
+        for character in (MARIO, LINK)
+        if character.name in names
+    }
+    backend.tracker.get_pages_stats.side_effect = lambda names, fields: {
+        name: PageStats(upvotes=3 if "upvotes" in fields else None,
+                        comment_count=1 if "comment_count" in fields else None,
+                        uploader="sebagabs" if "uploader" in fields else None)
+        for name in names
+    }
+    return backend
+
+
+@pytest.fixture
+def client(mock_backend):
+    app = Flask("flaskr")
+    app.config.from_mapping(SECRET_KEY="dev", TESTING=True, API_BATCH_LIMIT=3)
+    pages.make_endpoints(app, mock_backend)
+    api.make_endpoints(app, mock_backend)
+    return app.test_client()
+
+
+def test_page(client):
+    resp = client.get("/api/v1/pages/Mario")
+    assert resp.get_json() == {
+        "name": "Mario",
+        "info": "Plumber",
+        "world": "Super Mario Bros.",
+        "image": "/images/" + "a" * 64 + ".png",
+        "upvotes": 3,
+        "uploader": "sebagabs",
+        "comment_count": 1
+    }
+
+    resp = client.get("/api/v1/pages/Mario",
+                      headers={"If-None-Match": resp.headers["ETag"]})
+    assert resp.status_code == 304
+
+    resp = client.get("/api/v1/pages/Ness")
+    assert resp.status_code == 404
+    assert "Ness" in resp.get_json()["error"]
+
+
+def test_field_selection_skips_unneeded_lookups(client, mock_backend):
+    resp = client.get("/api/v1/pages/Link?fields=world,image")
+    assert resp.get_json() == {
+        "name": "Link",
+        "world": "The Legend of Zelda",
+        "image": None
+    }
+    mock_backend.tracker.get_pages_stats.assert_not_called()
+
+    resp = client.get("/api/v1/pages/Link?fields=upvotes")
+    assert resp.get_json() == {"name": "Link", "upvotes": 3}
+    mock_backend.tracker.get_pages_stats.assert_called_once_with(["Link"],
+                                                                 ["upvotes"])
+
+    resp = client.get("/api/v1/pages/Link?fields=upvotes,password")
+    assert resp.status_code == 400
+
+
+def test_batch(client, mock_backend):
+    resp = client.post("/api/v1/pages/batch",
+                       json={
+                           "names": ["Link", "Ness", "Mario", "Link"],
+                           "fields": ["world", "comment_count"]
+                       })
+    assert resp.get_json() == {
+        "pages": [{
+            "name": "Link",
+            "world": "The Legend of Zelda",
+            "comment_count": 1
+        }, {
+            "name": "Mario",
+            "world": "Super Mario Bros.",
+            "comment_count": 1
+        }],
+        "missing": ["Ness"]
+    }
+    # One lookup per kind group, however many pages are requested.
+    mock_backend.get_wiki_pages.assert_called_once_with(
+        ["Link", "Ness", "Mario"])
+    mock_backend.tracker.get_pages_stats.assert_called_once()
+
+    resp = client.get("/api/v1/pages?names=Mario,Link&fields=info")
+    assert [page["info"] for page in resp.get_json()["pages"]
+           ] == ["Plumber", "Hero"]
+
+
+def test_batch_rejects_bad_requests(client):
+    assert client.post("/api/v1/pages/batch", json=["Mario"]).status_code == 400
+    assert client.post("/api/v1/pages/batch", json={
+        "names": [1]
+    }).status_code == 400
+    assert client.post("/api/v1/pages/batch",
+                       json={
+                           "names": ["a", "b", "c", "d"]
+                       }).status_code == 400
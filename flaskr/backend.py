@@ -1,10 +1,32 @@
+from google.api_core.exceptions import NotFound, PreconditionFailed
 from google.cloud import datastore, storage
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 import os, base64, csv
+import contextvars
 import hashlib
 import json
+import logging
+import re
+from . import images
+from .cache import ImageCache
+from .changes import ChangeLog
+from .passwords import PasswordHasher
+from .records import Character, Comment, IndexDelta, WorldListing
+from .transactions import run_in_transaction
 """ Provides a backend implementation for the Super Smash Bros. wiki project using Google Cloud Storage (GCS) and Google Cloud Datastore """
 
+logger = logging.getLogger(__name__)
+
+# Datastore "IN" filters accept at most 30 values.
+MAX_IN_VALUES = 30
+
+# Datastore lookups accept at most 1000 keys.
+MAX_LOOKUP_KEYS = 1000
+
+# Words indexed for search.
+TOKEN = re.compile(r"\w+")
+
 
 class Backend:
     """Provides an interface for underlying GCS buckets.
@@ -24,6 +46,12 @@ class Backend:
         client:
             An instance of `datastore.Client` that represents the connection to
             the Google Cloud Datastore service for the project 'sds-project-nbs-wiki'.
+        password_hasher:
+            A `PasswordHasher` used to hash and verify user passwords.
+        change_log:
+            The `ChangeLog` that uploads are appended to.
+        image_cache:
+            The `ImageCache` that image downloads are kept in.
     """
 
     def __init__(self,
@@ -31,7 +59,10 @@ class Backend:
                  client=None,
                  content_bucket=None,
                  users_bucket=None,
-                 key_method=None) -> None:
+                 key_method=None,
+                 password_hasher=None,
+                 change_log=None,
+                 image_cache=None) -> None:
 
         if client is None:
             client = datastore.Client('sds-project-nbs-wiki')
@@ -45,31 +76,90 @@ class Backend:
         if key_method is None:
             key_method = client.key
 
+        if password_hasher is None:
+            password_hasher = PasswordHasher()
+
+        if change_log is None:
+            change_log = ChangeLog(client, key_method)
+
+        if image_cache is None:
+            image_cache = ImageCache()
+
         self.client = client
         self.content_bucket = content_bucket
         self.users_bucket = users_bucket
         self.key = key_method
         self.tracker = tracker
+        self.password_hasher = password_hasher
+        self.change_log = change_log
+        self.image_cache = image_cache
 
-    def get_wiki_page(self, name: str) -> str:
+    def get_wiki_page(self, name: str) -> Character:
         """Get a wiki page from the Datastore by name.
         
         Args:
             name: A string representing the name of the character to get.
         
         Returns:
-            A string representing the character's information in the format "character_name|info|world",
-            or None if the character is not found.
+            A `Character` record with the character's name, info, world and
+            image, or None if the character is not found.
         """
         key = self.key('Character', name)
         wiki_page = self.client.get(key)
         if wiki_page:
-            character_name = wiki_page['Name']
-            info = wiki_page['Info']
-            world = wiki_page['World']
-            return f"{character_name}|{info}|{world}"
+            return Character(wiki_page['Name'], wiki_page['Info'],
+                             wiki_page['World'], wiki_page.get('Image'))
         return None
 
+    def get_wiki_pages(self, names: list[str]) -> dict[str, Character]:
+        """Get many wiki pages from the Datastore with batched lookups.
+
+        Args:
+            names: A list of strings with the names of the characters to get.
+
+        Returns:
+            A dictionary mapping the name of each character found to its
+            `Character` record. Characters that are not found are left out.
+        """
+        keys = [self.key('Character', name) for name in names]
+        characters = {}
+        for start in range(0, len(keys), MAX_LOOKUP_KEYS):
+            for wiki_page in self.client.get_multi(keys[start:start +
+                                                        MAX_LOOKUP_KEYS]):
+                characters[wiki_page.key.name] = Character(
+                    wiki_page['Name'], wiki_page['Info'], wiki_page['World'],
+                    wiki_page.get('Image'))
+        return characters
+
+    def get_page_version(self, name: str) -> str:
+        """Get a cheap version token for a wiki page.
+
+        The token changes whenever anything rendered on the page changes:
+        the Character entity, the number of comments or upvotes, or the
+        generation of the character's image in the GCS bucket. Content-
+        addressed images are already named in the Character entity, so only
+        pages with a legacy image look up its generation. No image bytes are
+        downloaded.
+
+        Args:
+            name: A string representing the name of the character.
+
+        Returns:
+            A string with the hex digest of the page's version, or None if
+            the character is not found.
+        """
+        character = self.get_wiki_page(name)
+        if not character:
+            return None
+        stats = self.tracker.get_page_stats(name)
+        generation = 0
+        if not character.image:
+            blob = self.content_bucket.get_blob("character-images/" + name +
+                                                ".png")
+            generation = blob.generation if blob else 0
+        version = repr((character, stats, generation))
+        return hashlib.blake2b(version.encode(), digest_size=16).hexdigest()
+
     def get_all_page_names(self) -> list[str]:
         """ Get a list of all character names from the Datastore.
         
@@ -91,19 +181,26 @@ class Backend:
         results = list(query.fetch())
         return [entity.key.name for entity in results]
 
-    def upload(self, uploader, f, char_name, char_info, char_world):
+    def upload(self, uploader, f, char_name, char_info,
+               char_world) -> list[str]:
         """Uploads an image and character info to the GCS bucket and Datastore.
 
+        The image is stored under its content-addressed name (see
+        `store_image`), so an image shared by several characters is stored
+        only once.
+
         Args:
         uploader: the username of the person uploading the character
         f: A file object representing the image to be uploaded.
         char_name: A string representing the name of the character.
         char_info: A string representing the info of the character.
         char_world: A string representing the world of the character.
+
+        Returns:
+            A list with the names of other characters whose images are
+            identical or nearly identical to the uploaded one.
         """
-        image_blob = self.content_bucket.blob("character-images/" + char_name +
-                                              ".png")
-        image_blob.upload_from_file(f, content_type=f.content_type)
+        image, similar_images = self.store_image(f.read())
 
         # Save the character info to the Datastore
         wiki_page_key = self.client.key('Character', char_name)
@@ -112,6 +209,7 @@ class Backend:
             'Name': char_name,
             'Info': char_info,
             'World': char_world,
+            'Image': image,
         })
         self.client.put(wiki_page)
 
@@ -128,6 +226,343 @@ class Backend:
             })
         self.client.put(world_entity)
         self.tracker.add_upload(username=uploader, pagename=char_name)
+        self.change_log.append("upload",
+                               char_name,
+                               world=char_world,
+                               user=uploader)
+        return [
+            name for name in self.get_pages_with_images(similar_images)
+            if name != char_name
+        ]
+
+    def upload_batch(self, uploads: list[tuple], max_workers: int = 8) -> None:
+        """Uploads many characters at once, as `upload` does for a single one.
+
+        Images are stored in the GCS bucket concurrently, and the Character
+        and World entities are written with batched `put_multi` calls instead
+        of one round trip each. Re-uploading a character that is already in
+        its world does not add it to the world twice, so a batch can be
+        retried safely.
+
+        Args:
+            uploads: A list of (uploader, image_path, char_name, char_info,
+                char_world) tuples, where image_path is the path of the
+                character's image on the local disk.
+            max_workers: An integer with the number of concurrent image uploads.
+
+        Raises:
+            ValueError: If an image is not a PNG, JPEG or GIF; no character
+                of the batch is written then.
+        """
+        if not uploads:
+            return
+
+        def upload_image(upload):
+            _, image_path, char_name, _, _ = upload
+            with open(image_path, 'rb') as image_file:
+                image, similar_images = self.store_image(image_file.read())
+            if similar_images:
+                logger.warning("Image of %s looks like images %s", char_name,
+                               similar_images)
+            return image
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # Each upload runs in a copy of this context, keeping the trace ID.
+            uploaded_images = list(
+                executor.map(
+                    lambda upload: contextvars.copy_context().run(
+                        upload_image, upload), uploads))
+
+        entities = []
+        world_members = {}
+        for (_, _, char_name, char_info,
+             char_world), image in zip(uploads, uploaded_images):
+            wiki_page = datastore.Entity(key=self.key('Character', char_name))
+            wiki_page.update({
+                'Name': char_name,
+                'Info': char_info,
+                'World': char_world,
+                'Image': image,
+            })
+            entities.append(wiki_page)
+            world_members.setdefault(char_world, []).append(char_name)
+
+        world_keys = [self.key('World', world) for world in world_members]
+        existing_worlds = {
+            world_entity.key.name: world_entity
+            for world_entity in self.client.get_multi(world_keys)
+        }
+        for world_key, (world, char_names) in zip(world_keys,
+                                                  world_members.items()):
+            world_entity = existing_worlds.get(world)
+            if world_entity is None:
+                world_entity = datastore.Entity(key=world_key)
+                world_entity.update({'world_name': world, 'characters': []})
+            for char_name in char_names:
+                if char_name not in world_entity['characters']:
+                    world_entity['characters'].append(char_name)
+            entities.append(world_entity)
+
+        # Datastore accepts at most 500 entities per commit.
+        for start in range(0, len(entities), 500):
+            self.client.put_multi(entities[start:start + 500])
+        self.tracker.add_uploads([
+            (uploader, char_name) for uploader, _, char_name, _, _ in uploads
+        ])
+        # Without a transaction, the changes are logged in batches of at
+        # most 500 too, so batches of any size can be imported.
+        self.change_log.append_many([{
+            'action': 'upload',
+            'page': char_name,
+            'world': char_world,
+            'user': uploader
+        } for uploader, _, char_name, _, char_world in uploads])
+
+    def edit_page(self,
+                  name: str,
+                  info: str = None,
+                  world: str = None,
+                  editor: str = None) -> IndexDelta:
+        """Edits a character's info or world.
+
+        The Character entity, the membership of the old and new World
+        entities and the change-log entry are written in one transaction,
+        retried when it conflicts with a concurrent write.
+
+        Args:
+            name: A string with the name of the character to edit.
+            info: A string with the new info, or None to keep it.
+            world: A string with the new world, or None to keep it.
+            editor: A string with the username of the editor.
+
+        Returns:
+            An `IndexDelta` with the tokens and world the page left and
+            joined, or None if the character is not found.
+        """
+
+        def edit(trans):
+            wiki_page = self.client.get(self.key('Character', name),
+                                        transaction=trans)
+            if wiki_page is None:
+                return None
+            old = _character(wiki_page)
+            new = old._replace(info=old.info if info is None else info,
+                               world=old.world if world is None else world)
+            wiki_page.update({'Info': new.info, 'World': new.world})
+            trans.put(wiki_page)
+            if new.world != old.world:
+                self._update_world(trans, old.world, remove=name)
+                self._update_world(trans, new.world, add=name)
+            old_tokens, new_tokens = page_tokens(old), page_tokens(new)
+            delta = IndexDelta(name, sorted(old_tokens - new_tokens),
+                               sorted(new_tokens - old_tokens), old.world,
+                               new.world)
+            self.change_log.append("edit",
+                                   name,
+                                   trans,
+                                   user=editor,
+                                   **_change_details(delta))
+            return delta
+
+        return run_in_transaction(self.client, edit, "edit_page")
+
+    def delete_page(self, name: str, user: str = None) -> IndexDelta:
+        """Deletes a character and everything recorded about its page.
+
+        The Character entity, its membership in its World (and the World,
+        once empty), its upvotes, comments and uploader, and its entry in
+        the uploader's uploads are removed in one transaction with the
+        change-log entry. The page's individual upvotes and comments, and a
+        legacy image stored under the character's name, are deleted
+        afterwards; content-addressed images are kept, since other
+        characters can share them.
+
+        Args:
+            name: A string with the name of the character to delete.
+            user: A string with the username of the user deleting it.
+
+        Returns:
+            An `IndexDelta` with every token of the page and its world, or
+            None if the character is not found.
+        """
+
+        def delete(trans):
+            wiki_page = self.client.get(self.key('Character', name),
+                                        transaction=trans)
+            if wiki_page is None:
+                return None
+            old = _character(wiki_page)
+            trans.delete(wiki_page.key)
+            self._update_world(trans, old.world, remove=name)
+            self.tracker.delete_page_records(name, trans)
+            delta = IndexDelta(name, sorted(page_tokens(old)), [], old.world,
+                               None)
+            self.change_log.append("delete",
+                                   name,
+                                   trans,
+                                   user=user,
+                                   **_change_details(delta))
+            return delta, old.image
+
+        deleted = run_in_transaction(self.client, delete, "delete_page")
+        if deleted is None:
+            return None
+        delta, image = deleted
+        self.tracker.delete_page_activity(name)
+        if not image:
+            try:
+                self.content_bucket.blob("character-images/" + name +
+                                         ".png").delete()
+            except NotFound:
+                pass
+        return delta
+
+    def _update_world(self, trans, world: str, add=None, remove=None):
+        """Adds or removes a character from a World entity in a transaction.
+
+        A World left without characters is deleted.
+        """
+        world_key = self.key('World', world)
+        world_entity = self.client.get(world_key, transaction=trans)
+        if world_entity is None:
+            if add is None:
+                return
+            world_entity = datastore.Entity(key=world_key)
+            world_entity.update({'world_name': world, 'characters': []})
+        characters = [
+            character for character in world_entity['characters']
+            if character != remove
+        ]
+        if add is not None and add not in characters:
+            characters.append(add)
+        if not characters:
+            trans.delete(world_key)
+            return
+        world_entity['characters'] = characters
+        trans.put(world_entity)
+
+    def store_image(self, data: bytes) -> tuple[str, list[str]]:
+        """Stores an image in the GCS bucket under its content-addressed name.
+
+        The blob is only written if no image with the same bytes is stored
+        yet. Each stored image gets an Image entity in the Datastore with its
+        perceptual hash, split into bands so near-duplicates can be found
+        with an indexed lookup instead of a scan.
+
+        The image's type is recognized from its bytes, never taken from the
+        client, since images are served from the wiki's own origin.
+
+        Args:
+            data: The bytes of the image.
+
+        Returns:
+            A tuple with the content-addressed name of the image, and a list
+            with the names of stored images that are identical or nearly
+            identical to it.
+
+        Raises:
+            ValueError: If the image is not a PNG, JPEG or GIF.
+        """
+        name = images.image_name(data)
+        content_type = images.content_type(name)
+        phash = images.perceptual_hash(data)
+        similar_images = self.find_similar_images(phash)
+        if name in similar_images or self.client.get(self.key('Image', name)):
+            # An exact duplicate, found even when the image has no hash.
+            if name not in similar_images:
+                similar_images.append(name)
+            return name, similar_images
+
+        blob = self.content_bucket.blob(images.blob_name(name))
+        blob.cache_control = images.IMMUTABLE_CACHE_CONTROL
+        try:
+            # Only create the blob; its bytes never change once written.
+            blob.upload_from_string(data,
+                                    content_type=content_type,
+                                    if_generation_match=0)
+        except PreconditionFailed:
+            pass  # Another upload stored the same image first.
+
+        image_entity = datastore.Entity(key=self.key('Image', name))
+        image_entity.update({
+            'content_type': content_type,
+            'size': len(data),
+            'phash': f'{phash:016x}' if phash is not None else None,
+            'bands': images.hash_bands(phash) if phash is not None else [],
+        })
+        self.client.put(image_entity)
+        return name, similar_images
+
+    def find_similar_images(self, phash: int) -> list[str]:
+        """Finds the stored images that look like an image.
+
+        Args:
+            phash: An integer with the perceptual hash of the image, or None
+                if it has none.
+
+        Returns:
+            A list with the names of the stored images whose perceptual hash
+            is within `images.NEAR_DUPLICATE_DISTANCE` bits of the given one.
+        """
+        if phash is None:
+            return []
+        query = self.client.query(kind='Image')
+        query.add_filter('bands', 'IN', images.hash_bands(phash))
+        return [
+            image.key.name
+            for image in query.fetch()
+            if images.hamming_distance(int(image['phash'], 16), phash) <=
+            images.NEAR_DUPLICATE_DISTANCE
+        ]
+
+    def get_pages_with_images(self, image_names: list[str]) -> list[str]:
+        """Get the names of the characters shown with any of the given images.
+
+        Args:
+            image_names: A list of content-addressed image names.
+
+        Returns:
+            A list of strings with the names of the characters.
+        """
+        page_names = []
+        for start in range(0, len(image_names), MAX_IN_VALUES):
+            query = self.client.query(kind='Character')
+            query.add_filter('Image', 'IN',
+                             image_names[start:start + MAX_IN_VALUES])
+            page_names.extend(entity.key.name for entity in query.fetch())
+        return page_names
+
+    def get_image_data(self, name: str) -> bytes:
+        """Get the bytes of a content-addressed image from the GCS bucket.
+
+        Args:
+            name: A string with the content-addressed name of the image.
+
+        Returns:
+            The bytes of the image, or None if no image has that name.
+        """
+        blob_name = images.blob_name(name)
+        # The name is the hash of the bytes, so any cached copy is current.
+        image_data = self.image_cache.get(blob_name)
+        if image_data is not None:
+            return image_data
+        blob = self.content_bucket.get_blob(blob_name)
+        if blob is None:
+            return None
+        image_data = blob.download_as_bytes()
+        self.image_cache.put(blob_name, blob.generation, image_data)
+        return image_data
+
+    def user_exists(self, username: str) -> bool:
+        """Check whether a user is registered.
+
+        Args:
+            username: A string representing the username to look up.
+
+        Returns:
+            A boolean value indicating whether the user exists.
+        """
+        return self.client.get(self.key('User', username)) is not None
 
     def sign_up(self, new_user_name: str, new_password: str) -> bool:
         """Registers a new user with a username and password.
@@ -145,17 +580,18 @@ class Backend:
         if user:
             return False
 
-        salted_password = f"{new_user_name}nbs{new_password}"
-        hashed_password = hashlib.blake2b(salted_password.encode()).hexdigest()
-
         new_user = datastore.Entity(key=user_key)
-        new_user.update({'hashed_password': hashed_password})
+        new_user.update(
+            {'hashed_password': self.password_hasher.hash(new_password)})
         self.client.put(new_user)
         return True
 
     def sign_in(self, username: str, password: str) -> bool or int:
         """Sign in an existing user with the provided username and password.
 
+        A password stored with a legacy or outdated hash is rehashed with the
+        current parameters once it is verified.
+
         Args:
             username: A string representing the username of the existing user.
             password: A string representing the password of the existing user.
@@ -169,13 +605,21 @@ class Backend:
             return -1
 
         hashed_password = user['hashed_password']
-        verify_password = hashlib.blake2b(
-            f"{username}nbs{password}".encode()).hexdigest()
-        return verify_password == hashed_password
+        if not self.password_hasher.verify(username, password, hashed_password):
+            return False
+        if self.password_hasher.needs_rehash(hashed_password):
+            user['hashed_password'] = self.password_hasher.hash(password)
+            self.client.put(user)
+        return True
 
     def get_image(self, filepath: str, page_name: str) -> str:
         """Get the encoded image data of a character image from the GCS bucket.
 
+        Characters uploaded before images were content-addressed have their
+        image stored by name, and are rendered with it inline. The image can
+        be replaced under the same name, so only the blob's metadata is read
+        and the image is downloaded when its generation is not cached.
+
         Args:
             filepath: A string representing the file path of the character image in the GCS bucket.
             page_name: A string representing the name of the character whose image to retrieve.
@@ -183,8 +627,16 @@ class Backend:
         Returns:
             A string representing the encoded image data of the character image.
         """
-        blob = self.content_bucket.blob(filepath + page_name + ".png")
-        image_data = blob.download_as_bytes()
+        blob_name = filepath + page_name + ".png"
+        blob = self.content_bucket.get_blob(blob_name)
+        if blob is None:
+            raise NotFound(f"Image {blob_name} not found")
+        image_data = self.image_cache.get(blob_name, blob.generation)
+        if image_data is None:
+            # The blob's media link names its generation, so the bytes
+            # match the generation they are cached under.
+            image_data = blob.download_as_bytes()
+            self.image_cache.put(blob_name, blob.generation, image_data)
         encoded_image_data = base64.b64encode(image_data).decode("utf-8")
         return encoded_image_data
 
@@ -205,19 +657,17 @@ class Backend:
         """Returns a list of pages uploaded by the given user."""
         return self.tracker.get_pages_uploaded(username)
 
-    def get_user_comments(self, username, uploaded_pages):
-        """Returns a dictionary of comments made by the given user."""
+    def get_user_comments(self, username, uploaded_pages) -> dict:
+        """Returns a dictionary mapping page names to the `Comment` records
+        left on them by the given user."""
         comments = {}
         for pagename in uploaded_pages:
-            page_comments = self.tracker.get_comments(pagename)
-            if page_comments:
-                for comment_id, comment_data in page_comments.items():
-                    if username in comment_data:
-                        if pagename not in comments:
-                            comments[pagename] = {}
-                        comments[pagename][comment_id] = {
-                            username: comment_data[username]
-                        }
+            user_comments = [
+                comment for comment in self.tracker.get_comments(pagename)
+                if comment.username == username
+            ]
+            if user_comments:
+                comments[pagename] = user_comments
         return comments
 
     #Extra
@@ -253,12 +703,14 @@ class Backend:
 
         name_list = self.get_all_page_names()
         matching_names = list()
+        lowcase_q = query.lower()
         for page_name in name_list:
-            page_content = self.get_wiki_page(page_name)
-            character_name, description, world = page_content.split('|', 3)
-            lowcase_q = query.lower()
-            if lowcase_q in character_name.lower(
-            ) or lowcase_q in description.lower() or lowcase_q in world.lower():
+            character = self.get_wiki_page(page_name)
+            if character is None:
+                continue  # Deleted since the names were listed.
+            if lowcase_q in character.name.lower(
+            ) or lowcase_q in character.info.lower(
+            ) or lowcase_q in character.world.lower():
                 matching_names.append(page_name)
         return matching_names
 
@@ -305,3 +757,64 @@ class Backend:
         results = list(query.fetch())
         worlds = [result['world_name'] for result in results]
         return worlds
+
+    def build_world_listing(self) -> dict[str, list[str]]:
+        """Scans every World entity into a listing of worlds and characters.
+
+        Returns:
+            A dictionary mapping each world's name to the names of its
+            characters.
+        """
+        query = self.client.query(kind='World')
+        return {
+            result['world_name']: list(result['characters'])
+            for result in query.fetch()
+        }
+
+    def get_world_listing(self) -> WorldListing:
+        """Fetches the precomputed listing of worlds and characters.
+
+        Returns:
+            The stored `WorldListing`, or None if it was never built or was
+            built against the old integer sequence numbers of the change-log.
+        """
+        listing = self.client.get(self.key('WorldListing', 'latest'))
+        if not listing or not isinstance(listing['seq'], str):
+            return None
+        return WorldListing(json.loads(listing['worlds']), listing['seq'])
+
+    def save_world_listing(self, listing: WorldListing) -> None:
+        """Stores the precomputed listing of worlds and characters.
+
+        Args:
+            listing: A `WorldListing` record to store.
+        """
+        entity = datastore.Entity(key=self.key('WorldListing', 'latest'),
+                                  exclude_from_indexes=('worlds',))
+        entity.update({
+            'worlds': json.dumps(listing.worlds, separators=(',', ':')),
+            'seq': listing.seq,
+        })
+        self.client.put(entity)
+
+
+def page_tokens(character: Character) -> set[str]:
+    """Returns the lowercased words of a character's name, info and world."""
+    return set(
+        TOKEN.findall(
+            f"{character.name} {character.info} {character.world}".lower()))
+
+
+def _character(wiki_page) -> Character:
+    return Character(wiki_page['Name'], wiki_page['Info'], wiki_page['World'],
+                     wiki_page.get('Image'))
+
+
+def _change_details(delta: IndexDelta) -> dict:
+    """Returns the change-log properties of an index delta."""
+    return {
+        "world": delta.new_world,
+        "old_world": delta.old_world,
+        "removed_tokens": delta.removed_tokens,
+        "added_tokens": delta.added_tokens,
+    }
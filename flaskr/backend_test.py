@@ -1,14 +1,22 @@
 import pytest, hashlib, base64
+from google.cloud import datastore
 from werkzeug.security import generate_password_hash
 from unittest.mock import MagicMock, Mock, call
+from . import images
 from .backend import Backend
+from .passwords import PasswordHasher
+from .records import Character, Comment, IndexDelta, PageStats, WorldListing
 import json
 
 
 # Mocking Google Cloud Storage and Datastore client
 @pytest.fixture
 def mock_backend():
-    backend = Backend(MagicMock(), MagicMock(), MagicMock(), MagicMock())
+    backend = Backend(MagicMock(),
+                      MagicMock(),
+                      MagicMock(),
+                      MagicMock(),
+                      password_hasher=PasswordHasher('scrypt', 2**10))
 
     # Mock the key method
     def key_mock(*args, **kwargs):
@@ -35,7 +43,9 @@ def test_get_wiki_page(mock_backend):
     mock_backend.client.get.side_effect = get_side_effect
 
     result = mock_backend.get_wiki_page('Mario')
-    assert result == 'Mario|Plumber from the Mushroom Kingdom|Super Mario Bros.'
+    assert result == Character('Mario', 'Plumber from the Mushroom Kingdom',
+                               'Super Mario Bros.')
+    assert result.info == 'Plumber from the Mushroom Kingdom'
 
     result = mock_backend.get_wiki_page('Noel')
     assert result is None
@@ -72,17 +82,54 @@ def test_get_all_usernames(mock_backend):
 
 
 def test_upload(mock_backend):
-    mock_backend.content_bucket.blob.return_value = MagicMock(
-        upload_from_file=MagicMock())
+    image_data = b'\x89PNG\r\n\x1a\nmario sprite'
+    image_name = hashlib.sha256(image_data).hexdigest() + '.png'
+    mock_backend.client.get.return_value = None
+    # The type the client claims is ignored.
+    f = MagicMock(content_type='text/html',
+                  read=MagicMock(return_value=image_data))
+    result = mock_backend.upload("tester", f, 'Mario',
+                                 'A character from the Mario series.',
+                                 'Mushroom Kingdom')
+
+    assert result == []
+    mock_backend.content_bucket.blob.assert_called_once_with('images/' +
+                                                             image_name)
+    mock_backend.content_bucket.blob.return_value.upload_from_string.assert_called_once_with(
+        image_data, content_type='image/png', if_generation_match=0)
+    wiki_page = mock_backend.client.put.call_args_list[1].args[0]
+    assert wiki_page['Image'] == image_name
 
-    f = MagicMock(content_type='image/png', tell=MagicMock(return_value=0))
-    mock_backend.upload("tester", f, 'Mario',
-                        'A character from the Mario series.',
-                        'Mushroom Kingdom')
 
-    mock_backend.content_bucket.blob.assert_called_with(
-        'character-images/Mario.png')
-    mock_backend.client.put.assert_called()
+def test_store_image_stores_identical_images_once(mock_backend):
+    mock_backend.client.get.return_value = {'content_type': 'image/png'}
+
+    image_data = b'\x89PNG\r\n\x1a\nmario sprite'
+    name, similar_images = mock_backend.store_image(image_data)
+    assert name == hashlib.sha256(image_data).hexdigest() + '.png'
+    # Exact duplicates are reported even without a perceptual hash.
+    assert similar_images == [name]
+    mock_backend.content_bucket.blob.assert_not_called()
+    mock_backend.client.put.assert_not_called()
+
+
+def test_find_similar_images(mock_backend):
+
+    def image(name, phash):
+        entity = MagicMock()
+        entity.key.name = name
+        entity.__getitem__.side_effect = {'phash': f'{phash:016x}'}.get
+        return entity
+
+    # Candidates share a band with the hash; only close ones are similar.
+    mock_backend.client.query.return_value.fetch.return_value = [
+        image('close.png', 0xff00ff00ff00ff03),
+        image('far.png', 0xff00ff00ffffffff)
+    ]
+    assert mock_backend.find_similar_images(0xff00ff00ff00ff00) == ['close.png']
+    mock_backend.client.query.return_value.add_filter.assert_called_once_with(
+        'bands', 'IN', images.hash_bands(0xff00ff00ff00ff00))
+    assert mock_backend.find_similar_images(None) == []
 
 
 def test_sign_up(mock_backend):
@@ -91,15 +138,32 @@ def test_sign_up(mock_backend):
     result = mock_backend.sign_up("new_user", "new_password")
     assert result is True
 
+    new_user = mock_backend.client.put.call_args.args[0]
+    assert new_user['hashed_password'].startswith('scrypt$')
+    assert mock_backend.password_hasher.verify('new_user', 'new_password',
+                                               new_user['hashed_password'])
+
 
 def test_sign_in(mock_backend):
     correct_password = 'existing_password'
     salted_password = f"existing_usernbs{correct_password}"
     correct_hash = hashlib.blake2b(salted_password.encode()).hexdigest()
-    mock_backend.client.get.return_value = {'hashed_password': correct_hash}
+    user = {'hashed_password': correct_hash}
+    mock_backend.client.get.return_value = user
+
+    result = mock_backend.sign_in('existing_user', 'wrong_password')
+    assert result is False
+    mock_backend.client.put.assert_not_called()
+
+    # The legacy hash is upgraded once the password is verified.
+    result = mock_backend.sign_in('existing_user', correct_password)
+    assert result is True
+    mock_backend.client.put.assert_called_once_with(user)
+    assert user['hashed_password'].startswith('scrypt$')
 
     result = mock_backend.sign_in('existing_user', correct_password)
     assert result is True
+    mock_backend.client.put.assert_called_once()
 
     mock_backend.client.get.return_value = None
     result = mock_backend.sign_in('nonexistent_user', 'password')
@@ -110,33 +174,46 @@ def test_get_query_pages_name_search(mock_backend):
     mock_backend.get_all_page_names = MagicMock(return_value=["Mario", "Link"])
     mock_backend.get_wiki_page = MagicMock()
     mock_backend.get_wiki_page.side_effect = [
-        'Mario|Plumber from the Mushroom Kingdom|Super Mario Bros.',
-        'Link|I have a boomerang|La Leyenda de Zelda'
+        Character('Mario', 'Plumber from the Mushroom Kingdom',
+                  'Super Mario Bros.'),
+        Character('Link', 'I have a boomerang', 'La Leyenda de Zelda')
     ]
     result = mock_backend.get_query_pages("Link")
     assert result == ["Link"]
 
     mock_backend.get_wiki_page.side_effect = [
-        'Mario|Plumber from the Mushroom Kingdom|Super Mario Bros.',
-        'Link|I have a boomerang|La Leyenda de Zelda'
+        Character('Mario', 'Plumber from the Mushroom Kingdom',
+                  'Super Mario Bros.'),
+        Character('Link', 'I have a boomerang', 'La Leyenda de Zelda')
     ]
     result = mock_backend.get_query_pages("Mario")
     assert result == ["Mario"]
 
 
+def test_get_query_pages_skips_pages_deleted_during_search(mock_backend):
+    mock_backend.get_all_page_names = MagicMock(return_value=["Mario", "Link"])
+    mock_backend.get_wiki_page = MagicMock(side_effect=[
+        None,
+        Character('Link', 'I have a boomerang', 'La Leyenda de Zelda')
+    ])
+    assert mock_backend.get_query_pages("a") == ["Link"]
+
+
 def test_get_query_pages_content_search(mock_backend):
     mock_backend.get_all_page_names = MagicMock(return_value=["Mario", "Link"])
     mock_backend.get_wiki_page = MagicMock()
     mock_backend.get_wiki_page.side_effect = [
-        'Mario|Plumber from the Mushroom Kingdom|Super Mario Bros.',
-        'Link|I have a boomerang|La Leyenda de Zelda'
+        Character('Mario', 'Plumber from the Mushroom Kingdom',
+                  'Super Mario Bros.'),
+        Character('Link', 'I have a boomerang', 'La Leyenda de Zelda')
     ]
     result = mock_backend.get_query_pages("boomerang")
     assert result == ["Link"]
 
     mock_backend.get_wiki_page.side_effect = [
-        'Mario|Plumber from the Mushroom Kingdom|Super Mario Bros.',
-        'Link|I have a boomerang|La Leyenda de Zelda'
+        Character('Mario', 'Plumber from the Mushroom Kingdom',
+                  'Super Mario Bros.'),
+        Character('Link', 'I have a boomerang', 'La Leyenda de Zelda')
     ]
     result = mock_backend.get_query_pages("Plumber")
     assert result == ["Mario"]
@@ -146,15 +223,17 @@ def test_get_query_pages_world_search(mock_backend):
     mock_backend.get_all_page_names = MagicMock(return_value=["Mario", "Link"])
     mock_backend.get_wiki_page = MagicMock()
     mock_backend.get_wiki_page.side_effect = [
-        'Mario|Plumber from the Mushroom Kingdom|Super Mario Bros.',
-        'Link|I have a boomerang|La Leyenda de Zelda'
+        Character('Mario', 'Plumber from the Mushroom Kingdom',
+                  'Super Mario Bros.'),
+        Character('Link', 'I have a boomerang', 'La Leyenda de Zelda')
     ]
     result = mock_backend.get_query_pages("La Leyenda de Zelda")
     assert result == ["Link"]
 
     mock_backend.get_wiki_page.side_effect = [
-        'Mario|Plumber from the Mushroom Kingdom|Super Mario Bros.',
-        'Link|I have a boomerang|La Leyenda de Zelda'
+        Character('Mario', 'Plumber from the Mushroom Kingdom',
+                  'Super Mario Bros.'),
+        Character('Link', 'I have a boomerang', 'La Leyenda de Zelda')
     ]
     result = mock_backend.get_query_pages("Super Mario Bros.")
     assert result == ["Mario"]
@@ -164,15 +243,17 @@ def test_get_query_pages_empty_search(mock_backend):
     mock_backend.get_all_page_names = MagicMock(return_value=["Mario", "Link"])
     mock_backend.get_wiki_page = MagicMock()
     mock_backend.get_wiki_page.side_effect = [
-        'Mario|Plumber from the Mushroom Kingdom|Super Mario Bros.',
-        'Link|I have a boomerang|La Leyenda de Zelda'
+        Character('Mario', 'Plumber from the Mushroom Kingdom',
+                  'Super Mario Bros.'),
+        Character('Link', 'I have a boomerang', 'La Leyenda de Zelda')
     ]
     result = mock_backend.get_query_pages("")
     assert result == ["Mario", "Link"]
 
     mock_backend.get_wiki_page.side_effect = [
-        'Mario|Plumber from the Mushroom Kingdom|Super Mario Bros.',
-        'Link|I have a boomerang|La Leyenda de Zelda'
+        Character('Mario', 'Plumber from the Mushroom Kingdom',
+                  'Super Mario Bros.'),
+        Character('Link', 'I have a boomerang', 'La Leyenda de Zelda')
     ]
     result = mock_backend.get_query_pages(None)
     assert result == ["Mario", "Link"]
@@ -251,23 +332,13 @@ def test_get_worlds_no_worlds(mock_backend):
 
 def test_get_user_comments(mock_backend):
     # Prepare the mock data for tracker.get_comments method
-    mock_comments = {
-        '0': {
-            'Noel1827': 'testing testing'
-        },
-        '1': {
-            '2': 'tsting again brrrr'
-        },
-        '2': {
-            '2': 'tsting again brrrr'
-        },
-        '3': {
-            '2': 'one more time'
-        },
-        '4': {
-            '2': 'one more time'
-        }
-    }
+    mock_comments = [
+        Comment(0, 'Noel1827', 'testing testing'),
+        Comment(1, '2', 'tsting again brrrr'),
+        Comment(2, '2', 'tsting again brrrr'),
+        Comment(3, '2', 'one more time'),
+        Comment(4, '2', 'one more time'),
+    ]
     mock_tracker = MagicMock(get_comments=MagicMock(return_value=mock_comments))
     mock_backend.tracker = mock_tracker
 
@@ -277,22 +348,7 @@ def test_get_user_comments(mock_backend):
     result = mock_backend.get_user_comments(username, uploaded_pages)
 
     # Assert that the expected comments were returned
-    expected_result = {
-        'Donkey Kong': {
-            '1': {
-                '2': 'tsting again brrrr'
-            },
-            '2': {
-                '2': 'tsting again brrrr'
-            },
-            '3': {
-                '2': 'one more time'
-            },
-            '4': {
-                '2': 'one more time'
-            }
-        }
-    }
+    expected_result = {'Donkey Kong': mock_comments[1:]}
     assert expected_result == result
 
     # Check that get_comments was called with the expected arguments
@@ -306,8 +362,9 @@ def test_get_image(mock_backend):
     encoded_image_data = base64.b64encode(image_data).decode("utf-8")
 
     # Set up the mock for the blob
-    mock_blob = MagicMock(download_as_bytes=MagicMock(return_value=image_data))
-    mock_backend.content_bucket.blob.return_value = mock_blob
+    mock_blob = MagicMock(download_as_bytes=MagicMock(return_value=image_data),
+                          generation=1)
+    mock_backend.content_bucket.get_blob.return_value = mock_blob
 
     # Test the get_image function
     filepath = 'character-images/'
@@ -316,6 +373,33 @@ def test_get_image(mock_backend):
 
     # Assert the expected image data is returned
     assert result == encoded_image_data
+    mock_backend.content_bucket.get_blob.assert_called_once_with(
+        'character-images/Mario.png')
+
+    # The cached generation is served without downloading it again.
+    assert mock_backend.get_image(filepath, page_name) == encoded_image_data
+    mock_blob.download_as_bytes.assert_called_once()
+
+    # A replaced image is downloaded again.
+    mock_blob.generation = 2
+    mock_blob.download_as_bytes.return_value = b'new_image_data'
+    assert mock_backend.get_image(
+        filepath,
+        page_name) == base64.b64encode(b'new_image_data').decode("utf-8")
+
+
+def test_get_image_data_is_cached(mock_backend):
+    blob = MagicMock(generation=3)
+    blob.download_as_bytes.return_value = b'sprite'
+    mock_backend.content_bucket.get_blob.return_value = blob
+
+    assert mock_backend.get_image_data('abc.png') == b'sprite'
+    assert mock_backend.get_image_data('abc.png') == b'sprite'
+
+    # Content-addressed images are not revalidated.
+    mock_backend.content_bucket.get_blob.assert_called_once_with(
+        'images/abc.png')
+    blob.download_as_bytes.assert_called_once()
 
 
 def test_get_characters_by_world(mock_backend):
@@ -357,3 +441,213 @@ def test_get_characters_by_world(mock_backend):
     mock_backend.client.query.return_value.fetch.return_value = []
     result = mock_backend.get_characters_by_world("Nonexistent World")
     assert result == []
+
+
+def test_get_page_version(mock_backend):
+    character = {
+        'Name': 'Mario',
+        'Info': 'Plumber from the Mushroom Kingdom',
+        'World': 'Super Mario Bros.'
+    }
+    mock_backend.client.get.side_effect = lambda key: character if key.name == 'Mario' else None
+    mock_backend.tracker.get_page_stats.return_value = PageStats(5, 2, 'Noel')
+    mock_backend.content_bucket.get_blob.return_value = MagicMock(generation=1)
+
+    version = mock_backend.get_page_version('Mario')
+    assert version == mock_backend.get_page_version('Mario')
+    mock_backend.content_bucket.get_blob.assert_called_with(
+        'character-images/Mario.png')
+    mock_backend.content_bucket.blob.return_value.download_as_bytes.assert_not_called(
+    )
+
+    # A new upvote, comment or image generation changes the version.
+    mock_backend.tracker.get_page_stats.return_value = PageStats(6, 2, 'Noel')
+    assert mock_backend.get_page_version('Mario') != version
+    mock_backend.tracker.get_page_stats.return_value = PageStats(5, 2, 'Noel')
+    mock_backend.content_bucket.get_blob.return_value = MagicMock(generation=2)
+    assert mock_backend.get_page_version('Mario') != version
+
+    assert mock_backend.get_page_version('Noel') is None
+
+    # Content-addressed images are named in the Character entity.
+    mock_backend.content_bucket.get_blob.reset_mock()
+    character['Image'] = 'abc.png'
+    assert mock_backend.get_page_version('Mario') != version
+    mock_backend.content_bucket.get_blob.assert_not_called()
+
+
+def test_upload_batch(mock_backend, tmp_path):
+    existing_world = MagicMock()
+    existing_world.key.name = 'Super Mario Bros.'
+    existing_world.__getitem__.side_effect = {'characters': ['Mario']}.get
+    mock_backend.client.get_multi.return_value = [existing_world]
+    mock_backend.client.get.return_value = None
+    for name in ('Mario.png', 'Luigi.png'):
+        (tmp_path / name).write_bytes(b'\x89PNG\r\n\x1a\n' + name.encode())
+    (tmp_path / 'Link.gif').write_bytes(b'GIF89aLink')
+
+    mock_backend.upload_batch([
+        ('sebagabs', str(tmp_path / 'Mario.png'), 'Mario', 'Plumber',
+         'Super Mario Bros.'),
+        ('sebagabs', str(tmp_path / 'Luigi.png'), 'Luigi', 'Brother',
+         'Super Mario Bros.'),
+        ('Noel', str(tmp_path / 'Link.gif'), 'Link', 'Hero',
+         'The Legend of Zelda'),
+    ])
+
+    link_image = hashlib.sha256(b'GIF89aLink').hexdigest() + '.gif'
+    mock_backend.content_bucket.blob.assert_any_call('images/' + link_image)
+    mock_backend.content_bucket.blob.return_value.upload_from_string.assert_any_call(
+        b'GIF89aLink', content_type='image/gif', if_generation_match=0)
+    assert mock_backend.content_bucket.blob.call_count == 3
+
+    written = mock_backend.client.put_multi.call_args_list[0].args[0]
+    assert [entity['Name'] for entity in written[:3]
+           ] == ['Mario', 'Luigi', 'Link']
+    assert written[2]['Image'] == link_image
+    assert written[3] is existing_world
+    assert existing_world['characters'] == ['Mario', 'Luigi']
+    assert written[4]['characters'] == ['Link']
+    mock_backend.tracker.add_uploads.assert_called_once_with([
+        ('sebagabs', 'Mario'), ('sebagabs', 'Luigi'), ('Noel', 'Link')
+    ])
+
+
+def test_upload_batch_commits_at_most_500_entities(mock_backend, tmp_path):
+    mock_backend.client.get_multi.return_value = []
+    mock_backend.client.get.return_value = None
+    (tmp_path / 'Mii.png').write_bytes(b'\x89PNG\r\n\x1a\nMii')
+
+    mock_backend.upload_batch([('sebagabs', str(tmp_path / 'Mii.png'),
+                                f'Mii {i}', 'Fighter', 'Wii')
+                               for i in range(501)])
+
+    batches = [c.args[0] for c in mock_backend.client.put_multi.call_args_list]
+    assert max(len(batch) for batch in batches) == 500
+    changes = [
+        entity for batch in batches for entity in batch
+        if entity.get('action') == 'upload'
+    ]
+    assert len(changes) == 501
+
+
+def test_user_exists(mock_backend):
+    mock_backend.client.get.side_effect = lambda key: {
+        'hashed_password': 'hash'
+    } if key.name == 'sebagabs' else None
+
+    assert mock_backend.user_exists('sebagabs') is True
+    assert mock_backend.user_exists('Noel') is False
+
+
+def test_get_wiki_pages(mock_backend):
+    mario = MagicMock()
+    mario.key.name = 'Mario'
+    mario.__getitem__.side_effect = {
+        'Name': 'Mario',
+        'Info': 'Plumber',
+        'World': 'Super Mario Bros.'
+    }.__getitem__
+    mario.get.return_value = 'abc.png'
+    mock_backend.client.get_multi.return_value = [mario]
+
+    result = mock_backend.get_wiki_pages(['Mario', 'Noel'])
+    assert result == {
+        'Mario': Character('Mario', 'Plumber', 'Super Mario Bros.', 'abc.png')
+    }
+    assert len(mock_backend.client.get_multi.call_args.args[0]) == 2
+
+
+def test_world_listing_round_trip(mock_backend):
+    mock_backend.client.query.return_value.fetch.return_value = [{
+        'world_name': 'EarthBound',
+        'characters': ['Ness', 'Lucas']
+    }]
+    worlds = mock_backend.build_world_listing()
+    assert worlds == {'EarthBound': ['Ness', 'Lucas']}
+
+    seq = '1792000000000000-a1b2c3d4-00000000'
+    mock_backend.save_world_listing(WorldListing(worlds, seq))
+    stored = mock_backend.client.put.call_args.args[0]
+    assert 'worlds' in stored.exclude_from_indexes
+    mock_backend.client.get.return_value = stored
+    assert mock_backend.get_world_listing() == WorldListing(worlds, seq)
+
+    # Listings of the old integer sequence numbers are rebuilt.
+    stored['seq'] = 12
+    assert mock_backend.get_world_listing() is None
+
+    mock_backend.client.get.return_value = None
+    assert mock_backend.get_world_listing() is None
+
+
+@pytest.fixture
+def stored_pages(mock_backend):
+    """Stores Mario in the mocked Datastore and returns the transaction."""
+    mario = datastore.Entity()
+    mario.update({
+        'Name': 'Mario',
+        'Info': 'A brave plumber',
+        'World': 'Super Mario Bros.'
+    })
+    worlds = datastore.Entity()
+    worlds.update({'characters': ['Mario', 'Luigi']})
+    stored = {'Mario': mario, 'Super Mario Bros.': worlds}
+    mock_backend.client.get.side_effect = lambda key, **kwargs: stored.get(key.
+                                                                           name)
+    return mock_backend.client.transaction.return_value.__enter__.return_value
+
+
+def test_edit_page_emits_index_delta(mock_backend, stored_pages):
+    delta = mock_backend.edit_page('Mario',
+                                   info='A brave jumper',
+                                   world='Mushroom Kingdom',
+                                   editor='sebagabs')
+    assert delta == IndexDelta('Mario', ['bros', 'plumber', 'super'],
+                               ['jumper', 'kingdom', 'mushroom'],
+                               'Super Mario Bros.', 'Mushroom Kingdom')
+
+    puts = [call.args[0] for call in stored_pages.put.call_args_list]
+    assert puts[0]['World'] == 'Mushroom Kingdom'
+    assert puts[1]['characters'] == ['Luigi']
+    assert puts[2]['characters'] == ['Mario']
+    change = puts[3]
+    assert change['action'] == 'edit'
+    assert change['old_world'] == 'Super Mario Bros.'
+    assert change['added_tokens'] == ['jumper', 'kingdom', 'mushroom']
+
+    # Missing characters cannot be edited.
+    assert mock_backend.edit_page('Wario', info='Greedy') is None
+
+
+def test_delete_page_cascades(mock_backend, stored_pages):
+    delta = mock_backend.delete_page('Mario', user='sebagabs')
+    assert delta == IndexDelta(
+        'Mario', ['a', 'brave', 'bros', 'mario', 'plumber', 'super'], [],
+        'Super Mario Bros.', None)
+
+    mock_backend.tracker.delete_page_records.assert_called_once_with(
+        'Mario', stored_pages)
+    mock_backend.tracker.delete_page_activity.assert_called_once_with('Mario')
+    puts = [call.args[0] for call in stored_pages.put.call_args_list]
+    assert puts[0]['characters'] == ['Luigi']
+    assert puts[1]['action'] == 'delete'
+    # The legacy image stored under the character's name is deleted too.
+    mock_backend.content_bucket.blob.assert_called_once_with(
+        'character-images/Mario.png')
+
+    # A world left without characters is deleted.
+    mock_backend.client.get(mock_backend.key(
+        'World', 'Super Mario Bros.'))['characters'] = ['Mario']
+    stored_pages.reset_mock()
+    mock_backend.delete_page('Mario')
+    assert stored_pages.delete.call_count == 2
+
+
+def test_upload_rejects_files_that_are_not_images(mock_backend):
+    f = MagicMock(content_type='image/png',
+                  read=MagicMock(return_value=b'<script></script>'))
+    with pytest.raises(ValueError):
+        mock_backend.upload('tester', f, 'Mario', 'Plumber', 'Mushroom Kingdom')
+    mock_backend.content_bucket.blob.assert_not_called()
+    mock_backend.client.put.assert_not_called()
@@ -0,0 +1,431 @@
+from concurrent.futures import ThreadPoolExecutor
+from google.api_core.exceptions import NotFound
+from google.cloud import datastore
+from typing import Iterator
+import click
+import csv
+import io
+import json
+import logging
+import mimetypes
+import os
+import tarfile
+import tempfile
+from . import images
+""" Provides bulk loading, export and restore of wiki content for the Super Smash Bros. wiki project """
+
+logger = logging.getLogger(__name__)
+
+# Datastore kinds holding wiki content, in the order they are exported.
+EXPORT_KINDS = ('Character', 'Image', 'World', 'UserUploads', 'PageUploader',
+                'Upvote', 'PageComment', 'PageUpvote', 'UpvoteCount',
+                'PageCommentEntry', 'CommentCount')
+
+
+def read_manifest(path: str) -> Iterator[dict]:
+    """Streams the rows of a CSV or JSON manifest of characters.
+
+    CSV manifests need a header row. Files ending in ".json" hold a single
+    JSON array; any other extension is read as newline-delimited JSON, one
+    object per line, so large manifests never have to fit in memory.
+
+    Args:
+        path: A string with the path of the manifest file.
+
+    Yields:
+        A dictionary per character, with the keys "name", "info", "world",
+        and optionally "image" and "uploader".
+    """
+    with open(path, newline='', encoding='utf-8') as manifest:
+        if path.endswith('.csv'):
+            yield from csv.DictReader(manifest)
+        elif path.endswith('.json'):
+            yield from json.load(manifest)
+        else:
+            for line in manifest:
+                if line.strip():
+                    yield json.loads(line)
+
+
+class BulkImporter:
+    """Seeds the wiki with characters from a manifest and an image directory.
+
+    Rows are uploaded in batches through `Backend.upload_batch`. After each
+    batch is written, the number of manifest rows done is saved to a
+    checkpoint file, so an interrupted import resumes where it stopped.
+
+    Attributes:
+        backend:
+            The `Backend` the characters are uploaded through.
+        image_dir:
+            A string with the directory holding the character images.
+        uploader:
+            A string with the username credited for rows without an uploader.
+        batch_size:
+            An integer with the number of characters written per batch.
+        max_workers:
+            An integer with the number of concurrent image uploads.
+        checkpoint_path:
+            A string with the path of the checkpoint file, or None to always
+            import the manifest from its first row.
+    """
+
+    def __init__(self,
+                 backend,
+                 image_dir: str,
+                 uploader: str,
+                 batch_size: int = 200,
+                 max_workers: int = 8,
+                 checkpoint_path: str = None) -> None:
+        self.backend = backend
+        self.image_dir = image_dir
+        self.uploader = uploader
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.checkpoint_path = checkpoint_path
+
+    def run(self, manifest_path: str) -> dict:
+        """Imports every character in a manifest not yet checkpointed.
+
+        Args:
+            manifest_path: A string with the path of the manifest file.
+
+        Returns:
+            A dictionary with the number of rows "imported", "skipped" for
+            being invalid, and the row the import "resumed_from".
+        """
+        resumed_from = self.load_checkpoint()
+        stats = {'imported': 0, 'skipped': 0, 'resumed_from': resumed_from}
+        batch = []
+        rows_done = resumed_from
+        for row_num, row in enumerate(read_manifest(manifest_path)):
+            if row_num < resumed_from:
+                continue
+            upload = self._to_upload(row)
+            if upload is None:
+                logger.warning("Skipping invalid manifest row %d: %r", row_num,
+                               row)
+                stats['skipped'] += 1
+            else:
+                batch.append(upload)
+            rows_done = row_num + 1
+            if len(batch) >= self.batch_size:
+                self._flush(batch, rows_done, stats)
+                batch = []
+        self._flush(batch, rows_done, stats)
+        return stats
+
+    def load_checkpoint(self) -> int:
+        """Returns the number of manifest rows already imported."""
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return 0
+        with open(self.checkpoint_path, encoding='utf-8') as checkpoint:
+            return json.load(checkpoint)['rows_done']
+
+    def save_checkpoint(self, rows_done: int) -> None:
+        """Atomically records the number of manifest rows imported."""
+        if not self.checkpoint_path:
+            return
+        temp_path = self.checkpoint_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as checkpoint:
+            json.dump({'rows_done': rows_done}, checkpoint)
+        os.replace(temp_path, self.checkpoint_path)
+
+    def _to_upload(self, row: dict) -> tuple:
+        """Converts a manifest row to an `upload_batch` tuple, or None if invalid."""
+        name = (row.get('name') or '').strip()
+        info = (row.get('info') or '').strip()
+        world = (row.get('world') or '').strip()
+        image = row.get('image') or name + '.png'
+        image_path = os.path.join(self.image_dir, image)
+        if not (name and info and world) or not self.backend.allowed_file(
+                image) or not os.path.isfile(image_path):
+            return None
+        with open(image_path, 'rb') as image_file:
+            if images.image_format(image_file.read(16)) is None:
+                return None
+        return (row.get('uploader') or
+                self.uploader, image_path, name, info, world)
+
+    def _flush(self, batch: list, rows_done: int, stats: dict) -> None:
+        """Uploads a batch and checkpoints the rows it covers."""
+        if batch:
+            self.backend.upload_batch(batch, max_workers=self.max_workers)
+            stats['imported'] += len(batch)
+            logger.info("Imported %d characters", stats['imported'])
+        self.save_checkpoint(rows_done)
+
+
+class BulkExporter:
+    """Dumps the wiki's content into a tar archive.
+
+    Each kind in `EXPORT_KINDS` is written as "datastore/<kind>.ndjson",
+    one entity per line, and each image as "images/<blob name>": the
+    content-addressed images of the Image kind once each, and the legacy
+    images of characters uploaded before images were content-addressed.
+    Queries are paged with cursors, and the images of one page of
+    characters are downloaded in parallel before the next page is fetched,
+    so memory stays bounded by the page size.
+
+    Attributes:
+        backend:
+            The `Backend` whose Datastore and content bucket are exported.
+        page_size:
+            An integer with the number of entities fetched per query page.
+        max_workers:
+            An integer with the number of concurrent image downloads.
+    """
+
+    def __init__(self, backend, page_size: int = 500, max_workers: int = 8):
+        self.backend = backend
+        self.page_size = page_size
+        self.max_workers = max_workers
+
+    def run(self, archive_path: str) -> dict:
+        """Exports every entity and character image to an archive.
+
+        Args:
+            archive_path: A string with the path of the archive to write.
+                Paths ending in ".tar.gz" or ".tgz" are gzip-compressed.
+
+        Returns:
+            A dictionary with the number of entities exported per kind, and
+            the number of "images" exported.
+        """
+        stats = {'images': 0}
+        mode = 'w:gz' if archive_path.endswith(('.tar.gz', '.tgz')) else 'w'
+        with tarfile.open(archive_path, mode) as archive, ThreadPoolExecutor(
+                max_workers=self.max_workers) as executor:
+            for kind in EXPORT_KINDS:
+                stats[kind] = 0
+                # Records are spooled to disk, since a tar member's size must
+                # be known before its data is written.
+                with tempfile.TemporaryFile() as records:
+                    for entities in self.fetch_pages(kind):
+                        for entity in entities:
+                            records.write(
+                                json.dumps(_entity_record(entity)).encode() +
+                                b'\n')
+                        stats[kind] += len(entities)
+                        stats['images'] += self._export_images(
+                            archive, executor, _image_blob_names(entities))
+                    _add_member(archive, f'datastore/{kind}.ndjson', records)
+                logger.info("Exported %d %s entities", stats[kind], kind)
+        return stats
+
+    def fetch_pages(self, kind: str) -> Iterator[list]:
+        """Pages through every entity of a kind with query cursors.
+
+        Args:
+            kind: A string with the name of the Datastore kind.
+
+        Yields:
+            A list with each page of entities.
+        """
+        cursor = None
+        while True:
+            query = self.backend.client.query(kind=kind)
+            query_iter = query.fetch(start_cursor=cursor, limit=self.page_size)
+            entities = list(next(query_iter.pages, []))
+            if not entities:
+                return
+            yield entities
+            cursor = query_iter.next_page_token
+            if cursor is None:
+                return
+
+    def _export_images(self, archive, executor, blob_names) -> int:
+        """Downloads a page of images in parallel into the archive."""
+
+        def download(blob_name):
+            try:
+                return blob_name, self.backend.content_bucket.blob(
+                    blob_name).download_as_bytes()
+            except NotFound:
+                logger.warning("Image %s not found, skipping it", blob_name)
+                return blob_name, None
+
+        exported = 0
+        for blob_name, image_data in executor.map(download, blob_names):
+            if image_data is not None:
+                _add_member(archive, 'images/' + blob_name,
+                            io.BytesIO(image_data))
+                exported += 1
+        return exported
+
+
+class BulkRestorer:
+    """Reloads an archive written by `BulkExporter`.
+
+    Entities are written with `put_multi` in batches, and images are
+    uploaded in parallel with a bounded number of uploads in flight.
+
+    Attributes:
+        backend:
+            The `Backend` whose Datastore and content bucket are restored.
+        batch_size:
+            An integer with the number of entities written per batch, up to
+            Datastore's limit of 500.
+        max_workers:
+            An integer with the number of concurrent image uploads.
+    """
+
+    def __init__(self, backend, batch_size: int = 500, max_workers: int = 8):
+        self.backend = backend
+        self.batch_size = min(batch_size, 500)
+        self.max_workers = max_workers
+
+    def run(self, archive_path: str) -> dict:
+        """Restores every entity and image in an archive.
+
+        Args:
+            archive_path: A string with the path of the archive to read.
+
+        Returns:
+            A dictionary with the number of entities restored per kind, and
+            the number of "images" restored.
+        """
+        stats = {'images': 0}
+        uploads = []
+        with tarfile.open(archive_path, 'r:*') as archive, ThreadPoolExecutor(
+                max_workers=self.max_workers) as executor:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                data = archive.extractfile(member)
+                if member.name.startswith('datastore/'):
+                    kind = os.path.basename(member.name)[:-len('.ndjson')]
+                    stats[kind] = self._restore_entities(kind, data)
+                elif member.name.startswith('images/'):
+                    uploads.append(
+                        executor.submit(self._upload_image,
+                                        member.name[len('images/'):],
+                                        data.read()))
+                    if len(uploads) >= 2 * self.max_workers:
+                        stats['images'] += _wait_all(uploads)
+            stats['images'] += _wait_all(uploads)
+        return stats
+
+    def _restore_entities(self, kind: str, records) -> int:
+        """Writes one kind's newline-delimited records in batches."""
+        restored = 0
+        batch = []
+        for line in records:
+            record = json.loads(line)
+            entity = datastore.Entity(key=self.backend.key(kind, record['key']),
+                                      exclude_from_indexes=record.get(
+                                          'exclude_from_indexes', ()))
+            entity.update(record['properties'])
+            batch.append(entity)
+            if len(batch) >= self.batch_size:
+                self.backend.client.put_multi(batch)
+                restored += len(batch)
+                batch = []
+        if batch:
+            self.backend.client.put_multi(batch)
+            restored += len(batch)
+        logger.info("Restored %d %s entities", restored, kind)
+        return restored
+
+    def _upload_image(self, blob_name: str, image_data: bytes) -> None:
+        blob = self.backend.content_bucket.blob(blob_name)
+        if blob_name.startswith(images.IMAGE_PREFIX):
+            blob.cache_control = images.IMMUTABLE_CACHE_CONTROL
+        blob.upload_from_string(image_data,
+                                content_type=mimetypes.guess_type(blob_name)[0])
+
+
+def _entity_record(entity) -> dict:
+    """Returns the JSON record an entity is exported as.
+
+    Unindexed properties, such as long comment threads, are listed so they
+    are restored unindexed, since they may be longer than Datastore allows
+    indexed properties to be.
+    """
+    return {
+        'key': entity.key.name,
+        'properties': dict(entity),
+        'exclude_from_indexes': sorted(entity.exclude_from_indexes),
+    }
+
+
+def _image_blob_names(entities) -> list[str]:
+    """Returns the names of the image blobs owned by a page of entities."""
+    if not entities or entities[0].kind not in ('Character', 'Image'):
+        return []
+    if entities[0].kind == 'Image':
+        return [images.blob_name(image.key.name) for image in entities]
+    return [
+        "character-images/" + character.key.name + ".png"
+        for character in entities
+        if not character.get('Image')
+    ]
+
+
+def _add_member(archive, name: str, fileobj) -> None:
+    """Adds the contents of a seekable file object to a tar archive."""
+    info = tarfile.TarInfo(name)
+    info.size = fileobj.seek(0, io.SEEK_END)
+    fileobj.seek(0)
+    archive.addfile(info, fileobj)
+
+
+def _wait_all(futures: list) -> int:
+    """Waits for every future, clears the list and returns how many finished."""
+    for future in futures:
+        future.result()
+    finished = len(futures)
+    futures.clear()
+    return finished
+
+
+def register_commands(app, backend):
+    """Registers the bulk import, export and restore commands on the app's `flask` CLI."""
+
+    @app.cli.command("import-pages")
+    @click.argument("manifest", type=click.Path(exists=True, dir_okay=False))
+    @click.argument("image_dir", type=click.Path(exists=True, file_okay=False))
+    @click.option("--uploader",
+                  required=True,
+                  help="Username credited for rows without an uploader.")
+    @click.option("--batch-size", default=200, show_default=True)
+    @click.option("--workers", default=8, show_default=True)
+    @click.option("--checkpoint",
+                  type=click.Path(dir_okay=False),
+                  help="File used to resume an interrupted import.")
+    def import_pages(manifest, image_dir, uploader, batch_size, workers,
+                     checkpoint):
+        """Imports characters from a CSV/JSON MANIFEST and IMAGE_DIR."""
+        importer = BulkImporter(backend,
+                                image_dir,
+                                uploader,
+                                batch_size=batch_size,
+                                max_workers=workers,
+                                checkpoint_path=checkpoint)
+        stats = importer.run(manifest)
+        click.echo(f"Imported {stats['imported']} characters, skipped "
+                   f"{stats['skipped']} invalid rows (resumed from row "
+                   f"{stats['resumed_from']}).")
+
+    @app.cli.command("export-wiki")
+    @click.argument("archive", type=click.Path(dir_okay=False))
+    @click.option("--page-size", default=500, show_default=True)
+    @click.option("--workers", default=8, show_default=True)
+    def export_wiki(archive, page_size, workers):
+        """Exports the wiki's entities and images to ARCHIVE."""
+        stats = BulkExporter(backend, page_size=page_size,
+                             max_workers=workers).run(archive)
+        click.echo(", ".join(
+            f"{count} {name}" for name, count in stats.items()))
+
+    @app.cli.command("restore-wiki")
+    @click.argument("archive", type=click.Path(exists=True, dir_okay=False))
+    @click.option("--batch-size", default=500, show_default=True)
+    @click.option("--workers", default=8, show_default=True)
+    def restore_wiki(archive, batch_size, workers):
+        """Restores the wiki's entities and images from ARCHIVE."""
+        stats = BulkRestorer(backend,
+                             batch_size=batch_size,
+                             max_workers=workers).run(archive)
+        click.echo(", ".join(
+            f"{count} {name}" for name, count in stats.items()))
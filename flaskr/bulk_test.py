@@ -0,0 +1,223 @@
+import pytest, json
+from google.api_core.exceptions import NotFound
+from google.cloud import datastore
+from unittest.mock import MagicMock
+from .backend import Backend
+from .bulk import BulkExporter, BulkImporter, BulkRestorer, read_manifest
+
+
+@pytest.fixture
+def image_dir(tmp_path):
+    images = tmp_path / "images"
+    images.mkdir()
+    for name in ["Mario", "Link", "Ness"]:
+        (images / (name + ".png")).write_bytes(b"\x89PNG\r\n\x1a\n")
+    return images
+
+
+@pytest.fixture
+def mock_backend():
+    backend = MagicMock()
+    backend.allowed_file = Backend.allowed_file.__get__(backend)
+    return backend
+
+
+def test_read_manifest_csv(tmp_path):
+    manifest = tmp_path / "characters.csv"
+    manifest.write_text("name,info,world\n"
+                        "Mario,Plumber,Super Mario Bros.\n"
+                        "Link,\"Hero, of Hyrule\",The Legend of Zelda\n")
+
+    rows = list(read_manifest(str(manifest)))
+    assert [row["name"] for row in rows] == ["Mario", "Link"]
+    assert rows[1]["info"] == "Hero, of Hyrule"
+
+
+def test_read_manifest_json_lines(tmp_path):
+    manifest = tmp_path / "characters.jsonl"
+    manifest.write_text(
+        '{"name": "Mario", "info": "Plumber", "world": "Super Mario Bros."}\n'
+        '\n'
+        '{"name": "Ness", "info": "PSI", "world": "EarthBound"}\n')
+
+    rows = list(read_manifest(str(manifest)))
+    assert [row["name"] for row in rows] == ["Mario", "Ness"]
+
+
+def test_import_in_batches(tmp_path, image_dir, mock_backend):
+    manifest = tmp_path / "characters.json"
+    manifest.write_text(
+        json.dumps([
+            {
+                "name": "Mario",
+                "info": "Plumber",
+                "world": "Super Mario Bros."
+            },
+            {
+                "name": "Link",
+                "info": "Hero",
+                "world": "The Legend of Zelda",
+                "uploader": "Noel"
+            },
+            {
+                "name": "Sonic",
+                "info": "Missing image",
+                "world": "Sonic the Hedgehog"
+            },
+            {
+                "name": "Ness",
+                "info": "PSI",
+                "world": "EarthBound"
+            },
+        ]))
+
+    importer = BulkImporter(mock_backend,
+                            str(image_dir),
+                            "sebagabs",
+                            batch_size=2)
+    stats = importer.run(str(manifest))
+
+    assert stats == {"imported": 3, "skipped": 1, "resumed_from": 0}
+    batches = [c.args[0] for c in mock_backend.upload_batch.call_args_list]
+    assert [[upload[2] for upload in batch] for batch in batches
+           ] == [["Mario", "Link"], ["Ness"]]
+    assert batches[0][0] == ("sebagabs", str(image_dir / "Mario.png"), "Mario",
+                             "Plumber", "Super Mario Bros.")
+    assert batches[0][1][0] == "Noel"
+
+
+def test_import_resumes_from_checkpoint(tmp_path, image_dir, mock_backend):
+    manifest = tmp_path / "characters.csv"
+    manifest.write_text("name,info,world\n"
+                        "Mario,Plumber,Super Mario Bros.\n"
+                        "Link,Hero,The Legend of Zelda\n"
+                        "Ness,PSI,EarthBound\n")
+    checkpoint = tmp_path / "import.checkpoint"
+
+    # The second batch fails, leaving the first one checkpointed.
+    mock_backend.upload_batch.side_effect = [None, RuntimeError("timeout")]
+    importer = BulkImporter(mock_backend,
+                            str(image_dir),
+                            "sebagabs",
+                            batch_size=2,
+                            checkpoint_path=str(checkpoint))
+    with pytest.raises(RuntimeError):
+        importer.run(str(manifest))
+    assert importer.load_checkpoint() == 2
+
+    mock_backend.upload_batch.reset_mock(side_effect=True)
+    stats = importer.run(str(manifest))
+    assert stats == {"imported": 1, "skipped": 0, "resumed_from": 2}
+    uploaded = mock_backend.upload_batch.call_args.args[0]
+    assert [upload[2] for upload in uploaded] == ["Ness"]
+    assert importer.load_checkpoint() == 3
+
+
+def make_entity(kind, name, properties, exclude_from_indexes=()):
+    entity = datastore.Entity(key=datastore.Key(kind, name, project="test"),
+                              exclude_from_indexes=exclude_from_indexes)
+    entity.update(properties)
+    return entity
+
+
+def test_export_and_restore(tmp_path):
+    pages_by_kind = {
+        "Character": [[
+            make_entity("Character", "Mario", {
+                "Name": "Mario",
+                "Info": "Plumber",
+                "World": "Super Mario Bros."
+            })
+        ],
+                      [
+                          make_entity(
+                              "Character", "Link", {
+                                  "Name": "Link",
+                                  "Info": "Hero",
+                                  "World": "The Legend of Zelda",
+                                  "Image": "abc.png"
+                              })
+                      ]],
+        "Image": [[
+            make_entity("Image", "abc.png", {
+                "content_type": "image/png",
+                "phash": None,
+                "bands": []
+            })
+        ]],
+        "World": [[
+            make_entity("World", "Super Mario Bros.", {
+                "world_name": "Super Mario Bros.",
+                "characters": ["Mario"]
+            })
+        ]],
+        "Upvote": [[make_entity("Upvote", "Mario", {"upvotes": ["Noel"]})]],
+        "PageComment": [[
+            make_entity("PageComment",
+                        "Mario", {"comments": ["x" * 2000]},
+                        exclude_from_indexes=("comments",))
+        ]],
+    }
+
+    def query(kind):
+        pages = pages_by_kind.get(kind, [])
+
+        def fetch(start_cursor=None, limit=None):
+            page_num = start_cursor or 0
+            query_iter = MagicMock()
+            query_iter.pages = iter(pages[page_num:page_num + 1])
+            query_iter.next_page_token = page_num + 1 if page_num + 1 < len(
+                pages) else None
+            return query_iter
+
+        return MagicMock(fetch=fetch)
+
+    def blob(name):
+        if name == "images/abc.png":
+            return MagicMock(download_as_bytes=MagicMock(
+                side_effect=NotFound("missing")))
+        return MagicMock(download_as_bytes=MagicMock(return_value=b"mario"))
+
+    source = MagicMock()
+    source.client.query.side_effect = lambda kind: query(kind)
+    source.content_bucket.blob.side_effect = blob
+
+    archive = str(tmp_path / "wiki.tar.gz")
+    stats = BulkExporter(source, page_size=1).run(archive)
+    assert stats == {
+        "images": 1,
+        "Character": 2,
+        "Image": 1,
+        "World": 1,
+        "UserUploads": 0,
+        "PageUploader": 0,
+        "Upvote": 1,
+        "PageComment": 1,
+        "PageUpvote": 0,
+        "UpvoteCount": 0,
+        "PageCommentEntry": 0,
+        "CommentCount": 0
+    }
+
+    target = MagicMock()
+    target.key.side_effect = lambda kind, name: datastore.Key(
+        kind, name, project="test")
+    stats = BulkRestorer(target, batch_size=1).run(archive)
+    assert stats["images"] == 1
+    assert stats["Character"] == 2
+
+    restored = [
+        entity for c in target.client.put_multi.call_args_list
+        for entity in c.args[0]
+    ]
+    assert [(entity.kind, entity.key.name) for entity in restored
+           ] == [("Character", "Mario"), ("Character", "Link"),
+                 ("Image", "abc.png"), ("World", "Super Mario Bros."),
+                 ("Upvote", "Mario"), ("PageComment", "Mario")]
+    assert restored[3]["characters"] == ["Mario"]
+    assert restored[5].exclude_from_indexes == {"comments"}
+    assert not restored[0].exclude_from_indexes
+    target.content_bucket.blob.assert_called_once_with(
+        "character-images/Mario.png")
+    target.content_bucket.blob.return_value.upload_from_string.assert_called_once_with(
+        b"mario", content_type="image/png")
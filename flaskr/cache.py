@@ -0,0 +1,348 @@
+from collections import Counter, OrderedDict
+from typing import NamedTuple
+import fcntl
+import hashlib
+import itertools
+import logging
+import os
+import tempfile
+import threading
+""" Provides in-process caches of rendered pages and images for the Super Smash Bros. wiki project """
+
+logger = logging.getLogger(__name__)
+
+
+class CachedPage(NamedTuple):
+    """Rendered HTML of a route and the ETag it was served with, if any."""
+    html: str
+    etag: str
+
+
+class PageCache:
+    """Stores rendered HTML of wiki routes, tagged with surrogate keys.
+
+    Each entry is stored under a cache key (usually the request path and
+    query string) and tagged with one or more surrogate keys, such as
+    "page:Mario", "world:Super Mario Bros." or "authors". Writes to the
+    wiki purge every entry tagged with the surrogate keys they affect, so
+    readers never see a page older than the last write to its data. An
+    entry can carry the ETag of its HTML, which is purged along with it.
+
+    Attributes:
+        max_entries:
+            An integer with the maximum number of rendered pages kept. The
+            least recently used page is evicted once the limit is reached.
+    """
+
+    def __init__(self, max_entries: int = 256) -> None:
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # cache key -> (page, surrogate keys)
+        self._tagged = {}  # surrogate key -> set of cache keys
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, cache_key: str) -> str:
+        """Get the rendered HTML stored under a cache key.
+
+        Args:
+            cache_key: A string identifying the route and its arguments.
+
+        Returns:
+            A string with the rendered HTML, or None if it is not cached.
+        """
+        page = self.lookup(cache_key)
+        return None if page is None else page.html
+
+    def lookup(self, cache_key: str) -> CachedPage:
+        """Get the rendered HTML and ETag stored under a cache key.
+
+        Args:
+            cache_key: A string identifying the route and its arguments.
+
+        Returns:
+            A `CachedPage`, or None if the route is not cached.
+        """
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(cache_key)
+            return entry[0]
+
+    def set(self,
+            cache_key: str,
+            html: str,
+            surrogate_keys,
+            etag: str = None) -> None:
+        """Store rendered HTML under a cache key.
+
+        Args:
+            cache_key: A string identifying the route and its arguments.
+            html: A string with the rendered HTML of the route.
+            surrogate_keys: An iterable of strings to tag the entry with.
+            etag: A string with the ETag the HTML is served with, if any.
+        """
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._remove(cache_key)
+            surrogate_keys = frozenset(surrogate_keys)
+            self._entries[cache_key] = (CachedPage(html, etag), surrogate_keys)
+            for surrogate_key in surrogate_keys:
+                self._tagged.setdefault(surrogate_key, set()).add(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def purge(self, *surrogate_keys: str) -> int:
+        """Remove every entry tagged with any of the given surrogate keys.
+
+        Args:
+            surrogate_keys: Strings with the surrogate keys to purge.
+
+        Returns:
+            An integer with the number of entries removed.
+        """
+        removed = 0
+        with self._lock:
+            for surrogate_key in surrogate_keys:
+                for cache_key in self._tagged.pop(surrogate_key, ()):
+                    removed += self._remove(cache_key)
+        return removed
+
+    def clear(self) -> None:
+        """Remove every entry from the cache."""
+        with self._lock:
+            self._entries.clear()
+            self._tagged.clear()
+
+    def _remove(self, cache_key: str) -> int:
+        """Remove one entry and untag it. The caller must hold the lock."""
+        entry = self._entries.pop(cache_key, None)
+        if entry is None:
+            return 0
+        for surrogate_key in entry[1]:
+            cache_keys = self._tagged.get(surrogate_key)
+            if cache_keys is not None:
+                cache_keys.discard(cache_key)
+                if not cache_keys:
+                    del self._tagged[surrogate_key]
+        return 1
+
+
+class ImageCache:
+    """Keeps image bytes in memory and on local disk, bounded by size.
+
+    Images are stored under their GCS blob name along with the blob's
+    generation number, which changes whenever the blob is rewritten. A
+    lookup can ask for a generation, and a cached copy of any other
+    generation is ignored; content-addressed images never change, so they
+    are looked up without one.
+
+    Recently used images are kept in memory. When a directory is given,
+    every image is also written to disk, so images evicted from memory, or
+    cached before a restart, are read back from disk instead of downloaded
+    again. Both tiers evict their least recently used images to stay within
+    their byte limits.
+
+    Worker processes sharing a directory each claim a "slot-<n>"
+    subdirectory of it, locked for as long as the cache is open, and only
+    ever index, write and evict files in their own slot. A restarted worker
+    claims a slot left by an exited one and reuses its images, so the disk
+    holds at most `max_disk_bytes` per concurrently running worker.
+
+    Attributes:
+        max_memory_bytes:
+            An integer with the number of image bytes kept in memory.
+        directory:
+            A string with the path of the directory holding the disk tier's
+            slots, or None for no disk tier.
+        max_disk_bytes:
+            An integer with the number of image bytes kept on disk.
+        stats:
+            A `Counter` of "memory_hits", "disk_hits" and "misses".
+    """
+
+    def __init__(self,
+                 max_memory_bytes: int = 32 * 2**20,
+                 directory: str = None,
+                 max_disk_bytes: int = 512 * 2**20) -> None:
+        self.max_memory_bytes = max_memory_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.stats = Counter()
+        self._memory = OrderedDict()  # blob name -> (generation, bytes)
+        self._memory_bytes = 0
+        self._disk = OrderedDict()  # file key -> (generation, size)
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self._slot = None  # Directory of the claimed slot.
+        self._slot_lock = None  # Open file holding the slot's lock.
+        if directory is not None:
+            self._claim_slot()
+            self._scan_disk()
+
+    def close(self) -> None:
+        """Releases the cache's disk slot, leaving its files for reuse."""
+        if self._slot_lock is not None:
+            self._slot_lock.close()
+            self._slot_lock = None
+
+    def get(self, name: str, generation: int = None) -> bytes:
+        """Get the cached bytes of an image.
+
+        Args:
+            name: A string with the blob name of the image.
+            generation: An integer with the blob generation the bytes must
+                belong to, or None to accept any.
+
+        Returns:
+            The bytes of the image, or None if they are not cached.
+        """
+        with self._lock:
+            entry = self._memory.get(name)
+            if entry and (generation is None or entry[0] == generation):
+                self._memory.move_to_end(name)
+                self.stats["memory_hits"] += 1
+                return entry[1]
+        found = self._read_disk(name, generation)
+        with self._lock:
+            if found is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["disk_hits"] += 1
+            self._remember(name, *found)
+            return found[1]
+
+    def put(self, name: str, generation: int, data: bytes) -> None:
+        """Store the bytes of an image.
+
+        Args:
+            name: A string with the blob name of the image.
+            generation: An integer with the generation of the blob.
+            data: The bytes of the image.
+        """
+        with self._lock:
+            self._remember(name, generation, data)
+        if self.directory is not None:
+            self._write_disk(name, generation, data)
+
+    def _remember(self, name, generation, data) -> None:
+        """Keeps an image in memory. The caller must hold the lock."""
+        old = self._memory.pop(name, None)
+        if old is not None:
+            self._memory_bytes -= len(old[1])
+        if len(data) > self.max_memory_bytes:
+            return
+        self._memory[name] = (generation, data)
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.max_memory_bytes:
+            _, (_, evicted) = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _read_disk(self, name, generation):
+        """Returns the generation and bytes of an image on disk, or None."""
+        if self.directory is None:
+            return None
+        key = _file_key(name)
+        with self._lock:
+            entry = self._disk.get(key)
+            if entry is None or (generation is not None and
+                                 entry[0] != generation):
+                return None
+            self._disk.move_to_end(key)
+        stored_generation, _ = entry
+        try:
+            with open(self._path(key, stored_generation), "rb") as file:
+                return stored_generation, file.read()
+        except OSError:
+            # The file was evicted or removed since the lookup.
+            return None
+
+    def _write_disk(self, name, generation, data) -> None:
+        key = _file_key(name)
+        try:
+            # Written under a temporary name, so readers never see a
+            # partial file.
+            with tempfile.NamedTemporaryFile(dir=self._slot,
+                                             prefix=".tmp-",
+                                             delete=False) as file:
+                file.write(data)
+            os.replace(file.name, self._path(key, generation))
+        except OSError:
+            logger.exception("Could not cache image %s on disk", name)
+            return
+        with self._lock:
+            old = self._disk.pop(key, None)
+            if old is not None:
+                self._disk_bytes -= old[1]
+                if old[0] != generation:
+                    self._unlink(key, old[0])
+            self._disk[key] = (generation, len(data))
+            self._disk_bytes += len(data)
+            self._evict_disk()
+
+    def _claim_slot(self) -> None:
+        """Locks the first slot of the directory no other cache holds."""
+        for number in itertools.count():
+            slot = os.path.join(self.directory, f"slot-{number}")
+            os.makedirs(slot, exist_ok=True)
+            lock_file = open(os.path.join(slot, ".lock"), "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()  # Held by another worker.
+                continue
+            self._slot, self._slot_lock = slot, lock_file
+            return
+
+    def _scan_disk(self) -> None:
+        """Indexes the images already in the slot, oldest access first."""
+        files = []
+        for entry in os.scandir(self._slot):
+            if entry.name.startswith(".tmp-"):
+                # Left behind by an interrupted write; no other cache
+                # writes to this slot.
+                os.unlink(entry.path)
+                continue
+            if entry.name.startswith("."):
+                continue
+            key, _, generation = entry.name.partition(".")
+            stat = entry.stat()
+            files.append((stat.st_atime, key, generation, stat.st_size))
+        for _, key, generation, size in sorted(files):
+            # A key with files for several generations keeps its most
+            # recently accessed one; the others would never be read again.
+            old = self._disk.pop(key, None)
+            if old is not None:
+                self._disk_bytes -= old[1]
+                self._unlink(key, old[0])
+            self._disk[key] = (_parse_generation(generation), size)
+            self._disk_bytes += size
+        self._evict_disk()
+
+    def _evict_disk(self) -> None:
+        """Removes the least recently used files over the disk limit."""
+        while self._disk_bytes > self.max_disk_bytes:
+            key, (generation, size) = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            self._unlink(key, generation)
+
+    def _unlink(self, key, generation) -> None:
+        try:
+            os.unlink(self._path(key, generation))
+        except FileNotFoundError:
+            pass
+
+    def _path(self, key, generation) -> str:
+        return os.path.join(self._slot, f"{key}.{generation}")
+
+
+def _file_key(name: str) -> str:
+    """Returns a file name safe key for a blob name."""
+    return hashlib.sha256(name.encode()).hexdigest()
+
+
+def _parse_generation(generation: str):
+    return int(generation) if generation.isdigit() else generation
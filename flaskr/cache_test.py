@@ -0,0 +1,157 @@
+import os
+import pytest
+from .cache import CachedPage, ImageCache, PageCache
+
+
+@pytest.fixture
+def page_cache():
+    return PageCache(max_entries=3)
+
+
+def test_get_and_set(page_cache):
+    assert page_cache.get("/pages/Mario") is None
+
+    page_cache.set("/pages/Mario", "<h1>Mario</h1>", ["page:Mario"])
+    assert page_cache.get("/pages/Mario") == "<h1>Mario</h1>"
+    assert len(page_cache) == 1
+    assert page_cache.lookup("/pages/Mario") == CachedPage(
+        "<h1>Mario</h1>", None)
+
+    page_cache.set("/pages/Mario", "<h1>Mario</h1>", ["page:Mario"], etag="v1")
+    assert page_cache.lookup("/pages/Mario").etag == "v1"
+
+
+def test_purge_by_surrogate_key(page_cache):
+    page_cache.set("/pages/Mario", "<h1>Mario</h1>", ["page:Mario"])
+    page_cache.set("/pages?world=Mushroom Kingdom", "<ul></ul>",
+                   ["worlds", "world:Mushroom Kingdom"])
+    page_cache.set("/about", "<h3>About</h3>", ["authors"])
+
+    assert page_cache.purge("page:Mario", "worlds") == 2
+    assert page_cache.get("/pages/Mario") is None
+    assert page_cache.get("/pages?world=Mushroom Kingdom") is None
+    assert page_cache.get("/about") == "<h3>About</h3>"
+
+    # Purging a key with no entries is a no-op.
+    assert page_cache.purge("world:Mushroom Kingdom") == 0
+
+
+def test_evicts_least_recently_used(page_cache):
+    page_cache.set("/pages/Mario", "Mario", ["page:Mario"])
+    page_cache.set("/pages/Link", "Link", ["page:Link"])
+    page_cache.set("/pages/Ness", "Ness", ["page:Ness"])
+    page_cache.get("/pages/Mario")
+    page_cache.set("/pages/Lucas", "Lucas", ["page:Lucas"])
+
+    assert len(page_cache) == 3
+    assert page_cache.get("/pages/Link") is None
+    assert page_cache.get("/pages/Mario") == "Mario"
+    assert page_cache.purge("page:Link") == 0
+
+
+def test_disabled_cache():
+    page_cache = PageCache(max_entries=0)
+    page_cache.set("/about", "<h3>About</h3>", ["authors"])
+    assert page_cache.get("/about") is None
+
+
+def test_image_cache_evicts_least_recently_used_bytes():
+    image_cache = ImageCache(max_memory_bytes=10)
+    image_cache.put("images/a.png", 1, b"aaaa")
+    image_cache.put("images/b.png", 1, b"bbbb")
+    assert image_cache.get("images/a.png") == b"aaaa"
+
+    image_cache.put("images/c.png", 1, b"cccc")
+    assert image_cache.get("images/b.png") is None
+    assert image_cache.get("images/a.png") == b"aaaa"
+    assert image_cache.get("images/c.png") == b"cccc"
+
+    # Images larger than the whole cache are not kept.
+    image_cache.put("images/d.png", 1, b"d" * 11)
+    assert image_cache.get("images/d.png") is None
+
+
+def test_image_cache_checks_generation():
+    image_cache = ImageCache()
+    image_cache.put("character-images/Mario.png", 1, b"old")
+    assert image_cache.get("character-images/Mario.png", 1) == b"old"
+    assert image_cache.get("character-images/Mario.png", 2) is None
+    assert image_cache.get("character-images/Mario.png") == b"old"
+    assert image_cache.stats == {"memory_hits": 2, "misses": 1}
+
+
+def image_files(directory):
+    return sorted(path.name
+                  for path in directory.glob("slot-*/*")
+                  if not path.name.startswith("."))
+
+
+def test_image_cache_disk_tier(tmp_path):
+    image_cache = ImageCache(max_memory_bytes=4,
+                             directory=str(tmp_path),
+                             max_disk_bytes=10)
+    image_cache.put("images/a.png", 1, b"aaaa")
+    image_cache.put("images/b.png", 1, b"bbbb")
+
+    # Evicted from memory, read back from disk.
+    assert image_cache.get("images/a.png") == b"aaaa"
+    assert image_cache.stats["disk_hits"] == 1
+
+    # A new generation replaces the old file.
+    image_cache.put("images/a.png", 2, b"AAAA")
+    assert len(image_files(tmp_path)) == 2
+
+    # The disk tier is bounded, evicting the least recently used file.
+    image_cache.put("images/c.png", 1, b"cccc")
+    assert len(image_files(tmp_path)) == 2
+
+    # Files on disk survive a restart.
+    image_cache.close()
+    restarted = ImageCache(max_memory_bytes=4,
+                           directory=str(tmp_path),
+                           max_disk_bytes=10)
+    assert restarted.get("images/a.png", 2) == b"AAAA"
+    assert restarted.get("images/a.png", 1) is None
+    assert restarted.get("images/b.png") is None
+    assert restarted.get("images/c.png") == b"cccc"
+
+
+def test_image_caches_sharing_a_directory_use_their_own_slots(tmp_path):
+    first = ImageCache(max_memory_bytes=0,
+                       directory=str(tmp_path),
+                       max_disk_bytes=4)
+    first.put("images/a.png", 1, b"aaaa")
+    (tmp_path / "slot-0" / ".tmp-writing").write_bytes(b"aa")
+
+    # A second worker neither removes the first one's files in progress
+    # nor evicts the images it indexed.
+    second = ImageCache(directory=str(tmp_path), max_disk_bytes=4)
+    second.put("images/b.png", 1, b"bbbb")
+    assert (tmp_path / "slot-0" / ".tmp-writing").exists()
+    assert len(image_files(tmp_path)) == 2
+    assert first.get("images/a.png") == b"aaaa"
+    assert first.stats["disk_hits"] == 1
+
+    # An exited worker's slot is reused, along with its images.
+    first.close()
+    restarted = ImageCache(directory=str(tmp_path), max_disk_bytes=4)
+    assert restarted.get("images/a.png") == b"aaaa"
+    assert not (tmp_path / "slot-0" / ".tmp-writing").exists()
+
+
+def test_image_cache_removes_stale_generations_on_restart(tmp_path):
+    image_cache = ImageCache(directory=str(tmp_path), max_disk_bytes=8)
+    image_cache.put("images/a.png", 1, b"aaaa")
+    image_cache.close()
+    # A worker that exited while replacing the image left both generations.
+    old = next(tmp_path.glob("slot-0/*.1"))
+    new = old.with_suffix(".2")
+    new.write_bytes(b"AAAA")
+    os.utime(old, (1, 1))
+
+    restarted = ImageCache(directory=str(tmp_path), max_disk_bytes=8)
+    assert image_files(tmp_path) == [new.name]
+    assert restarted.get("images/a.png", 2) == b"AAAA"
+    # The removed file no longer counts against the disk budget.
+    restarted.put("images/b.png", 1, b"bbbb")
+    assert len(image_files(tmp_path)) == 2
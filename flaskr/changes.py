@@ -0,0 +1,290 @@
+from google.cloud import datastore
+import datetime
+import itertools
+import logging
+import secrets
+import threading
+import time
+""" Provides a change-feed of wiki mutations for the Super Smash Bros. wiki project """
+
+logger = logging.getLogger(__name__)
+
+# Seconds a change can take from being appended to being committed, plus
+# the clock skew between instances. Readers re-read this far back, so
+# changes that commit late are not missed.
+COMMIT_LAG_SECONDS = 10
+
+# Datastore accepts at most 500 mutations per commit.
+MAX_MUTATIONS = 500
+
+# Number of changes read at a time when following the log.
+READ_BATCH = 500
+
+
+def seq_at(seconds: float) -> str:
+    """Returns the sequence position of a time, before any change made at it.
+
+    Sequence numbers are strings starting with the microseconds since the
+    epoch when the change was appended, padded so they sort by time.
+    """
+    return f"{int(seconds * 1e6):016d}"
+
+
+def rewind(seq: str, seconds: float = COMMIT_LAG_SECONDS) -> str:
+    """Returns the sequence position some seconds before a sequence number."""
+    if not seq:
+        return seq
+    return seq_at(max(0, int(seq[:16]) / 1e6 - seconds))
+
+
+class ChangeLog:
+    """
+    Ordered log of wiki mutations, stored in the WikiChange kind of the
+    Datastore so every App Engine instance can learn about writes made by
+    the others.
+
+    Each change gets a sequence number made of the time it was appended,
+    an ID of the writing log and a counter, so sequence numbers are unique
+    and sort by time without any shared counter: logging a change is a
+    blind write of a new entity, which never conflicts with another
+    writer's transaction. Changes can commit out of sequence order, up to
+    COMMIT_LAG_SECONDS apart, so readers following the log re-read that
+    far back and must skip, or be unaffected by, changes seen twice.
+
+    ---
+    Attributes:
+        client:
+            An instance of `datastore.Client` that represents the connection to
+            the Google Cloud Datastore service for the project 'sds-project-nbs-wiki'.
+    """
+
+    def __init__(self, client, key_method=None):
+        if key_method is None:
+            key_method = client.key
+        self.client = client
+        self.key = key_method
+        self._writer = secrets.token_hex(4)
+        self._counter = itertools.count()
+
+    def append(self, action: str, pagename: str, trans=None, **details) -> str:
+        """
+        Appends one change to the log.
+
+        ---
+        Args:
+            action:
+                String naming the mutation, such as "upload", "upvote" or
+                "comment".
+            pagename:
+                String containing the name of the changed page.
+            trans:
+                The transaction the mutation is written in, if any, so the
+                change commits atomically with it.
+            details:
+                Extra properties of the change, such as "world" or "user".
+
+        Returns:
+            String with the sequence number of the change.
+        """
+        return self.append_many([dict(details, action=action, page=pagename)],
+                                trans)[-1]
+
+    def append_many(self, changes: list[dict], trans=None) -> list[str]:
+        """
+        Appends several changes to the log.
+
+        ---
+        Args:
+            changes:
+                List of dictionaries with the "action" and "page" of each
+                change, plus any extra properties.
+            trans:
+                The transaction the mutations are written in, if any. Without
+                one, the changes are written in batches of MAX_MUTATIONS.
+
+        Returns:
+            List of strings with the sequence numbers of the changes.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        micros = time.time_ns() // 1000
+        entities = []
+        for change in changes:
+            seq = (f"{micros:016d}-{self._writer}-"
+                   f"{next(self._counter) % 2**32:08x}")
+            entity = datastore.Entity(key=self.key("WikiChange", seq))
+            entity.update(dict(change, seq=seq, time=now))
+            entities.append(entity)
+        if trans is not None:
+            for entity in entities:
+                trans.put(entity)
+        else:
+            for start in range(0, len(entities), MAX_MUTATIONS):
+                self.client.put_multi(entities[start:start + MAX_MUTATIONS])
+        return [entity["seq"] for entity in entities]
+
+    def latest_seq(self) -> str:
+        """
+        Get the sequence position of the present.
+
+        Changes appended from now on sort after it, though changes appended
+        up to COMMIT_LAG_SECONDS earlier may still commit.
+
+        ---
+        Returns:
+            String with the sequence position.
+        """
+        return seq_at(time.time())
+
+    def read_since(self, seq: str, limit: int = 500) -> list[dict]:
+        """
+        Get the changes made after a sequence number, oldest first.
+
+        ---
+        Args:
+            seq:
+                String with the last sequence number already seen.
+            limit:
+                Integer with the maximum number of changes returned.
+
+        Returns:
+            List of dictionaries with the properties of each change.
+        """
+        query = self.client.query(kind="WikiChange")
+        query.add_filter("seq", ">", seq)
+        query.order = ["seq"]
+        return [dict(change) for change in query.fetch(limit=limit)]
+
+    def read_recent(self,
+                    since: datetime.datetime,
+                    limit: int = 10000) -> list[dict]:
+        """
+        Get the changes made after a point in time, oldest first.
+
+        When more than `limit` changes were made, the newest ones are
+        returned.
+
+        ---
+        Args:
+            since:
+                Timezone-aware datetime of the oldest change to return.
+            limit:
+                Integer with the maximum number of changes returned.
+
+        Returns:
+            List of dictionaries with the properties of each change.
+        """
+        query = self.client.query(kind="WikiChange")
+        query.add_filter("time", ">=", since)
+        query.order = ["-time"]
+        changes = [dict(change) for change in query.fetch(limit=limit)]
+        return sorted(changes, key=lambda change: change["seq"])
+
+
+class ChangeFeed:
+    """Follows a `ChangeLog` and hands new changes to local subscribers.
+
+    Polling is driven by the app (for example once per request) and hits
+    the Datastore at most once per interval, from one thread at a time.
+    A feed starts at the latest change, since local caches start empty,
+    after replaying the changes of the last `replay_seconds` so that
+    subscribers aggregating recent activity can warm up; unless forced, that
+    first poll runs in a background thread, so no request waits for it and
+    other polls are skipped until it is done. Each poll re-reads
+    the last COMMIT_LAG_SECONDS of the log, to find changes that committed
+    after later ones, and skips the changes it already handed out.
+
+    Attributes:
+        change_log:
+            The `ChangeLog` to follow.
+        interval:
+            A float with the minimum number of seconds between polls.
+        replay_seconds:
+            A float with how far back the first poll replays changes.
+    """
+
+    def __init__(self,
+                 change_log,
+                 interval: float = 5.0,
+                 replay_seconds: float = 0) -> None:
+        self.change_log = change_log
+        self.interval = interval
+        self.replay_seconds = replay_seconds
+        self._subscribers = []
+        self._last_seq = None
+        self._seen = set()  # Sequence numbers handed out since the lag.
+        self._next_poll = 0.0
+        self._lock = threading.Lock()
+
+    def subscribe(self, subscriber) -> None:
+        """Registers a function called with each new change, in order."""
+        self._subscribers.append(subscriber)
+
+    def poll(self, force: bool = False) -> int:
+        """Reads new changes and hands them to the subscribers.
+
+        Args:
+            force: A boolean to poll even if the interval has not passed.
+
+        Returns:
+            An integer with the number of changes handled.
+        """
+        now = time.monotonic()
+        if not force and now < self._next_poll:
+            return 0
+        if not self._lock.acquire(blocking=False):
+            return 0  # Another thread is already polling.
+        self._next_poll = now + self.interval
+        if self._last_seq is None and self.replay_seconds and not force:
+            threading.Thread(target=self._poll_locked,
+                             name="change-feed-replay",
+                             daemon=True).start()
+            return 0
+        return self._poll_locked()
+
+    def _poll_locked(self) -> int:
+        """Polls the change log, then releases the lock the caller acquired."""
+        try:
+            if self._last_seq is None:
+                self._last_seq = self.change_log.latest_seq()
+                changes = self._replay()
+            else:
+                changes = self._read_new()
+            for change in changes:
+                for subscriber in self._subscribers:
+                    try:
+                        subscriber(change)
+                    except Exception:
+                        logger.exception("Change feed subscriber failed on %r",
+                                         change)
+                self._seen.add(change["seq"])
+                self._last_seq = max(self._last_seq, change["seq"])
+            # Changes before the re-read window are never read again.
+            floor = rewind(self._last_seq)
+            self._seen = {seq for seq in self._seen if seq > floor}
+            return len(changes)
+        finally:
+            self._lock.release()
+
+    def _read_new(self) -> list[dict]:
+        """Returns the changes not yet handed out, in sequence order."""
+        changes = []
+        seq = rewind(self._last_seq)
+        while True:
+            batch = self.change_log.read_since(seq, READ_BATCH)
+            changes.extend(
+                change for change in batch if change["seq"] not in self._seen)
+            if len(batch) < READ_BATCH:
+                return changes
+            seq = batch[-1]["seq"]
+
+    def _replay(self) -> list[dict]:
+        """Returns the recent changes up to the feed's starting point."""
+        if not self.replay_seconds:
+            return []
+        since = datetime.datetime.now(
+            datetime.timezone.utc) - datetime.timedelta(
+                seconds=self.replay_seconds)
+        return [
+            change for change in self.change_log.read_recent(since)
+            if change["seq"] <= self._last_seq
+        ]
@@ -0,0 +1,203 @@
+import datetime, pytest, threading
+from unittest.mock import MagicMock
+from .changes import MAX_MUTATIONS, READ_BATCH, ChangeFeed, ChangeLog, rewind, seq_at
+
+
+@pytest.fixture
+def change_log():
+
+    def key_mock(*args, **kwargs):
+        key = MagicMock()
+        key.kind = args[0]
+        key.name = args[1]
+        return key
+
+    return ChangeLog(MagicMock(), key_mock)
+
+
+def seq(seconds, writer="w"):
+    """Returns the sequence number of a change appended at a time."""
+    return f"{seq_at(seconds)}-{writer}-00000000"
+
+
+def test_append(change_log):
+    trans = MagicMock()
+
+    appended = change_log.append("upvote", "Ness", trans, user="sebagabs")
+
+    # The change is a blind write: no counter is read or written.
+    [change] = [c.args[0] for c in trans.put.call_args_list]
+    change_log.client.get.assert_not_called()
+    assert change.key.kind == "WikiChange"
+    assert change.key.name == appended
+    assert change["seq"] == appended
+    assert change["action"] == "upvote"
+    assert change["page"] == "Ness"
+    assert change["user"] == "sebagabs"
+
+
+def test_sequence_numbers_are_unique_and_ordered(change_log):
+    trans = MagicMock()
+    before = change_log.latest_seq()
+    first = change_log.append("upvote", "Ness", trans)
+    second = change_log.append("upvote", "Ness", trans)
+    other = ChangeLog(MagicMock(),
+                      change_log.key).append("upvote", "Ness", trans)
+    assert before < first < second
+    assert len({first, second, other}) == 3
+    assert rewind(first) < before
+
+
+def test_append_many_without_transaction_is_batched(change_log):
+    seqs = change_log.append_many([{
+        "action": "upload",
+        "page": f"Mii {i}",
+        "world": "Wii"
+    } for i in range(MAX_MUTATIONS + 1)])
+    assert len(seqs) == MAX_MUTATIONS + 1
+    change_log.client.transaction.assert_not_called()
+    assert [len(c.args[0]) for c in change_log.client.put_multi.call_args_list
+           ] == [MAX_MUTATIONS, 1]
+    assert change_log.client.put_multi.call_args.args[0][0]["seq"] == seqs[-1]
+
+
+def test_read_since(change_log):
+    query = change_log.client.query.return_value
+    query.fetch.return_value = [{
+        "seq": seq(3),
+        "action": "comment",
+        "page": "Ness"
+    }]
+    assert change_log.read_since(seq(2)) == [{
+        "seq": seq(3),
+        "action": "comment",
+        "page": "Ness"
+    }]
+    query.add_filter.assert_called_once_with("seq", ">", seq(2))
+    assert query.order == ["seq"]
+
+
+def test_change_feed_polls_new_changes():
+    change_log = MagicMock()
+    change_log.latest_seq.return_value = seq_at(100)
+    feed = ChangeFeed(change_log, interval=60)
+    seen = []
+    feed.subscribe(seen.append)
+
+    # The first poll only finds where the log ends.
+    assert feed.poll() == 0
+    change_log.read_since.assert_not_called()
+
+    change_log.read_since.return_value = [{
+        "seq": seq(101),
+        "action": "upvote",
+        "page": "Ness"
+    }, {
+        "seq": seq(102),
+        "action": "comment",
+        "page": "Ness"
+    }]
+    # Polls within the interval are skipped.
+    assert feed.poll() == 0
+    assert feed.poll(force=True) == 2
+    # The last COMMIT_LAG_SECONDS are read again, for late commits.
+    change_log.read_since.assert_called_once_with(seq_at(90), READ_BATCH)
+    assert [change["seq"] for change in seen] == [seq(101), seq(102)]
+
+    # Changes already handed out are skipped; late ones are not.
+    change_log.read_since.return_value = [{
+        "seq": seq(101, writer="late"),
+        "action": "upvote",
+        "page": "Mario"
+    }, {
+        "seq": seq(101),
+        "action": "upvote",
+        "page": "Ness"
+    }]
+    assert feed.poll(force=True) == 1
+    change_log.read_since.assert_called_with(seq_at(92), READ_BATCH)
+    assert seen[-1]["page"] == "Mario"
+
+
+def test_change_feed_reads_past_full_batches():
+    change_log = MagicMock()
+    change_log.latest_seq.return_value = seq_at(100)
+    feed = ChangeFeed(change_log)
+    feed.poll()
+    batches = [[{
+        "seq": seq(101 + i / 1000)
+    } for i in range(READ_BATCH)], [{
+        "seq": seq(102)
+    }]]
+    change_log.read_since.side_effect = lambda seq, limit: batches.pop(0)
+    assert feed.poll(force=True) == READ_BATCH + 1
+    change_log.read_since.assert_called_with(seq(101 + (READ_BATCH - 1) / 1000),
+                                             READ_BATCH)
+
+
+def test_change_feed_survives_failing_subscriber():
+    change_log = MagicMock()
+    change_log.latest_seq.return_value = seq_at(100)
+    change_log.read_since.return_value = [{"seq": seq(101), "page": "Ness"}]
+    feed = ChangeFeed(change_log)
+    seen = []
+    feed.subscribe(MagicMock(side_effect=RuntimeError("boom")))
+    feed.subscribe(seen.append)
+
+    feed.poll(force=True)
+    assert feed.poll(force=True) == 1
+    assert seen == [{"seq": seq(101), "page": "Ness"}]
+
+
+def test_change_feed_replays_recent_changes():
+    change_log = MagicMock()
+    change_log.latest_seq.return_value = seq_at(103)
+    change_log.read_recent.return_value = [{
+        "seq": seq(101),
+        "page": "Mario"
+    }, {
+        "seq": seq(102),
+        "page": "Ness"
+    }, {
+        "seq": seq(104),
+        "page": "Link"
+    }]
+    feed = ChangeFeed(change_log, replay_seconds=3600)
+    seen = []
+    feed.subscribe(seen.append)
+
+    # Changes after the starting point are left for the next poll.
+    assert feed.poll(force=True) == 2
+    assert [change["page"] for change in seen] == ["Mario", "Ness"]
+
+    # Replayed changes are not handed out again.
+    change_log.read_since.return_value = change_log.read_recent.return_value
+    assert feed.poll(force=True) == 1
+    assert seen[-1]["page"] == "Link"
+
+
+def test_change_feed_replays_in_background():
+    change_log = MagicMock()
+    change_log.latest_seq.return_value = seq_at(103)
+    change_log.read_recent.return_value = [{"seq": seq(101), "page": "Mario"}]
+    feed = ChangeFeed(change_log, replay_seconds=3600)
+    replayed = threading.Event()
+    feed.subscribe(lambda change: replayed.set())
+
+    # The request polling first does not wait for the replay.
+    assert feed.poll() == 0
+    assert replayed.wait(5)
+
+
+def test_read_recent_keeps_newest_changes(change_log):
+    query = change_log.client.query.return_value
+    query.fetch.return_value = [{"seq": seq(102)}, {"seq": seq(101)}]
+    since = datetime.datetime.now(datetime.timezone.utc)
+    assert change_log.read_recent(since, limit=2) == [{
+        "seq": seq(101)
+    }, {
+        "seq": seq(102)
+    }]
+    query.add_filter.assert_called_once_with("time", ">=", since)
+    assert query.order == ["-time"]
+    query.fetch.assert_called_once_with(limit=2)
@@ -0,0 +1,141 @@
+from flask import request, send_file
+import click
+import gzip
+import os
+
+try:
+    import brotli
+except ImportError:  # Brotli is optional; responses fall back to gzip.
+    brotli = None
+""" Provides compressed responses for the Super Smash Bros. wiki project """
+
+COMPRESSIBLE_MIMETYPES = {
+    'text/html', 'text/css', 'text/plain', 'text/javascript',
+    'application/javascript', 'application/json', 'image/svg+xml'
+}
+
+# Precompressed file extension per content coding.
+PRECOMPRESSED_EXTENSIONS = {'br': '.br', 'gzip': '.gz'}
+
+
+def init_app(app):
+    """Compresses the app's responses for clients that accept it.
+
+    Responses are compressed with brotli when it is installed and accepted,
+    or else gzip, at level COMPRESS_LEVEL, once they are at least
+    COMPRESS_MIN_SIZE bytes long. Static files are served from a
+    precompressed ".br" or ".gz" sibling when one exists (see the
+    `compress-static` command) instead of being compressed per request.
+
+    Args:
+        app: The Flask app to compress the responses of.
+    """
+    app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+    app.config.setdefault('COMPRESS_LEVEL', 6)
+
+    @app.after_request
+    def compress_response(response):
+        if request.endpoint == 'static':
+            return _precompressed_static(app, response)
+        encoding = _negotiate(available=('br', 'gzip'))
+        if (encoding is None or response.status_code != 200 or
+                response.direct_passthrough or
+                'Content-Encoding' in response.headers or
+                response.mimetype not in COMPRESSIBLE_MIMETYPES):
+            return response
+        data = response.get_data()
+        if len(data) < app.config['COMPRESS_MIN_SIZE']:
+            return response
+        level = app.config['COMPRESS_LEVEL']
+        if encoding == 'br':
+            # Brotli qualities run 0-11 rather than gzip's 1-9.
+            data = brotli.compress(data, quality=min(11, round(level * 11 / 9)))
+        else:
+            data = gzip.compress(data, compresslevel=level)
+        response.set_data(data)
+        _mark_encoded(response, encoding)
+        return response
+
+    @app.cli.command("compress-static")
+    @click.argument("directory",
+                    required=False,
+                    type=click.Path(exists=True, file_okay=False))
+    def compress_static(directory):
+        """Writes .gz (and .br) copies of static assets in DIRECTORY."""
+        directory = directory or app.static_folder
+        if not directory or not os.path.isdir(directory):
+            click.echo("No static folder to compress.")
+            return
+        written = precompress_directory(directory)
+        click.echo(f"Wrote {written} precompressed files.")
+
+
+def precompress_directory(directory: str) -> int:
+    """Writes maximally compressed copies of the compressible files in a directory.
+
+    Args:
+        directory: A string with the path of the directory to walk.
+
+    Returns:
+        An integer with the number of precompressed files written.
+    """
+    written = 0
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            if filename.endswith(tuple(PRECOMPRESSED_EXTENSIONS.values())):
+                continue
+            if not filename.endswith(
+                ('.html', '.css', '.js', '.json', '.svg', '.txt')):
+                continue
+            path = os.path.join(root, filename)
+            with open(path, 'rb') as asset:
+                data = asset.read()
+            with open(path + '.gz', 'wb') as compressed:
+                compressed.write(gzip.compress(data, compresslevel=9))
+            written += 1
+            if brotli is not None:
+                with open(path + '.br', 'wb') as compressed:
+                    compressed.write(brotli.compress(data, quality=11))
+                written += 1
+    return written
+
+
+def _negotiate(available) -> str:
+    """Returns the preferred content coding the client accepts, or None."""
+    for encoding in available:
+        if encoding == 'br' and brotli is None:
+            continue
+        if request.accept_encodings[encoding]:
+            return encoding
+    return None
+
+
+def _precompressed_static(app, response):
+    """Swaps a static file response for its precompressed sibling, if any."""
+    if response.status_code != 200 or not request.view_args:
+        return response
+    path = os.path.join(app.static_folder, request.view_args['filename'])
+    available = [
+        encoding for encoding, extension in PRECOMPRESSED_EXTENSIONS.items()
+        if os.path.isfile(path + extension)
+    ]
+    encoding = _negotiate(available)
+    if encoding is None:
+        return response
+    response.close()
+    compressed = send_file(path + PRECOMPRESSED_EXTENSIONS[encoding],
+                           mimetype=response.mimetype,
+                           max_age=response.cache_control.max_age)
+    _mark_encoded(compressed, encoding)
+    return compressed
+
+
+def _mark_encoded(response, encoding: str) -> None:
+    """Sets the headers of a response whose body was compressed."""
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        # The compressed bytes differ from the identity ones, so the entity
+        # tag is only weakly valid for them.
+        response.set_etag(etag, weak=True)
@@ -0,0 +1,84 @@
+import pytest, gzip
+from flask import Flask
+from . import compression
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = Flask(__name__,
+                static_folder=str(tmp_path),
+                static_url_path="/static")
+    app.config.from_mapping(TESTING=True, COMPRESS_MIN_SIZE=100)
+    compression.init_app(app)
+
+    @app.route("/page")
+    def page():
+        return "<p>Mario</p>" * 100
+
+    @app.route("/short")
+    def short():
+        return "<p>Mario</p>"
+
+    @app.route("/tagged")
+    def tagged():
+        response = app.make_response("<p>Mario</p>" * 100)
+        response.set_etag("v1")
+        return response
+
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def test_gzip(client):
+    resp = client.get("/page", headers={"Accept-Encoding": "gzip"})
+    assert resp.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in resp.headers["Vary"]
+    assert gzip.decompress(resp.data) == b"<p>Mario</p>" * 100
+
+
+def test_brotli_preferred(client):
+    if compression.brotli is None:
+        pytest.skip("Brotli is not installed")
+    resp = client.get("/page", headers={"Accept-Encoding": "gzip, br"})
+    assert resp.headers["Content-Encoding"] == "br"
+    assert compression.brotli.decompress(resp.data) == b"<p>Mario</p>" * 100
+
+
+def test_not_compressed(client):
+    resp = client.get("/page")
+    assert "Content-Encoding" not in resp.headers
+    assert resp.data == b"<p>Mario</p>" * 100
+
+    # Responses under the size threshold are sent as is.
+    resp = client.get("/short", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in resp.headers
+
+
+def test_compressed_etag_is_weak(client):
+    resp = client.get("/tagged", headers={"Accept-Encoding": "gzip"})
+    assert resp.headers["ETag"] == 'W/"v1"'
+
+    resp = client.get("/tagged")
+    assert resp.headers["ETag"] == '"v1"'
+
+
+def test_precompressed_static(app, client, tmp_path):
+    (tmp_path / "style.css").write_text("body { color: red; }" * 50)
+    (tmp_path / "logo.png").write_bytes(b"png")
+    assert compression.precompress_directory(
+        str(tmp_path)) == (1 if compression.brotli is None else 2)
+    assert not (tmp_path / "logo.png.gz").exists()
+
+    resp = client.get("/static/style.css", headers={"Accept-Encoding": "gzip"})
+    assert resp.headers["Content-Encoding"] == "gzip"
+    assert resp.mimetype == "text/css"
+    assert gzip.decompress(resp.data) == b"body { color: red; }" * 50
+    resp.close()
+
+    resp = client.get("/static/style.css")
+    assert "Content-Encoding" not in resp.headers
+    resp.close()
@@ -0,0 +1,148 @@
+import hashlib
+import io
+import re
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; near-duplicates go undetected.
+    Image = None
+""" Provides content-addressed image naming and perceptual hashing for the Super Smash Bros. wiki project """
+
+# Content-addressed images are stored as "images/<sha256><extension>".
+IMAGE_PREFIX = 'images/'
+
+# Image formats that can be uploaded, recognized by their leading bytes
+# rather than by the type the client claims, with the MIME type and file
+# extension they are stored and served with.
+IMAGE_FORMATS = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png', '.png'),
+    (b'\xff\xd8\xff', 'image/jpeg', '.jpg'),
+    (b'GIF87a', 'image/gif', '.gif'),
+    (b'GIF89a', 'image/gif', '.gif'),
+)
+CONTENT_TYPES = {
+    extension: content_type for _, content_type, extension in IMAGE_FORMATS
+}
+
+# Content-addressed image names: a SHA-256 hex digest and the extension of
+# an uploadable format. Images stored before formats were checked may have
+# no extension; they are served as plain bytes.
+IMAGE_NAME = re.compile(r'[0-9a-f]{64}(\.png|\.jpg|\.gif)?')
+
+# An image's bytes never change under its name, so it can be cached forever.
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Images whose perceptual hashes differ in at most this many of their 64
+# bits are flagged as near-duplicates.
+NEAR_DUPLICATE_DISTANCE = 7
+
+# Images with more pixels than this are not hashed, since decoding them
+# takes too much memory and time; Pillow refuses larger ones as
+# decompression bombs anyway.
+MAX_HASHED_PIXELS = 40 * 10**6
+
+# The 64-bit hash is split into bands of this many bits. Two hashes within
+# NEAR_DUPLICATE_DISTANCE bits of each other have at least one identical
+# band, so candidates can be found with an equality lookup on the bands.
+BAND_BITS = 8
+
+
+def image_format(data: bytes) -> tuple[str, str]:
+    """Recognizes a PNG, JPEG or GIF image by its leading bytes.
+
+    Args:
+        data: The bytes of the image.
+
+    Returns:
+        A tuple with the MIME type and file extension of the image, or None
+        if it is not in one of the uploadable formats.
+    """
+    for magic, content_type, extension in IMAGE_FORMATS:
+        if data.startswith(magic):
+            return content_type, extension
+    return None
+
+
+def image_name(data: bytes) -> str:
+    """Returns the content-addressed name of an image.
+
+    Args:
+        data: The bytes of the image.
+
+    Returns:
+        A string with the SHA-256 hex digest of the image, followed by the
+        file extension of its format.
+
+    Raises:
+        ValueError: If the image is not a PNG, JPEG or GIF.
+    """
+    recognized = image_format(data)
+    if recognized is None:
+        raise ValueError('Not a PNG, JPEG or GIF image')
+    return hashlib.sha256(data).hexdigest() + recognized[1]
+
+
+def content_type(name: str) -> str:
+    """Returns the MIME type a content-addressed image is served with."""
+    for extension, mime_type in CONTENT_TYPES.items():
+        if name.endswith(extension):
+            return mime_type
+    return 'application/octet-stream'
+
+
+def blob_name(name: str) -> str:
+    """Returns the GCS blob name of a content-addressed image."""
+    return IMAGE_PREFIX + name
+
+
+def perceptual_hash(data: bytes) -> int:
+    """Computes the difference hash (dHash) of an image.
+
+    The image is shrunk to 9x8 grayscale pixels, and each bit of the hash
+    tells whether a pixel is brighter than its right neighbour, so resizing,
+    recompressing or recoloring an image barely changes its hash.
+
+    Args:
+        data: The bytes of the image.
+
+    Returns:
+        An integer with the 64-bit hash, or None if Pillow is not installed,
+        the data is not an image it can decode, or the image has more than
+        MAX_HASHED_PIXELS pixels.
+    """
+    if Image is None:
+        return None
+    try:
+        # Opening an image only reads its header; its size is checked
+        # before any pixels are decoded.
+        with Image.open(io.BytesIO(data)) as image:
+            width, height = image.size
+            if width * height > MAX_HASHED_PIXELS:
+                return None
+            # JPEGs are decoded at a fraction of their size when possible.
+            image.draft('L', (64, 64))
+            pixels = list(
+                image.convert('L').resize((9, 8),
+                                          Image.Resampling.BILINEAR).getdata())
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            pixel = row * 9 + col
+            bits = bits << 1 | (pixels[pixel] > pixels[pixel + 1])
+    return bits
+
+
+def hash_bands(phash: int) -> list[str]:
+    """Splits a perceptual hash into labelled bands for indexing."""
+    mask = (1 << BAND_BITS) - 1
+    return [
+        f'{band}:{phash >> (band * BAND_BITS) & mask:x}'
+        for band in range(64 // BAND_BITS)
+    ]
+
+
+def hamming_distance(first: int, second: int) -> int:
+    """Returns the number of bits that differ between two hashes."""
+    return bin(first ^ second).count('1')
@@ -0,0 +1,71 @@
+import pytest, hashlib, io, struct, zlib
+from .images import content_type, hamming_distance, hash_bands, image_name, perceptual_hash, MAX_HASHED_PIXELS, NEAR_DUPLICATE_DISTANCE
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def make_image(size, image_format="PNG", mirrored=False):
+    # A wavy gradient, so neighbouring pixels differ.
+    width, height = size
+    image = Image.new("L", size)
+    image.putdata([
+        int(
+            abs((
+                (width - x if mirrored else x) * 8 // width + y * 4 // height) %
+                4 - 2) * 127) for y in range(height) for x in range(width)
+    ])
+    data = io.BytesIO()
+    image.save(data, image_format)
+    return data.getvalue()
+
+
+def test_image_name():
+    png = b"\x89PNG\r\n\x1a\nsprite"
+    gif = b"GIF89asprite"
+    assert image_name(png) == hashlib.sha256(png).hexdigest() + ".png"
+    assert image_name(gif) == hashlib.sha256(gif).hexdigest() + ".gif"
+    # The format comes from the bytes, never from the client.
+    with pytest.raises(ValueError):
+        image_name(b"<script>alert(1)</script>")
+
+
+def test_content_type():
+    assert content_type("abc.jpg") == "image/jpeg"
+    assert content_type("abc.html") == "application/octet-stream"
+    assert content_type("abc") == "application/octet-stream"
+
+
+def test_perceptual_hash_matches_resized_images():
+    original = perceptual_hash(make_image((64, 64)))
+    resized = perceptual_hash(make_image((96, 96), "JPEG"))
+    different = perceptual_hash(make_image((64, 64), mirrored=True))
+    assert hamming_distance(original, resized) <= NEAR_DUPLICATE_DISTANCE
+    assert hamming_distance(original, different) > NEAR_DUPLICATE_DISTANCE
+
+
+def test_perceptual_hash_of_non_images():
+    assert perceptual_hash(b"not an image") is None
+
+
+def with_size(png, width, height):
+    # Rewrites the size in a PNG's header, leaving its pixels as they are.
+    header = b"IHDR" + struct.pack(">II", width, height) + png[24:29]
+    return png[:12] + header + struct.pack(">I", zlib.crc32(header)) + png[33:]
+
+
+def test_perceptual_hash_of_huge_images():
+    png = make_image((64, 64))
+    assert perceptual_hash(with_size(png, 64, 64)) is not None
+    # Too large to hash, though Pillow would decode it.
+    assert perceptual_hash(with_size(png, 8000,
+                                     MAX_HASHED_PIXELS // 8000 + 1)) is None
+    # A decompression bomb, which Pillow refuses to open.
+    assert perceptual_hash(with_size(png, 100000, 100000)) is None
+
+
+def test_near_duplicates_share_a_band():
+    phash = 0x0123456789abcdef
+    # Flip one bit in each of 7 of the 8 bands.
+    near = phash ^ 0x0001010101010101
+    assert hamming_distance(phash, near) == NEAR_DUPLICATE_DISTANCE
+    assert set(hash_bands(phash)) & set(hash_bands(near))
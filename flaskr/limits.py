@@ -0,0 +1,136 @@
+from collections import OrderedDict
+import threading
+import time
+""" Provides request coalescing and rate limiting for the Super Smash Bros. wiki project """
+
+
+class SingleFlight:
+    """Coalesces concurrent identical calls into a single computation.
+
+    The first caller for a key runs the function; callers arriving while it
+    is in flight wait for it and share its result (or exception) instead of
+    repeating the same backend calls. Nothing is kept once the call ends.
+    """
+
+    def __init__(self) -> None:
+        self._calls = {}  # key -> _Call in flight
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """Runs `fn`, or waits for the identical call already in flight.
+
+        Args:
+            key: A hashable value identifying the computation.
+            fn: A function with no arguments that performs the computation.
+
+        Returns:
+            The value returned by `fn`.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+        else:
+            try:
+                call.result = fn()
+            except Exception as error:
+                call.error = error
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+
+class _Call:
+    """A call in flight, shared by every caller of the same key."""
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MemoryBucketStore:
+    """Keeps token buckets in process memory.
+
+    This is the default store of `RateLimiter`. A store shared between
+    instances (such as one backed by Memorystore) only has to provide the
+    same atomic `consume` method.
+
+    Attributes:
+        max_keys:
+            An integer with the maximum number of buckets kept. The least
+            recently used bucket is dropped first, which only refills it.
+    """
+
+    def __init__(self, max_keys: int = 10000) -> None:
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, last refill time)
+        self._lock = threading.Lock()
+
+    def consume(self, key, rate: float, burst: int, now: float) -> float:
+        """Takes one token from a bucket, refilling it first.
+
+        Args:
+            key: A hashable value identifying the bucket.
+            rate: A float with the tokens added to the bucket per second.
+            burst: An integer with the capacity of the bucket.
+            now: A float with the current time, in seconds.
+
+        Returns:
+            A float with 0 if a token was taken, or else the number of
+            seconds until the next token is available.
+        """
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return wait
+
+
+class RateLimiter:
+    """Token-bucket rate limiting per client and route.
+
+    Attributes:
+        limits:
+            A dictionary mapping route names to (rate, burst) tuples, where
+            rate is the sustained requests per second a client may make and
+            burst is how many it may make at once. Routes not listed are
+            not limited.
+        store:
+            The bucket store, `MemoryBucketStore` unless a shared one is given.
+    """
+
+    def __init__(self, limits: dict, store=None) -> None:
+        self.limits = limits
+        self.store = store if store is not None else MemoryBucketStore()
+
+    def check(self, route: str, client: str) -> float:
+        """Counts a request from a client to a route against its limit.
+
+        Args:
+            route: A string with the name of the route.
+            client: A string identifying the client.
+
+        Returns:
+            A float with 0 if the request is allowed, or else the number of
+            seconds the client should wait before retrying.
+        """
+        if route not in self.limits:
+            return 0.0
+        rate, burst = self.limits[route]
+        return self.store.consume((route, client), rate, burst,
+                                  time.monotonic())
@@ -0,0 +1,77 @@
+import pytest, threading
+from .limits import MemoryBucketStore, RateLimiter, SingleFlight
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    single_flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def search():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return ["Mario"]
+
+    results = []
+    leader = threading.Thread(
+        target=lambda: results.append(single_flight.do("Mario", search)))
+    leader.start()
+    started.wait()
+    followers = [
+        threading.Thread(
+            target=lambda: results.append(single_flight.do("Mario", search)))
+        for _ in range(3)
+    ]
+    for follower in followers:
+        follower.start()
+    release.set()
+    for thread in [leader] + followers:
+        thread.join()
+
+    assert len(calls) == 1
+    assert results == [["Mario"]] * 4
+
+    # Later calls run again, since nothing is cached.
+    assert single_flight.do("Mario", lambda: ["Luigi"]) == ["Luigi"]
+
+
+def test_single_flight_propagates_errors():
+    single_flight = SingleFlight()
+
+    def fail():
+        raise RuntimeError("Datastore unavailable")
+
+    with pytest.raises(RuntimeError):
+        single_flight.do("authors", fail)
+    assert single_flight.do("authors", lambda: []) == []
+
+
+def test_bucket_allows_burst_then_refills():
+    store = MemoryBucketStore()
+    assert [store.consume("client", 1, 3, 0.0) for _ in range(3)] == [0, 0, 0]
+    assert store.consume("client", 1, 3, 0.0) == pytest.approx(1.0)
+    assert store.consume("client", 1, 3, 0.5) == pytest.approx(0.5)
+    assert store.consume("client", 1, 3, 1.0) == 0
+
+    # Other clients have their own bucket.
+    assert store.consume("other", 1, 3, 1.0) == 0
+
+
+def test_bucket_store_is_bounded():
+    store = MemoryBucketStore(max_keys=2)
+    for client in ["a", "b", "c"]:
+        store.consume(client, 1, 1, 0.0)
+    # The least recently used bucket was dropped, so it is full again.
+    assert store.consume("a", 1, 1, 0.0) == 0
+    assert store.consume("c", 1, 1, 0.0) > 0
+
+
+def test_rate_limiter_only_limits_configured_routes():
+    limiter = RateLimiter({"search": (1, 1)})
+    assert limiter.check("search", "127.0.0.1") == 0
+    assert limiter.check("search", "127.0.0.1") > 0
+    assert limiter.check("search", "10.0.0.1") == 0
+    assert limiter.check("pages", "127.0.0.1") == 0
+    assert limiter.check("pages", "127.0.0.1") == 0
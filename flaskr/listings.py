@@ -0,0 +1,157 @@
+from .changes import rewind
+from .records import WorldListing
+import click
+import logging
+import threading
+""" Provides precomputed world and page listings for the Super Smash Bros. wiki project """
+
+logger = logging.getLogger(__name__)
+
+# Number of changes read at a time when catching up with the change-log.
+REPLAY_BATCH = 500
+
+
+class WorldListings:
+    """An in-memory listing of the wiki's worlds and their characters.
+
+    The listing is materialized in a single WorldListing entity, along with
+    the change-log sequence number it reflects. An instance loads that
+    document once, replays the changes logged after it, and then applies
+    uploads, edits and deletes as they arrive from the change-feed, so
+    `/pages` and `/upload` never query the World kind. A periodic rebuild rescans the
+    World kind and stores a fresh document, repairing any drift.
+
+    Attributes:
+        backend:
+            The `Backend` the listing is built from and stored in.
+    """
+
+    def __init__(self, backend) -> None:
+        self.backend = backend
+        self._worlds = None  # world name -> character names
+        self._lock = threading.RLock()
+        self._stopped = threading.Event()
+
+    def worlds(self) -> list[str]:
+        """Returns the names of all worlds, sorted."""
+        with self._lock:
+            return sorted(self._load())
+
+    def characters(self, world: str) -> list[str]:
+        """Returns the names of a world's characters, empty if it is unknown."""
+        with self._lock:
+            return list(self._load().get(world, []))
+
+    def counts(self) -> dict[str, int]:
+        """Returns the number of characters in each world."""
+        with self._lock:
+            return {
+                world: len(characters)
+                for world, characters in self._load().items()
+            }
+
+    def apply_change(self, change: dict) -> None:
+        """Applies an upload, edit or delete of a character to the listing.
+
+        Changes can be applied more than once, so uploads recorded both
+        locally and through the change-feed are only listed once.
+
+        Args:
+            change: A dictionary with the "action", "page" and "world" of a
+                change from the change-feed, and the "old_world" of edits
+                and deletes.
+        """
+        if change["action"] not in ("upload", "edit", "delete"):
+            return
+        with self._lock:
+            worlds = self._load()
+            old_world = change.get("old_world")
+            if old_world is not None and old_world != change["world"]:
+                characters = worlds.get(old_world, [])
+                if change["page"] in characters:
+                    characters.remove(change["page"])
+                if not characters:
+                    worlds.pop(old_world, None)
+            if change["world"] is not None:
+                characters = worlds.setdefault(change["world"], [])
+                if change["page"] not in characters:
+                    characters.append(change["page"])
+
+    def rebuild(self) -> WorldListing:
+        """Rescans the World kind and stores the listing.
+
+        Returns:
+            The `WorldListing` that was stored.
+        """
+        # Reading the sequence first means changes racing with the scan are
+        # replayed on load rather than missed.
+        seq = self.backend.change_log.latest_seq()
+        listing = WorldListing(self.backend.build_world_listing(), seq)
+        self.backend.save_world_listing(listing)
+        with self._lock:
+            self._worlds = listing.worlds
+            self._replay(seq)
+        logger.info("Rebuilt the listing of %d worlds", len(listing.worlds))
+        return listing
+
+    def start(self, interval: float, on_rebuild=None) -> None:
+        """Rebuilds the listing every `interval` seconds in a daemon thread.
+
+        Args:
+            interval: A float with the number of seconds between rebuilds.
+            on_rebuild: A function called after each rebuild, if any.
+        """
+
+        def run():
+            while not self._stopped.wait(interval):
+                try:
+                    self.rebuild()
+                    if on_rebuild:
+                        on_rebuild()
+                except Exception:
+                    logger.exception("Rebuilding the world listing failed")
+
+        threading.Thread(target=run, name="world-listings", daemon=True).start()
+
+    def stop(self) -> None:
+        """Stops the periodic rebuilds."""
+        self._stopped.set()
+
+    def _load(self) -> dict:
+        """Returns the listing, loading it first if needed.
+
+        The caller must hold the lock.
+        """
+        if self._worlds is None:
+            listing = self.backend.get_world_listing()
+            if listing is None:
+                self.rebuild()
+            else:
+                self._worlds = listing.worlds
+                self._replay(listing.seq)
+        return self._worlds
+
+    def _replay(self, seq: str) -> None:
+        """Applies the changes logged after a sequence number.
+
+        Changes can commit after later ones, so the replay starts a little
+        before the sequence number; applying a change twice is harmless.
+        """
+        seq = rewind(seq)
+        while True:
+            changes = self.backend.change_log.read_since(seq, REPLAY_BATCH)
+            for change in changes:
+                self.apply_change(change)
+                seq = max(seq, change["seq"])
+            if len(changes) < REPLAY_BATCH:
+                return
+
+
+def register_commands(app, backend):
+    """Registers the listing commands on the app's `flask` CLI."""
+
+    @app.cli.command("build-listings")
+    def build_listings():
+        """Rebuilds the precomputed listing of worlds and characters."""
+        listing = WorldListings(backend).rebuild()
+        click.echo(f"Listed {len(listing.worlds)} worlds.")
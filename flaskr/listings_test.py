@@ -0,0 +1,116 @@
+import pytest, time
+from unittest.mock import MagicMock
+from .changes import seq_at
+from .listings import WorldListings
+from .records import WorldListing
+
+
+@pytest.fixture
+def backend():
+    backend = MagicMock()
+    backend.get_world_listing.return_value = None
+    backend.build_world_listing.return_value = {
+        "Super Mario Bros.": ["Mario"],
+        "EarthBound": ["Ness"]
+    }
+    backend.change_log.latest_seq.return_value = seq_at(107)
+    backend.change_log.read_since.return_value = []
+    return backend
+
+
+def test_listing_is_built_and_stored_when_missing(backend):
+    listings = WorldListings(backend)
+    assert listings.worlds() == ["EarthBound", "Super Mario Bros."]
+    assert listings.characters("EarthBound") == ["Ness"]
+    assert listings.characters("Pokémon") == []
+    assert listings.counts() == {"Super Mario Bros.": 1, "EarthBound": 1}
+    backend.save_world_listing.assert_called_once_with(
+        WorldListing(backend.build_world_listing.return_value, seq_at(107)))
+
+    # Later reads use the listing in memory.
+    listings.worlds()
+    backend.build_world_listing.assert_called_once()
+    backend.get_world_listing.assert_called_once()
+
+
+def test_stored_listing_catches_up_with_change_log(backend):
+    backend.get_world_listing.return_value = WorldListing(
+        {"EarthBound": ["Ness"]}, seq_at(103))
+    # Changes up to COMMIT_LAG_SECONDS before the listing are replayed too.
+    backend.change_log.read_since.side_effect = lambda seq, limit: [{
+        "seq": seq_at(102),
+        "action": "upload",
+        "page": "Ness",
+        "world": "EarthBound"
+    }, {
+        "seq": seq_at(104),
+        "action": "upload",
+        "page": "Lucas",
+        "world": "EarthBound"
+    }, {
+        "seq": seq_at(105),
+        "action": "comment",
+        "page": "Ness"
+    }] if seq == seq_at(93) else []
+
+    listings = WorldListings(backend)
+    assert listings.characters("EarthBound") == ["Ness", "Lucas"]
+    backend.build_world_listing.assert_not_called()
+
+
+def test_uploads_are_applied_once(backend):
+    listings = WorldListings(backend)
+    upload = {"action": "upload", "page": "Luigi", "world": "Super Mario Bros."}
+    listings.apply_change(upload)
+    listings.apply_change(upload)
+    listings.apply_change({
+        "action": "upload",
+        "page": "Pikachu",
+        "world": "Pokémon"
+    })
+    assert listings.characters("Super Mario Bros.") == ["Mario", "Luigi"]
+    assert "Pokémon" in listings.worlds()
+
+
+def test_periodic_rebuild(backend):
+    listings = WorldListings(backend)
+    listings.worlds()
+    rebuilt = MagicMock()
+    backend.build_world_listing.return_value = {"EarthBound": ["Ness", "Lucas"]}
+
+    listings.start(0.01, on_rebuild=rebuilt)
+    try:
+        for _ in range(100):
+            if rebuilt.called:
+                break
+            time.sleep(0.01)
+    finally:
+        listings.stop()
+    assert rebuilt.called
+    assert listings.worlds() == ["EarthBound"]
+
+
+def test_edits_and_deletes_move_characters(backend):
+    listings = WorldListings(backend)
+    edit = {
+        "action": "edit",
+        "page": "Mario",
+        "world": "EarthBound",
+        "old_world": "Super Mario Bros."
+    }
+    listings.apply_change(edit)
+    listings.apply_change(edit)
+    assert listings.counts() == {"EarthBound": 2}
+    assert listings.characters("EarthBound") == ["Ness", "Mario"]
+
+    # Edits within a world leave the listing alone.
+    listings.apply_change(dict(edit, old_world="EarthBound"))
+    assert listings.characters("EarthBound") == ["Ness", "Mario"]
+
+    listings.apply_change({
+        "action": "delete",
+        "page": "Ness",
+        "world": None,
+        "old_world": "EarthBound"
+    })
+    assert listings.characters("EarthBound") == ["Mario"]
@@ -0,0 +1,499 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+import click
+import collections
+import html
+import http.cookiejar
+import itertools
+import json
+import random
+import re
+import secrets
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+""" Provides a concurrent load-test driver for the Super Smash Bros. wiki project """
+
+# Traffic mixes: the relative weight of each kind of request.
+TRAFFIC_MIXES = {
+    'browse': {
+        'home': 5,
+        'pages': 15,
+        'page': 70,
+        'search': 10
+    },
+    'mixed': {
+        'home': 5,
+        'pages': 10,
+        'page': 55,
+        'search': 10,
+        'upvote': 10,
+        'comment': 10
+    },
+    'contention': {
+        'page': 20,
+        'upvote': 40,
+        'comment': 40
+    },
+}
+
+# Kinds of requests a traffic mix can weigh.
+ROUTES = ('home', 'pages', 'page', 'search', 'upvote', 'comment')
+
+# Requests that change a page, which need a logged-in user.
+WRITE_ROUTES = ('upvote', 'comment')
+
+# Pages whose stats are read at once through the JSON API, its default
+# API_BATCH_LIMIT.
+STATS_BATCH = 500
+
+_CSRF_TOKEN = re.compile(r'name="csrf_token"[^>]*value="([^"]*)"')
+_WORLD_OPTION = re.compile(r'<option value="(/pages\?world=[^"]*)"')
+_PAGE_LINK = re.compile(r'<a href="/pages/([^"]+)"')
+
+
+class RouteStats(NamedTuple):
+    """The results of the requests made to one route.
+
+    Errors are server errors and failed connections; rejections are other
+    4xx responses, such as rate limiting. Latencies are in milliseconds.
+    """
+    route: str
+    requests: int
+    errors: int
+    rejected: int
+    throughput: float
+    p50: float
+    p95: float
+    p99: float
+
+    @property
+    def error_rate(self) -> float:
+        return self.errors / self.requests if self.requests else 0.0
+
+
+class LostUpdate(NamedTuple):
+    """A page stat that does not reflect all the writes acknowledged to it."""
+    page: str
+    field: str
+    expected: int
+    actual: int
+
+
+class LoadReport(NamedTuple):
+    """The results of a load test."""
+    duration: float
+    routes: list[RouteStats]
+    lost_updates: list[LostUpdate]
+
+    def format(self) -> str:
+        """Renders the report as a table of routes and any lost updates."""
+        lines = [
+            f'{"route":<10}{"requests":>10}{"req/s":>10}{"errors":>9}'
+            f'{"rejected":>10}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}'
+        ]
+        for stats in self.routes:
+            lines.append(f'{stats.route:<10}{stats.requests:>10}'
+                         f'{stats.throughput:>10.1f}{stats.error_rate:>9.1%}'
+                         f'{stats.rejected:>10}{stats.p50:>9.1f}'
+                         f'{stats.p95:>9.1f}{stats.p99:>9.1f}')
+        lines.append(f'Ran for {self.duration:.1f} s.')
+        if self.lost_updates:
+            lines.append(f'{len(self.lost_updates)} lost updates:')
+            lines.extend(f'  {lost.page} {lost.field}: expected '
+                         f'{lost.expected}, found {lost.actual}'
+                         for lost in self.lost_updates)
+        else:
+            lines.append('No lost updates.')
+        return '\n'.join(lines)
+
+
+class ZipfSampler:
+    """Picks items with Zipf-distributed popularity.
+
+    The item at rank k (from 1) is picked with probability proportional to
+    1 / k ** exponent, so a few pages get most of the traffic, as on real
+    wikis, and they are the ones contended by writes.
+
+    Attributes:
+        items: A list of the items, most popular first.
+        exponent: A float with the skew; 0 picks items uniformly.
+    """
+
+    def __init__(self, items, exponent: float = 1.1) -> None:
+        self.items = list(items)
+        self.exponent = exponent
+        self._cumulative = list(
+            itertools.accumulate(1 / rank**exponent
+                                 for rank in range(1,
+                                                   len(self.items) + 1)))
+
+    def sample(self, rng: random.Random):
+        """Returns a random item."""
+        return rng.choices(self.items, cum_weights=self._cumulative)[0]
+
+
+class InProcessClient:
+    """Sends requests to a Flask app through its test client."""
+
+    def __init__(self, app) -> None:
+        self._client = app.test_client()
+
+    def request(self, method: str, path: str, data=None, json_body=None):
+        """Sends a request without following redirects.
+
+        Returns:
+            A tuple with the integer status and the bytes of the body.
+        """
+        response = self._client.open(path,
+                                     method=method,
+                                     data=data,
+                                     json=json_body)
+        return response.status_code, response.get_data()
+
+
+class HttpClient:
+    """Sends requests to a running server, keeping its session cookie.
+
+    Attributes:
+        base_url: A string with the server's URL, such as
+            "http://localhost:8080".
+        timeout: A float with the number of seconds a request can take.
+    """
+
+    def __init__(self, base_url: str, timeout: float = 30) -> None:
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self._opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+            _NoRedirects())
+
+    def request(self, method: str, path: str, data=None, json_body=None):
+        """Sends a request without following redirects.
+
+        Returns:
+            A tuple with the integer status and the bytes of the body.
+        """
+        headers = {}
+        body = None
+        if json_body is not None:
+            body = json.dumps(json_body).encode()
+            headers['Content-Type'] = 'application/json'
+        elif data is not None:
+            body = urllib.parse.urlencode(data).encode()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        http_request = urllib.request.Request(self.base_url + path,
+                                              data=body,
+                                              headers=headers,
+                                              method=method)
+        try:
+            with self._opener.open(http_request,
+                                   timeout=self.timeout) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as error:
+            return error.code, error.read()
+
+
+class _NoRedirects(urllib.request.HTTPRedirectHandler):
+    """Returns redirects as responses, like the test client does."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class LoadTest:
+    """Drives concurrent wiki traffic and measures how the app holds up.
+
+    Each worker has its own client and, when the mix writes, its own user,
+    signed up for the run. Workers pick requests from the traffic mix and
+    pages from a Zipf distribution until the request budget or the
+    duration runs out.
+
+    Lost updates are found by reading every page's upvote and comment
+    counts through the JSON API before and after the run: a page must
+    gain one comment per acknowledged comment, and one upvote per user who
+    toggled its upvote an odd number of times. The check assumes nothing
+    else writes to the pages during the run.
+
+    Attributes:
+        client_factory: A function returning a new client, such as
+            `InProcessClient` or `HttpClient`.
+        page_names: A list of the page names, most popular first.
+        mix: A dictionary mapping routes to their relative weights; the
+            "mixed" traffic mix by default.
+        concurrency: An integer with the number of concurrent workers.
+        zipf_exponent: A float with the skew of page popularity.
+        seed: An integer seeding the random choices, or None.
+    """
+
+    def __init__(self,
+                 client_factory,
+                 page_names,
+                 mix: dict = None,
+                 concurrency: int = 8,
+                 zipf_exponent: float = 1.1,
+                 seed: int = None) -> None:
+        mix = mix or TRAFFIC_MIXES['mixed']
+        unknown = set(mix) - set(ROUTES)
+        if unknown:
+            raise ValueError(f'Unknown routes in the traffic mix: {unknown}')
+        if not page_names:
+            raise ValueError('The load test needs at least one page.')
+        self.client_factory = client_factory
+        self.page_names = list(page_names)
+        self.mix = mix
+        self.concurrency = concurrency
+        self.zipf_exponent = zipf_exponent
+        self.seed = seed
+        self._lock = threading.Lock()
+
+    def run(self, requests: int = 1000, duration: float = None) -> LoadReport:
+        """Runs the load test.
+
+        Args:
+            requests: An integer with the total number of requests to send.
+            duration: A float with the number of seconds to run for
+                instead, if given.
+
+        Returns:
+            A `LoadReport` of the run.
+        """
+        rng = random.Random(self.seed)
+        run_id = f'{rng.getrandbits(32):08x}'
+        pages = ZipfSampler(self.page_names, self.zipf_exponent)
+        writes = any(route in WRITE_ROUTES for route in self.mix)
+        workers = [
+            _Worker(self.client_factory(), f'loadtest-{run_id}-{index}',
+                    random.Random(rng.random()))
+            for index in range(self.concurrency)
+        ]
+        if writes:
+            for worker in workers:
+                worker.log_in()
+            before = page_stats(workers[0].client, self.page_names)
+
+        self._remaining = requests if duration is None else None
+        self._latencies = collections.defaultdict(list)
+        self._statuses = collections.defaultdict(collections.Counter)
+        self._comments = collections.Counter()
+        self._toggles = collections.Counter()
+        deadline = None if duration is None else time.monotonic() + duration
+        routes, weights = zip(*self.mix.items())
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency,
+                                thread_name_prefix='load-test') as executor:
+            for future in [
+                    executor.submit(self._drive, worker, pages, routes, weights,
+                                    deadline) for worker in workers
+            ]:
+                future.result()
+        elapsed = time.perf_counter() - started
+
+        lost_updates = []
+        if writes:
+            after = page_stats(workers[0].client, self.page_names)
+            lost_updates = self._lost_updates(before, after)
+        return LoadReport(elapsed, [
+            _route_stats(route, self._latencies[route], self._statuses[route],
+                         elapsed) for route in routes if self._latencies[route]
+        ], lost_updates)
+
+    def _claim(self, deadline) -> bool:
+        """Tells whether a worker may send another request."""
+        if deadline is not None:
+            return time.monotonic() < deadline
+        with self._lock:
+            if self._remaining <= 0:
+                return False
+            self._remaining -= 1
+            return True
+
+    def _drive(self, worker, pages, routes, weights, deadline) -> None:
+        while self._claim(deadline):
+            route = worker.rng.choices(routes, weights)[0]
+            page = pages.sample(worker.rng)
+            started = time.perf_counter()
+            try:
+                status, _ = worker.send(route, page)
+            except OSError:
+                status = None
+            latency = 1000 * (time.perf_counter() - started)
+            with self._lock:
+                self._latencies[route].append(latency)
+                self._statuses[route][status] += 1
+                # Writes redirect back to the page once they are stored.
+                if status == 302 and route == 'comment':
+                    self._comments[page] += 1
+                elif status == 302 and route == 'upvote':
+                    self._toggles[page, worker.username] += 1
+
+    def _lost_updates(self, before, after) -> list[LostUpdate]:
+        gained_upvotes = collections.Counter(
+            page for (page, _), toggles in self._toggles.items() if toggles % 2)
+        lost = []
+        for page in sorted(before):
+            for field, gained in (('comment_count', self._comments[page]),
+                                  ('upvotes', gained_upvotes[page])):
+                expected = before[page][field] + gained
+                if after[page][field] != expected:
+                    lost.append(
+                        LostUpdate(page, field, expected, after[page][field]))
+        return lost
+
+
+class _Worker:
+    """A simulated user with its own client and session."""
+
+    def __init__(self, client, username: str, rng: random.Random) -> None:
+        self.client = client
+        self.username = username
+        self.rng = rng
+
+    def log_in(self) -> None:
+        """Signs the worker's user up and logs it in.
+
+        Raises:
+            RuntimeError: If the app did not log the user in.
+        """
+        password = secrets.token_urlsafe(16)
+        for path in ('/signup', '/login'):
+            _, body = self.client.request('GET', path)
+            form = {'username': self.username, 'password': password}
+            token = _CSRF_TOKEN.search(body.decode(errors='replace'))
+            if token:
+                form['csrf_token'] = html.unescape(token.group(1))
+            status, _ = self.client.request('POST', path, data=form)
+            if status != 302:
+                raise RuntimeError(
+                    f'Could not {path[1:]} as {self.username}: {status}')
+
+    def send(self, route: str, page: str):
+        quoted = '/pages/' + urllib.parse.quote(page, safe='')
+        if route == 'home':
+            return self.client.request('GET', '/home')
+        if route == 'pages':
+            return self.client.request('GET', '/pages')
+        if route == 'page':
+            return self.client.request('GET', quoted)
+        if route == 'search':
+            # Searches for part of a popular page's name.
+            return self.client.request(
+                'POST',
+                '/search',
+                data={'search_query': page[:max(3,
+                                                len(page) // 2)]})
+        if route == 'upvote':
+            return self.client.request('POST', quoted + '/upvote')
+        return self.client.request(
+            'POST',
+            quoted + '/comment',
+            data={'comment': f'Load test comment {self.rng.getrandbits(32)}'})
+
+
+def _route_stats(route, latencies, statuses, elapsed) -> RouteStats:
+    latencies = sorted(latencies)
+    errors = sum(count for status, count in statuses.items()
+                 if status is None or status >= 500)
+    rejected = sum(count for status, count in statuses.items()
+                   if status is not None and 400 <= status < 500)
+    return RouteStats(route, len(latencies), errors, rejected,
+                      len(latencies) / elapsed if elapsed else 0.0,
+                      percentile(latencies, 50), percentile(latencies, 95),
+                      percentile(latencies, 99))
+
+
+def percentile(sorted_values, percent: float) -> float:
+    """Returns the nearest-rank percentile of sorted values, 0 if empty."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * percent // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def page_stats(client, page_names) -> dict:
+    """Reads pages' upvote and comment counts through the JSON API.
+
+    Args:
+        client: The client to read with.
+        page_names: The names of the pages to read.
+
+    Returns:
+        A dictionary mapping each found page's name to a dictionary with
+        its "upvotes" and "comment_count".
+
+    Raises:
+        RuntimeError: If the API does not answer.
+    """
+    stats = {}
+    page_names = list(page_names)
+    for start in range(0, len(page_names), STATS_BATCH):
+        status, body = client.request(
+            'POST',
+            '/api/v1/pages/batch',
+            json_body={
+                'names': page_names[start:start + STATS_BATCH],
+                'fields': ['upvotes', 'comment_count']
+            })
+        if status != 200:
+            raise RuntimeError(f'Reading page stats failed: {status}')
+        for page in json.loads(body)['pages']:
+            stats[page['name']] = page
+    return stats
+
+
+def discover_pages(client) -> list[str]:
+    """Lists the wiki's page names by crawling the page index of each world."""
+    _, body = client.request('GET', '/pages')
+    names = []
+    for option in _WORLD_OPTION.findall(body.decode(errors='replace')):
+        _, world_body = client.request('GET', html.unescape(option))
+        names.extend(
+            html.unescape(name)
+            for name in _PAGE_LINK.findall(world_body.decode(errors='replace')))
+    return list(dict.fromkeys(names))
+
+
+def register_commands(app):
+    """Registers the load test command on the app's `flask` CLI."""
+
+    @app.cli.command('load-test')
+    @click.option('--url',
+                  default=None,
+                  help='Server to load over HTTP; the app runs in-process '
+                  'through its test client by default.')
+    @click.option('--mix',
+                  type=click.Choice(sorted(TRAFFIC_MIXES)),
+                  default='mixed',
+                  show_default=True)
+    @click.option('--concurrency', default=8, show_default=True)
+    @click.option('--requests', default=1000, show_default=True)
+    @click.option('--duration',
+                  type=float,
+                  default=None,
+                  help='Seconds to run for, instead of a number of requests.')
+    @click.option('--zipf', default=1.1, show_default=True)
+    @click.option('--page',
+                  'page_names',
+                  multiple=True,
+                  help='Page to load, most popular first; every page by '
+                  'default.')
+    @click.option('--seed', type=int, default=None)
+    def load_test(url, mix, concurrency, requests, duration, zipf, page_names,
+                  seed):
+        """Drives concurrent wiki traffic and reports latency and lost updates."""
+        if url:
+            client_factory = lambda: HttpClient(url)
+        else:
+            client_factory = lambda: InProcessClient(app)
+        if not page_names:
+            page_names = discover_pages(client_factory())
+            # Popularity is assigned at random, not alphabetically.
+            random.Random(seed).shuffle(page_names)
+        try:
+            report = LoadTest(client_factory, page_names, TRAFFIC_MIXES[mix],
+                              concurrency, zipf, seed).run(requests, duration)
+        except (RuntimeError, ValueError) as error:
+            raise click.ClickException(str(error))
+        click.echo(report.format())
@@ -0,0 +1,136 @@
+import collections, pytest, random, threading
+from flask import Flask, jsonify, redirect, request, session
+from .loadtest import InProcessClient, LoadTest, ZipfSampler, discover_pages, percentile
+
+PAGES = ["Mario", "Ness", "Kirby", "Samus"]
+
+
+def make_wiki(lose_every=0):
+    """Builds a small app with the wiki's routes, losing every nth upvote."""
+    app = Flask(__name__)
+    app.config["SECRET_KEY"] = "test"
+    lock = threading.Lock()
+    upvotes = collections.defaultdict(set)
+    comments = collections.Counter()
+    writes = collections.Counter()
+
+    @app.route("/signup", methods=["GET", "POST"])
+    def signup():
+        if request.method == "GET":
+            return '<input name="csrf_token" type="hidden" value="abc">'
+        assert request.form["csrf_token"] == "abc"
+        return redirect("/login")
+
+    @app.route("/login", methods=["GET", "POST"])
+    def login():
+        if request.method == "POST":
+            session["user"] = request.form["username"]
+            return redirect("/home")
+        return "Log in"
+
+    @app.route("/home")
+    def home():
+        return "Home"
+
+    @app.route("/pages")
+    def pages():
+        if "world" not in request.args:
+            return ('<option value="/pages?world=A%26B">'
+                    '<option value="/pages?world=C">')
+        names = PAGES[:2] if request.args["world"] == "A&B" else PAGES[1:]
+        return "".join(f'<a href="/pages/{name}">' for name in names)
+
+    @app.route("/pages/<name>")
+    def page(name):
+        return name
+
+    @app.route("/search", methods=["POST"])
+    def search():
+        return "Too many requests", 429
+
+    @app.route("/pages/<name>/upvote", methods=["POST"])
+    def upvote(name):
+        with lock:
+            writes["upvote"] += 1
+            if not (lose_every and writes["upvote"] % lose_every == 0):
+                upvotes[name] ^= {session["user"]}
+        return redirect("/pages/" + name)
+
+    @app.route("/pages/<name>/comment", methods=["POST"])
+    def comment(name):
+        with lock:
+            comments[name] += 1
+        return redirect("/pages/" + name)
+
+    @app.route("/api/v1/pages/batch", methods=["POST"])
+    def batch():
+        return jsonify({
+            "pages": [{
+                "name": name,
+                "upvotes": len(upvotes[name]),
+                "comment_count": comments[name]
+            } for name in request.json["names"]],
+            "missing": []
+        })
+
+    return app
+
+
+def test_zipf_sampler_favours_top_ranks():
+    sampler = ZipfSampler(range(100), exponent=1.2)
+    rng = random.Random(1)
+    counts = collections.Counter(sampler.sample(rng) for _ in range(10000))
+    assert counts[0] > counts[1] > counts[10] > counts[90]
+    assert sum(counts[rank] for rank in range(10)) > 5000
+
+
+def test_percentile_uses_nearest_rank():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([7], 95) == 7
+    assert percentile([], 50) == 0.0
+
+
+def test_load_test_reports_routes():
+    app = make_wiki()
+    report = LoadTest(lambda: InProcessClient(app),
+                      PAGES,
+                      concurrency=4,
+                      seed=3).run(requests=400)
+
+    routes = {stats.route: stats for stats in report.routes}
+    assert sum(stats.requests for stats in report.routes) == 400
+    assert set(routes) == {
+        "home", "pages", "page", "search", "upvote", "comment"
+    }
+    assert routes["search"].rejected == routes["search"].requests
+    assert routes["page"].errors == 0
+    assert routes["page"].p50 <= routes["page"].p95 <= routes["page"].p99
+    assert report.lost_updates == []
+    assert "No lost updates." in report.format()
+
+
+def test_load_test_detects_lost_updates():
+    app = make_wiki(lose_every=5)
+    report = LoadTest(lambda: InProcessClient(app),
+                      PAGES,
+                      mix={
+                          "upvote": 1
+                      },
+                      concurrency=4,
+                      seed=3).run(requests=200)
+
+    assert report.lost_updates
+    assert all(lost.field == "upvotes" for lost in report.lost_updates)
+    assert "lost updates:" in report.format()
+
+
+def test_load_test_rejects_unknown_routes():
+    with pytest.raises(ValueError):
+        LoadTest(lambda: None, PAGES, mix={"delete": 1})
+
+
+def test_discover_pages_crawls_each_world():
+    client = InProcessClient(make_wiki())
+    assert discover_pages(client) == ["Mario", "Ness", "Kirby", "Samus"]
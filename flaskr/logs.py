@@ -0,0 +1,264 @@
+from flask import g, request
+import atexit
+import contextvars
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import time
+import uuid
+import zlib
+""" Provides structured, queued logging with request tracing for the Super Smash Bros. wiki project """
+
+# Trace ID of the request being handled, if any. Context variables follow
+# the request into async views and, through `AsyncProxy`, into backend
+# calls on executor threads.
+trace_id = contextvars.ContextVar('trace_id', default=None)
+
+# Trace IDs are 32 hex digits in both Cloud Trace and W3C trace context.
+TRACE_ID = re.compile(r'[0-9a-fA-F]{32}')
+
+# Loggers quieted by default: the Google Cloud clients log every RPC.
+DEFAULT_LOG_LEVELS = {
+    'google': 'WARNING',
+    'urllib3': 'WARNING',
+    'werkzeug': 'WARNING',
+}
+
+# Attributes every `LogRecord` has, which are not copied as extra fields.
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord(
+    {}))) | {'message', 'asctime', 'trace_id'}
+
+_listener = None
+_handler = None
+_traceback_formatter = logging.Formatter()
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as single-line JSON objects.
+
+    Field names follow Cloud Logging's structured logging conventions, so
+    App Engine parses the severity and links lines to their trace. Extra
+    attributes passed with `extra=` are added as fields.
+
+    Attributes:
+        project: A string with the Google Cloud project traces belong to,
+            or None.
+    """
+
+    def __init__(self, project: str = None) -> None:
+        super().__init__()
+        self.project = project
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time':
+                datetime.datetime.fromtimestamp(
+                    record.created, datetime.timezone.utc).isoformat(),
+            'severity':
+                record.levelname,
+            'logger':
+                record.name,
+            'message':
+                record.getMessage(),
+        }
+        if getattr(record, 'trace_id', None):
+            entry['trace_id'] = record.trace_id
+            if self.project:
+                entry['logging.googleapis.com/trace'] = (
+                    f'projects/{self.project}/traces/{record.trace_id}')
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TraceFilter(logging.Filter):
+    """Stamps records with the current trace ID.
+
+    It runs in the thread that logs, before records are queued, since the
+    thread writing them out does not share the request's context.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = trace_id.get()
+        return True
+
+
+class DebugSampler(logging.Filter):
+    """Keeps only a sample of DEBUG records.
+
+    Requests are sampled as a whole, by their trace ID, so a sampled
+    request keeps all its debug lines. Records outside requests are
+    sampled one by one.
+
+    Attributes:
+        rate: A float with the fraction of DEBUG records kept.
+    """
+
+    def __init__(self, rate: float) -> None:
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG or self.rate >= 1:
+            return True
+        key = getattr(record, 'trace_id', None)
+        if key is None:
+            return random.random() < self.rate
+        return zlib.crc32(key.encode()) < self.rate * 2**32
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """A queue handler that drops records instead of blocking when full.
+
+    Attributes:
+        dropped: An integer with the number of records dropped so far.
+    """
+
+    def __init__(self, log_queue: queue.Queue) -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Merges the arguments into the message and renders the traceback
+        # now, so the record can be written from another thread, keeping
+        # the traceback out of the message.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exception = _traceback_formatter.formatException(
+                record.exc_info)
+            record.exc_info = None
+            record.exc_text = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def configure_logging(level: str = 'INFO',
+                      levels: dict = None,
+                      debug_sample_rate: float = 1.0,
+                      queue_size: int = 10000,
+                      stream=None) -> DroppingQueueHandler:
+    """Sends log records through a queue to a JSON stream handler.
+
+    Logging calls only format the message and queue the record; a
+    background thread writes it out. Reconfiguring replaces the handler
+    installed by the previous call, leaving other handlers alone.
+
+    Args:
+        level: A string with the level of the root logger.
+        levels: A dictionary mapping logger names to their own levels.
+        debug_sample_rate: A float with the fraction of DEBUG records kept.
+        queue_size: An integer with the number of records that can wait to
+            be written before new ones are dropped.
+        stream: The stream written to; standard error by default.
+
+    Returns:
+        The `DroppingQueueHandler` installed on the root logger.
+    """
+    global _listener, _handler
+    root = logging.getLogger()
+    if _listener is not None:
+        _listener.stop()
+        root.removeHandler(_handler)
+
+    output = logging.StreamHandler(stream)
+    output.setFormatter(JsonFormatter(os.environ.get('GOOGLE_CLOUD_PROJECT')))
+    _handler = DroppingQueueHandler(queue.Queue(queue_size))
+    _handler.addFilter(TraceFilter())
+    _handler.addFilter(DebugSampler(debug_sample_rate))
+    _listener = logging.handlers.QueueListener(_handler.queue, output)
+    _listener.start()
+
+    root.addHandler(_handler)
+    root.setLevel(level)
+    for name, logger_level in dict(DEFAULT_LOG_LEVELS, **(levels or
+                                                          {})).items():
+        logging.getLogger(name).setLevel(logger_level)
+    return _handler
+
+
+def _flush():
+    if _listener is not None:
+        _listener.stop()
+
+
+atexit.register(_flush)
+
+
+def init_app(app):
+    """Configures logging for the app and traces its requests.
+
+    Each request gets the trace ID of its X-Cloud-Trace-Context or
+    traceparent header, or a new one, which is logged with every line
+    written while handling it and returned in the X-Trace-Id header.
+
+    Logging is set up from the LOG_LEVEL, LOG_LEVELS,
+    LOG_DEBUG_SAMPLE_RATE and LOG_QUEUE_SIZE config values.
+
+    Args:
+        app: The Flask app to configure logging for.
+    """
+    app.config.setdefault('LOG_LEVEL', 'INFO')
+    app.config.setdefault('LOG_LEVELS', {})
+    app.config.setdefault('LOG_DEBUG_SAMPLE_RATE', 0.01)
+    app.config.setdefault('LOG_QUEUE_SIZE', 10000)
+    configure_logging(app.config['LOG_LEVEL'], app.config['LOG_LEVELS'],
+                      app.config['LOG_DEBUG_SAMPLE_RATE'],
+                      app.config['LOG_QUEUE_SIZE'])
+    request_logger = logging.getLogger('flaskr.requests')
+
+    @app.before_request
+    def start_trace():
+        g.trace_token = trace_id.set(request_trace_id())
+        g.trace_started = time.perf_counter()
+
+    @app.after_request
+    def log_request(response):
+        current = trace_id.get()
+        if current:
+            response.headers['X-Trace-Id'] = current
+            request_logger.debug(
+                '%s %s %d',
+                request.method,
+                request.path,
+                response.status_code,
+                extra={
+                    'duration_ms':
+                        round(1000 * (time.perf_counter() - g.trace_started), 1)
+                })
+        return response
+
+    @app.teardown_request
+    def end_trace(exc):
+        token = g.pop('trace_token', None)
+        if token is not None:
+            trace_id.reset(token)
+
+
+def request_trace_id() -> str:
+    """Returns the trace ID sent with the current request, or a new one."""
+    # X-Cloud-Trace-Context is "TRACE_ID/SPAN_ID;o=OPTIONS", and traceparent
+    # is "VERSION-TRACE_ID-SPAN_ID-FLAGS".
+    candidates = [
+        request.headers.get('X-Cloud-Trace-Context', '').split('/', 1)[0],
+        (request.headers.get('traceparent', '').split('-') + [''])[1],
+    ]
+    for candidate in candidates:
+        if TRACE_ID.fullmatch(candidate):
+            return candidate.lower()
+    return uuid.uuid4().hex
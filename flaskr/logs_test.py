@@ -0,0 +1,106 @@
+import pytest, io, json, logging, queue, time
+from flask import Flask
+from unittest.mock import MagicMock
+from .aio import AsyncProxy
+from . import logs
+
+
+@pytest.fixture
+def stream():
+    stream = io.StringIO()
+    yield stream
+    logs.configure_logging()
+
+
+def read_lines(stream):
+    logs._listener.stop()  # Waits for queued records to be written.
+    logs._listener.start()
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+def test_json_lines_with_extra_fields(stream):
+    logs.configure_logging(stream=stream)
+    logger = logging.getLogger("flaskr.test")
+    logger.info("Uploaded %s", "Mario", extra={"world": "Super Mario Bros."})
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        logger.exception("Upload failed")
+
+    uploaded, failed = read_lines(stream)
+    assert uploaded["severity"] == "INFO"
+    assert uploaded["logger"] == "flaskr.test"
+    assert uploaded["message"] == "Uploaded Mario"
+    assert uploaded["world"] == "Super Mario Bros."
+    assert failed["message"] == "Upload failed"
+    assert "ValueError: boom" in failed["exception"]
+
+
+def test_per_logger_levels(stream):
+    logs.configure_logging("DEBUG", {"flaskr.quiet": "ERROR"}, stream=stream)
+    logging.getLogger("flaskr.quiet").warning("hidden")
+    logging.getLogger("google.cloud").info("hidden")
+    logging.getLogger("flaskr.loud").debug("shown")
+    assert [line["message"] for line in read_lines(stream)] == ["shown"]
+
+
+def test_debug_sampling_keeps_whole_traces(stream):
+    logs.configure_logging("DEBUG", debug_sample_rate=0.5, stream=stream)
+    logger = logging.getLogger("flaskr.test")
+    for request_num in range(100):
+        token = logs.trace_id.set(f"{request_num:032x}")
+        logger.debug("first")
+        logger.debug("second")
+        logger.warning("always")
+        logs.trace_id.reset(token)
+
+    lines = read_lines(stream)
+    debug_traces = [
+        line["trace_id"] for line in lines if line["severity"] == "DEBUG"
+    ]
+    assert 0 < len(debug_traces) < 200
+    assert all(debug_traces.count(trace) == 2 for trace in debug_traces)
+    assert sum(line["severity"] == "WARNING" for line in lines) == 100
+
+
+def test_full_queue_drops_records():
+    handler = logs.DroppingQueueHandler(queue.Queue(1))
+    record = logging.makeLogRecord({"msg": "hi"})
+    handler.handle(record)
+    handler.handle(record)
+    assert handler.dropped == 1
+
+
+def test_requests_are_traced(stream):
+    app = Flask(__name__)
+    app.config.from_mapping(LOG_LEVELS={"flaskr": "DEBUG"},
+                            LOG_DEBUG_SAMPLE_RATE=1)
+    logs.init_app(app)
+    logs.configure_logging("INFO", {"flaskr": "DEBUG"}, stream=stream)
+    backend = MagicMock()
+    backend.get_wiki_page.side_effect = lambda name: logging.getLogger(
+        "flaskr.backend").info("Read %s", name)
+    async_backend = AsyncProxy(backend)
+
+    @app.route("/pages/<name>")
+    async def page(name):
+        await async_backend.get_wiki_page(name)
+        return "ok"
+
+    trace = "105445aa7843bc8bf206b12000100000"
+    resp = app.test_client().get(
+        "/pages/Mario", headers={"X-Cloud-Trace-Context": trace + "/1;o=1"})
+    assert resp.headers["X-Trace-Id"] == trace
+    resp = app.test_client().get("/pages/Mario",
+                                 headers={"traceparent": "not-a-trace"})
+    assert len(resp.headers["X-Trace-Id"]) == 32
+    assert logs.trace_id.get() is None
+
+    read, done = read_lines(stream)[:2]
+    assert read["message"] == "Read Mario"
+    assert read["trace_id"] == trace
+    assert read["logger"] == "flaskr.backend"
+    assert done["logger"] == "flaskr.requests"
+    assert done["message"] == "GET /pages/Mario 200"
+    assert done["trace_id"] == trace
+    assert done["duration_ms"] >= 0
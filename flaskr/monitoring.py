@@ -0,0 +1,466 @@
+from flask import abort, g, jsonify, request
+from typing import NamedTuple
+from .logs import trace_id
+from .profiling import admin_check
+import collections
+import contextvars
+import itertools
+import threading
+import time
+""" Provides per-route latency SLO monitoring and slow-request capture for the Super Smash Bros. wiki project """
+
+# Histogram buckets per power of two. Values below 2 * SUB_BUCKETS
+# microseconds get a bucket each; above that, every bucket spans 1/16 of
+# its power of two, so a percentile is off by at most 6.25%.
+SUB_BUCKETS = 16
+
+# Latencies are counted up to 2^32 microseconds (about 71 minutes);
+# longer ones go into the last bucket.
+MAX_LATENCY_US = 2**32 - 1
+
+# Burn rates are reported over these windows, in seconds. Burning the
+# error budget 14.4 times faster than sustainable over both spends 2% of
+# a 30-day budget in an hour.
+BURN_RATE_WINDOWS = (300, 3600)
+FAST_BURN_RATE = 14.4
+
+# Methods of Datastore clients, GCS buckets and blobs that make a request;
+# the calls of any other method, such as building a key or adding a filter
+# to a query, are passed through without being traced.
+_IO_METHODS = ('get', 'get_multi', 'put', 'put_multi', 'delete', 'delete_multi',
+               'allocate_ids', 'reserve_ids', 'get_blob', 'delete_blob',
+               'delete_blobs', 'copy_blob', 'exists', 'reload', 'patch',
+               'download_as_bytes', 'download_as_string', 'download_as_text',
+               'download_to_file', 'download_to_filename', 'upload_from_string',
+               'upload_from_file', 'upload_from_filename', 'rewrite', 'compose')
+
+# Methods returning objects that make requests, traced under the name of
+# the blob or kind. get_blob also fetches the blob first.
+_TRACED_FACTORIES = ('blob', 'get_blob', 'query')
+
+# Methods returning iterators that fetch their results a page at a time,
+# as they are iterated; each page fetched is traced as a call.
+_PAGED_METHODS = ('fetch', 'list_blobs')
+
+
+class _Trace:
+    """The backend calls made while handling a request, up to `limit`."""
+
+    def __init__(self, started: float, limit: int) -> None:
+        self.started = started
+        self.limit = limit
+        self.calls = []
+        self.dropped = 0
+
+
+# The `_Trace` of the request being handled, if any.
+backend_calls = contextvars.ContextVar('backend_calls', default=None)
+
+
+class LatencyHistogram:
+    """Counts latencies in log-linear buckets of fixed memory.
+
+    Like an HDR histogram, bucket widths grow with the value, so the
+    relative error of a percentile is bounded however long the tail, with
+    a few hundred counters per histogram.
+    """
+
+    def __init__(self) -> None:
+        self.counts = [0] * (_bucket(MAX_LATENCY_US) + 1)
+        self.count = 0
+        self.max_us = 0
+
+    def record(self, seconds: float) -> None:
+        micros = min(MAX_LATENCY_US, max(0, int(seconds * 1e6)))
+        self.counts[_bucket(micros)] += 1
+        self.count += 1
+        self.max_us = max(self.max_us, micros)
+
+    def percentile(self, percent: float) -> float:
+        """Returns the upper bound, in seconds, of a latency percentile."""
+        if not self.count:
+            return 0.0
+        rank = max(1, -(-self.count * percent // 100))
+        for index, seen in enumerate(itertools.accumulate(self.counts)):
+            if seen >= rank:
+                return min(_upper_bound(index), self.max_us) / 1e6
+        return self.max_us / 1e6
+
+
+class BurnRateCounter:
+    """Counts good and bad requests in per-minute slots over the last hour.
+
+    Attributes:
+        target: A float with the fraction of requests meant to be good.
+    """
+
+    SLOT_SECONDS = 60
+
+    def __init__(self, target: float, clock=time.time) -> None:
+        self.target = target
+        self._clock = clock
+        slots = max(BURN_RATE_WINDOWS) // self.SLOT_SECONDS
+        self._slots = [None] * slots  # slot number, total, bad
+        self._lock = threading.Lock()
+
+    def record(self, bad: bool) -> None:
+        slot = int(self._clock() // self.SLOT_SECONDS)
+        index = slot % len(self._slots)
+        with self._lock:
+            current = self._slots[index]
+            if current is None or current[0] != slot:
+                current = self._slots[index] = [slot, 0, 0]
+            current[1] += 1
+            current[2] += bad
+
+    def burn_rate(self, window: float) -> float:
+        """Returns how many times faster than sustainable the error budget
+        was spent over the last `window` seconds."""
+        oldest = int(self._clock() // self.SLOT_SECONDS) - int(
+            window // self.SLOT_SECONDS)
+        total = bad = 0
+        with self._lock:
+            for current in self._slots:
+                if current is not None and current[0] > oldest:
+                    total += current[1]
+                    bad += current[2]
+        if not total:
+            return 0.0
+        return bad / total / (1 - self.target)
+
+
+class BackendCall(NamedTuple):
+    """A Datastore or GCS call made while handling a request.
+
+    `offset` is the time from the start of the request to the call, and
+    both it and `duration` are in seconds.
+    """
+    operation: str
+    key: str
+    offset: float
+    duration: float
+
+
+class SlowRequest(NamedTuple):
+    """A request that took longer than SLOW_REQUEST_SECONDS."""
+    id: str
+    method: str
+    path: str
+    route: str
+    status: int
+    started: float
+    duration: float
+    trace_id: str
+    calls: list
+    dropped_calls: int
+
+
+class TracedClient:
+    """Records the calls made to a Datastore client or GCS bucket.
+
+    Calls are recorded into the `backend_calls` of the current request,
+    which `AsyncProxy` carries over to executor threads. Blobs and queries
+    the client creates are traced too, since they do the I/O; transaction
+    commits are recorded when their `with` block exits, and query results
+    and blob listings each time they fetch a page.
+
+    Public attributes are read from and written to the traced object, so
+    setting a query's order or a blob's cache control reaches the real one.
+
+    Attributes:
+        target: The client, bucket, blob or query whose calls are traced.
+    """
+
+    def __init__(self, target, service: str, name: str = None) -> None:
+        # Set on the wrapper itself; every other attribute is the target's.
+        object.__setattr__(self, '_target', target)
+        object.__setattr__(self, '_service', service)
+        object.__setattr__(self, '_name', name)
+
+    @property
+    def target(self):
+        return self._target
+
+    def __setattr__(self, name: str, value) -> None:
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._target, name, value)
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self._target, name)
+        if not callable(attribute) or name not in (
+                _IO_METHODS + _TRACED_FACTORIES + _PAGED_METHODS +
+            ('transaction',)):
+            return attribute
+
+        def call(*args, **kwargs):
+            if name == 'transaction':
+                return _TracedTransaction(attribute(*args, **kwargs),
+                                          self._service)
+            key = self._name or _describe(args, kwargs)
+            if name in _PAGED_METHODS:
+                return _TracedPages(attribute(*args, **kwargs),
+                                    f'{self._service}.{name}', key)
+            started = time.perf_counter()
+            try:
+                result = attribute(*args, **kwargs)
+            finally:
+                if name in _IO_METHODS:
+                    _record(f'{self._service}.{name}', key, started)
+            if name in _TRACED_FACTORIES and result is not None:
+                return TracedClient(result, self._service,
+                                    _describe(args, kwargs))
+            return result
+
+        return call
+
+
+class _TracedTransaction:
+    """Records the commit of a transaction as one backend call."""
+
+    def __init__(self, transaction, service: str) -> None:
+        self._transaction = transaction
+        self._service = service
+
+    def __enter__(self):
+        return self._transaction.__enter__()
+
+    def __exit__(self, *exc_info):
+        started = time.perf_counter()
+        try:
+            return self._transaction.__exit__(*exc_info)
+        finally:
+            _record(f'{self._service}.commit', '', started)
+
+
+class _TracedPages:
+    """Records each page a lazy query result or blob listing fetches."""
+
+    def __init__(self, iterator, operation: str, key: str) -> None:
+        self._iterator = iterator
+        self._operation = operation
+        self._key = key
+
+    def __getattr__(self, name: str):
+        return getattr(self._iterator, name)
+
+    def __iter__(self):
+        for page in self.pages:
+            yield from page
+
+    @property
+    def pages(self):
+        pages = iter(self._iterator.pages)
+        while True:
+            started = time.perf_counter()
+            try:
+                page = next(pages)
+            except StopIteration:
+                return
+            except Exception:
+                _record(self._operation, self._key, started)
+                raise
+            _record(self._operation, self._key, started)
+            yield page
+
+
+def _record(operation: str, key: str, started: float) -> None:
+    trace = backend_calls.get()
+    if trace is None:
+        return
+    if len(trace.calls) >= trace.limit:
+        trace.dropped += 1
+        return
+    trace.calls.append(
+        BackendCall(operation, key, started - trace.started,
+                    time.perf_counter() - started))
+
+
+def _describe(args, kwargs) -> str:
+    """Names what a call is about: a key, blob, or number of keys."""
+    subject = args[0] if args else kwargs.get('kind') or kwargs.get('prefix')
+    if isinstance(subject, (list, tuple)):
+        return f'{len(subject)} keys'
+    path = getattr(subject, 'flat_path', None)
+    if path is not None:
+        return '/'.join(str(part) for part in path)
+    return '' if subject is None else str(subject)
+
+
+def trace_backend(backend) -> None:
+    """Traces the Datastore and GCS calls a `Backend` and its `Tracker` make."""
+    for owner, attribute, service in (
+        (backend, 'client', 'datastore'),
+        (backend, 'content_bucket', 'gcs'),
+        (backend.change_log, 'client', 'datastore'),
+        (backend.tracker, 'client', 'datastore'),
+        (backend.tracker.change_log, 'client', 'datastore'),
+    ):
+        target = getattr(owner, attribute)
+        if not isinstance(target, TracedClient):
+            setattr(owner, attribute, TracedClient(target, service))
+
+
+def init_app(app, backend=None, is_admin=None):
+    """Monitors the latency of every route against its SLO.
+
+    Each route gets a latency histogram and a burn-rate counter of its
+    SLO: a request is good when it succeeds within SLO_LATENCY_SECONDS,
+    and SLO_TARGET of them are meant to be, unless SLOS overrides either
+    for the route (keyed by its rule, such as "/search"). Requests slower
+    than SLOW_REQUEST_SECONDS are kept, with the backend calls they made,
+    in a buffer of the last SLOW_REQUEST_BUFFER. Admins can read both at
+    /admin/slo and /admin/slow-requests.
+
+    Args:
+        app: The Flask app to monitor.
+        backend: The `Backend` whose Datastore and GCS calls are traced.
+        is_admin: A function that tells whether the current user is an
+            admin; by default, whether they are logged in as one of ADMINS.
+    """
+    app.config.setdefault('ADMINS', [])
+    app.config.setdefault('SLO_LATENCY_SECONDS', 0.5)
+    app.config.setdefault('SLO_TARGET', 0.99)
+    app.config.setdefault('SLOS', {})
+    app.config.setdefault('SLOW_REQUEST_SECONDS', 1.0)
+    app.config.setdefault('SLOW_REQUEST_BUFFER', 50)
+    app.config.setdefault('MAX_TRACED_CALLS', 200)
+    if is_admin is None:
+        is_admin = admin_check(app)
+    if backend is not None:
+        trace_backend(backend)
+
+    # Route -> (histogram, burn-rate counter, latency SLO, histogram lock).
+    routes = {}
+    routes_lock = threading.Lock()
+    slow_requests = collections.deque(maxlen=app.config['SLOW_REQUEST_BUFFER'])
+    slow_ids = itertools.count(1)
+    app.extensions['slo'] = routes
+    app.extensions['slow_requests'] = slow_requests
+
+    def route_monitor(route):
+        with routes_lock:
+            if route not in routes:
+                slo = app.config['SLOS'].get(route, {})
+                routes[route] = (LatencyHistogram(),
+                                 BurnRateCounter(
+                                     slo.get('target',
+                                             app.config['SLO_TARGET'])),
+                                 slo.get('latency',
+                                         app.config['SLO_LATENCY_SECONDS']),
+                                 threading.Lock())
+            return routes[route]
+
+    @app.before_request
+    def start_monitoring():
+        g.monitor_started = (time.time(), time.perf_counter())
+        g.monitor_token = backend_calls.set(
+            _Trace(g.monitor_started[1], app.config['MAX_TRACED_CALLS']))
+
+    @app.after_request
+    def record_response(response):
+        _finish(response.status_code)
+        return response
+
+    @app.teardown_request
+    def record_failure(exc):
+        _finish(500)
+        token = g.pop('monitor_token', None)
+        if token is not None:
+            backend_calls.reset(token)
+
+    def _finish(status):
+        started = g.pop('monitor_started', None)
+        if started is None:
+            return
+        started_at, start_time = started
+        duration = time.perf_counter() - start_time
+        route = request.url_rule.rule if request.url_rule else '<unmatched>'
+        histogram, burn_rate, latency_slo, lock = route_monitor(route)
+        with lock:
+            histogram.record(duration)
+        burn_rate.record(status >= 500 or duration > latency_slo)
+        if duration < app.config['SLOW_REQUEST_SECONDS']:
+            return
+        trace = backend_calls.get() or _Trace(start_time, 0)
+        slow_requests.append(
+            SlowRequest(str(next(slow_ids)), request.method, request.full_path,
+                        route, status, started_at, duration, trace_id.get(),
+                        list(trace.calls), trace.dropped))
+
+    @app.route('/admin/slo')
+    def slo_report():
+        """Reports each route's latency percentiles and SLO burn rates."""
+        if not is_admin():
+            abort(403)
+        with routes_lock:
+            monitored = dict(routes)
+        report = {}
+        for route, (histogram, burn_rate, latency_slo,
+                    lock) in sorted(monitored.items()):
+            with lock:
+                percentiles = {
+                    f'p{percent}': histogram.percentile(percent)
+                    for percent in (50, 90, 99, 99.9)
+                }
+                count, max_seconds = histogram.count, histogram.max_us / 1e6
+            burn_rates = {
+                f'{window}s': burn_rate.burn_rate(window)
+                for window in BURN_RATE_WINDOWS
+            }
+            report[route] = dict(
+                percentiles,
+                count=count,
+                max=max_seconds,
+                slo_latency=latency_slo,
+                slo_target=burn_rate.target,
+                burn_rates=burn_rates,
+                fast_burn=all(
+                    rate >= FAST_BURN_RATE for rate in burn_rates.values()))
+        return jsonify(report)
+
+    @app.route('/admin/slow-requests')
+    def list_slow_requests():
+        """Lists the captured slow requests, newest first."""
+        if not is_admin():
+            abort(403)
+        return jsonify([
+            _slow_request_json(slow, with_calls=False)
+            for slow in reversed(slow_requests)
+        ])
+
+    @app.route('/admin/slow-requests/<request_id>')
+    def show_slow_request(request_id):
+        """Shows a captured slow request with its backend calls."""
+        if not is_admin():
+            abort(403)
+        for slow in list(slow_requests):
+            if slow.id == request_id:
+                return jsonify(_slow_request_json(slow, with_calls=True))
+        abort(404)
+
+
+def _slow_request_json(slow: SlowRequest, with_calls: bool) -> dict:
+    entry = slow._asdict()
+    calls = entry.pop('calls')
+    entry['call_count'] = len(calls)
+    if with_calls:
+        entry['calls'] = [call._asdict() for call in calls]
+    return entry
+
+
+def _bucket(micros: int) -> int:
+    """Returns the index of the histogram bucket counting a value."""
+    if micros < 2 * SUB_BUCKETS:
+        return micros
+    shift = micros.bit_length() - SUB_BUCKETS.bit_length()
+    return shift * SUB_BUCKETS + (micros >> shift)
+
+
+def _upper_bound(index: int) -> int:
+    """Returns the largest value counted by a histogram bucket."""
+    if index < 2 * SUB_BUCKETS:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    return ((index - shift * SUB_BUCKETS + 1) << shift) - 1
@@ -0,0 +1,181 @@
+import pytest
+from flask import Flask
+from google.cloud import datastore
+from unittest.mock import MagicMock
+from . import images
+from .backend import Backend
+from .changes import ChangeLog
+from .monitoring import BurnRateCounter, LatencyHistogram, TracedClient, _Trace, _bucket, _upper_bound, backend_calls, init_app
+from .tracker import Tracker
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    app.config.from_mapping(TESTING=True,
+                            SLOW_REQUEST_SECONDS=0,
+                            SLOW_REQUEST_BUFFER=3,
+                            MAX_TRACED_CALLS=2,
+                            SLOS={"/search": {
+                                "latency": 0,
+                                "target": 0.9
+                            }})
+    app.admin = True
+    app.backend = Backend(Tracker(MagicMock(), MagicMock()), MagicMock(),
+                          MagicMock(), MagicMock())
+    init_app(app, app.backend, is_admin=lambda: app.admin)
+
+    @app.route("/pages/<name>")
+    def page(name):
+        app.backend.client.get(datastore.Key("Character", name, project="wiki"))
+        blob = app.backend.content_bucket.get_blob("character-images/" + name)
+        blob.download_as_bytes()
+        return name
+
+    @app.route("/search")
+    def search():
+        return "results"
+
+    return app
+
+
+def test_histogram_buckets_are_contiguous():
+    for micros in range(1, 100000):
+        index = _bucket(micros)
+        assert index in (_bucket(micros - 1), _bucket(micros - 1) + 1)
+        assert _upper_bound(index - 1) < micros <= _upper_bound(index)
+
+
+def test_histogram_percentiles():
+    histogram = LatencyHistogram()
+    for millis in range(1, 1001):
+        histogram.record(millis / 1000)
+    assert histogram.count == 1000
+    assert histogram.percentile(50) == pytest.approx(0.5, rel=1 / 16)
+    assert histogram.percentile(99) == pytest.approx(0.99, rel=1 / 16)
+    assert histogram.percentile(100) == 1.0
+    assert LatencyHistogram().percentile(99) == 0
+
+
+def test_burn_rate_windows():
+    now = [0]
+    counter = BurnRateCounter(0.99, clock=lambda: now[0])
+    for bad in [True] + [False] * 9:
+        counter.record(bad)
+    assert counter.burn_rate(300) == pytest.approx(10)
+
+    # An hour later, the old minute's requests have left both windows.
+    now[0] = 3600
+    counter.record(False)
+    assert counter.burn_rate(300) == 0
+    assert counter.burn_rate(3600) == 0
+
+
+def test_slo_report(app):
+    client = app.test_client()
+    client.get("/search")
+    client.get("/pages/Mario")
+    client.get("/pages/Link")
+
+    report = client.get("/admin/slo").get_json()
+    assert report["/pages/<name>"]["count"] == 2
+    assert report["/pages/<name>"]["slo_latency"] == 0.5
+    assert report["/pages/<name>"]["burn_rates"]["300s"] == 0
+    # Every search is slower than its SLO of no latency at all.
+    assert report["/search"]["slo_target"] == 0.9
+    assert report["/search"]["burn_rates"]["300s"] == pytest.approx(10)
+    assert report["/search"]["fast_burn"] is False
+
+
+def test_slow_requests_keep_their_backend_calls(app):
+    client = app.test_client()
+    client.get("/search")
+    client.get("/pages/Mario")
+    client.get("/pages/Link")
+    client.get("/search")
+
+    # Only the last SLOW_REQUEST_BUFFER requests are kept, newest first.
+    listed = client.get("/admin/slow-requests").get_json()
+    assert [slow["path"] for slow in listed
+           ] == ["/search?", "/pages/Link?", "/pages/Mario?"]
+    assert "calls" not in listed[0]
+
+    slow = client.get(f"/admin/slow-requests/{listed[1]['id']}").get_json()
+    assert slow["route"] == "/pages/<name>"
+    assert slow["status"] == 200
+    assert [(call["operation"], call["key"]) for call in slow["calls"]] == [
+        ("datastore.get", "Character/Link"),
+        ("gcs.get_blob", "character-images/Link"),
+    ]
+    assert all(call["duration"] >= 0 for call in slow["calls"])
+    # The blob download went over MAX_TRACED_CALLS.
+    assert slow["dropped_calls"] == 1
+
+    assert client.get("/admin/slow-requests/99").status_code == 404
+
+
+def test_calls_outside_requests_are_not_recorded():
+    client = MagicMock()
+    traced = TracedClient(client, "datastore")
+    traced.get("key")
+    client.get.assert_called_once_with("key")
+
+
+def test_each_page_of_lazy_results_is_recorded():
+    client = MagicMock()
+    client.query.return_value.fetch.return_value.pages = [["Mario", "Luigi"],
+                                                          ["Link"]]
+    bucket = MagicMock()
+    bucket.list_blobs.return_value.pages = [["authors/noel.png"]]
+    trace = _Trace(0, 10)
+    token = backend_calls.set(trace)
+    try:
+        results = TracedClient(client,
+                               "datastore").query(kind="Character").fetch()
+        # Nothing is fetched until the results are iterated.
+        assert trace.calls == []
+        assert list(results) == ["Mario", "Luigi", "Link"]
+        blobs = TracedClient(bucket, "gcs").list_blobs(prefix="authors/")
+        assert [len(page) for page in blobs.pages] == [1]
+    finally:
+        backend_calls.reset(token)
+    assert [(call.operation, call.key) for call in trace.calls] == [
+        ("datastore.fetch", "Character"),
+        ("datastore.fetch", "Character"),
+        ("gcs.list_blobs", "authors/"),
+    ]
+
+
+def test_attributes_are_set_on_the_traced_objects():
+    client = MagicMock()
+    query = client.query.return_value
+    query.fetch.return_value.pages = [[{"seq": "2"}, {"seq": "1"}]]
+    trace = _Trace(0, 10)
+    token = backend_calls.set(trace)
+    try:
+        change_log = ChangeLog(TracedClient(client, "datastore"))
+        assert change_log.read_recent(MagicMock()) == [{
+            "seq": "1"
+        }, {
+            "seq": "2"
+        }]
+    finally:
+        backend_calls.reset(token)
+    assert query.order == ["-time"]
+    # Building the query makes no request, so only the fetch is recorded.
+    assert [call.operation for call in trace.calls] == ["datastore.fetch"]
+
+    bucket = MagicMock()
+    backend = Backend(MagicMock(), MagicMock(), TracedClient(bucket, "gcs"),
+                      MagicMock())
+    backend.client.get.return_value = None
+    backend.store_image(b"\x89PNG\r\n\x1a\nsprite")
+    assert bucket.blob.return_value.cache_control == images.IMMUTABLE_CACHE_CONTROL
+
+
+def test_only_admins_can_read_the_monitors(app):
+    app.admin = False
+    client = app.test_client()
+    assert client.get("/admin/slo").status_code == 403
+    assert client.get("/admin/slow-requests").status_code == 403
+    assert client.get("/admin/slow-requests/1").status_code == 403
@@ -0,0 +1,67 @@
+import collections
+import threading
+import time
+""" Provides read-your-writes overlays of recent writes for the Super Smash Bros. wiki project """
+
+
+class WriteOverlay:
+    """Remembers what a session just wrote to a page, until its next render.
+
+    After a write, the route redirects to the page it changed. The values
+    the write returned (such as the page's comments or upvote count) are
+    recorded here under the writer's session, and the page's next render
+    for that session uses them instead of reading the entities again, so
+    the writer sees their write even if a cache or a query lags behind.
+    Entries are used once, and expire after `ttl` seconds in case the
+    redirect is never followed or is served by another instance.
+
+    Attributes:
+        ttl:
+            A float with the number of seconds an entry is kept.
+        max_entries:
+            An integer with the number of entries kept before the least
+            recently written ones are dropped.
+    """
+
+    def __init__(self,
+                 ttl: float = 30.0,
+                 max_entries: int = 10000,
+                 clock=time.monotonic) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._clock = clock
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def record(self, session_id: str, page_name: str, **fields) -> None:
+        """Records the values of a write, merged with earlier unread ones."""
+        key = (session_id, page_name)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < self._clock():
+                entry = (0, {})
+            self._entries[key] = (self._clock() + self.ttl,
+                                  dict(entry[1], **fields))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pending(self, session_id: str, page_name: str) -> bool:
+        """Tells whether a session has unread writes to a page."""
+        with self._lock:
+            entry = self._entries.get((session_id, page_name))
+            return entry is not None and entry[0] >= self._clock()
+
+    def pop(self, session_id: str, page_name: str) -> dict:
+        """Returns and forgets a session's unread writes to a page.
+
+        Returns:
+            A dictionary with the written values, empty if there are none.
+        """
+        with self._lock:
+            entry = self._entries.pop((session_id, page_name), None)
+        if entry is None or entry[0] < self._clock():
+            return {}
+        return entry[1]
@@ -0,0 +1,46 @@
+from .overlay import WriteOverlay
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_writes_are_merged_and_read_once():
+    overlay = WriteOverlay()
+    overlay.record("session1", "Mario", upvotes=3)
+    overlay.record("session1", "Mario", comments=["Wahoo!"])
+    assert overlay.pending("session1", "Mario")
+    assert not overlay.pending("session2", "Mario")
+    assert not overlay.pending("session1", "Luigi")
+
+    assert overlay.pop("session1", "Mario") == {
+        "upvotes": 3,
+        "comments": ["Wahoo!"]
+    }
+    assert overlay.pop("session1", "Mario") == {}
+    assert not overlay.pending("session1", "Mario")
+
+
+def test_writes_expire():
+    clock = FakeClock()
+    overlay = WriteOverlay(ttl=10, clock=clock)
+    overlay.record("session1", "Mario", upvotes=3)
+    clock.now = 11
+    assert not overlay.pending("session1", "Mario")
+    # An expired entry's values are not merged into new writes.
+    overlay.record("session1", "Mario", comments=[])
+    assert overlay.pop("session1", "Mario") == {"comments": []}
+
+
+def test_overlay_is_bounded():
+    overlay = WriteOverlay(max_entries=2)
+    for page_name in ("Mario", "Luigi", "Peach"):
+        overlay.record("session1", page_name, upvotes=1)
+    assert len(overlay) == 2
+    assert overlay.pop("session1", "Mario") == {}
+    assert overlay.pop("session1", "Peach") == {"upvotes": 1}
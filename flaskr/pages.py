@@ -1,8 +1,23 @@
-from flask import Flask, render_template, url_for, redirect, flash, request
-from flask_login import LoginManager, login_required, login_user, current_user, logout_user
+from flask import Flask, render_template, url_for, redirect, flash, request, session, make_response, abort
+from flask_login import LoginManager, UserMixin, login_required, login_user, current_user, logout_user
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField, FileField, TextAreaField
 from wtforms.validators import InputRequired
+from concurrent.futures import ThreadPoolExecutor
+from .aio import AsyncProxy
+from .cache import PageCache
+from .changes import ChangeFeed
+from .images import IMAGE_NAME, IMMUTABLE_CACHE_CONTROL, content_type
+from .limits import RateLimiter, SingleFlight
+from .listings import WorldListings
+from .overlay import WriteOverlay
+from .trending import TrendingPages
+import asyncio
+import functools
+import hashlib
+import math
+import secrets
+import time
 
 
 class SignupForm(FlaskForm):
@@ -23,73 +38,254 @@ class LoginForm(FlaskForm):
     submit = SubmitField("Log In")
 
 
-class User():
-    """Current user in session."""
+class EditPageForm(FlaskForm):
+    """Generates form and stores form data for editing a wiki page."""
+    info = TextAreaField()
+    world = StringField()
+    submit = SubmitField("Save")
 
-    def __init__(self, username, active=False):
-        self.username = username
-        self.active = active
 
-    def is_active(self):
-        return self.active
+class DeletePageForm(FlaskForm):
+    """Generates form for deleting a wiki page, carrying only its CSRF token."""
+    submit = SubmitField("Delete page")
+
 
-    def is_authenticated(self):
-        return True
+class User(UserMixin):
+    """User in session, loaded from the signed session cookie on each request."""
+
+    def __init__(self, username):
+        self.username = username
 
     def get_id(self):
         return self.username
 
 
-user = User(None)  # /login will update this with current user in session.
+def make_endpoints(app, backend):
 
+    # Async handlers await backend calls that run in this bounded thread pool.
+    async_backend = AsyncProxy(
+        backend,
+        ThreadPoolExecutor(max_workers=app.config.get("BACKEND_IO_WORKERS", 64),
+                           thread_name_prefix="backend-io"))
+    app.extensions["async_backend"] = async_backend
 
-def make_endpoints(app, backend):
+    # Rendered pages served to anonymous visitors, purged by surrogate key on writes.
+    page_cache = PageCache(app.config.get("PAGE_CACHE_SIZE", 256))
+    app.extensions["page_cache"] = page_cache
+
+    # Upvotes and comments decay with this half-life in the trending ranking.
+    trending_half_life = app.config.get("TRENDING_HALF_LIFE_HOURS", 24) * 3600
+    trending_size = app.config.get("TRENDING_SIZE", 10)
+    trending = TrendingPages(trending_half_life)
+    app.extensions["trending"] = trending
+
+    # Writes made by other instances reach this one through the change-feed.
+    # Older events weigh under 1% of new ones, so up to 7 half-lives are
+    # replayed, but no more than TRENDING_REPLAY_HOURS.
+    replay_seconds = min(7 * trending_half_life,
+                         app.config.get("TRENDING_REPLAY_HOURS", 72) * 3600)
+    change_feed = ChangeFeed(backend.change_log,
+                             app.config.get("CHANGE_FEED_POLL_SECONDS", 5),
+                             replay_seconds=replay_seconds)
+    app.extensions["change_feed"] = change_feed
+
+    def purge_changed_pages(change):
+        if change["action"] in ("upload", "edit", "delete"):
+            worlds = {change.get("world"), change.get("old_world")} - {None}
+            page_cache.purge("page:" + change["page"], "worlds",
+                             *("world:" + world for world in worlds))
+        else:
+            page_cache.purge("page:" + change["page"])
+
+    def update_trending(change):
+        top_pages = trending.top(trending_size)
+        trending.apply_change(change)
+        if trending.top(trending_size) != top_pages:
+            page_cache.purge("trending")
+
+    # Uploads are added to the listings before the pages listing them are
+    # purged, so a render in between cannot cache the old listing.
+    listings = WorldListings(backend)
+    app.extensions["listings"] = listings
+    listings_refresh = app.config.get("LISTINGS_REFRESH_SECONDS", 3600)
+    if listings_refresh:
+        listings.start(listings_refresh,
+                       on_rebuild=lambda: page_cache.purge("worlds"))
+
+    change_feed.subscribe(listings.apply_change)
+    change_feed.subscribe(purge_changed_pages)
+    change_feed.subscribe(update_trending)
+
+    # A session's own comments and upvotes are shown on the redirect that
+    # follows them without reading them back.
+    write_overlay = WriteOverlay(app.config.get("READ_YOUR_WRITES_TTL", 30))
+    app.extensions["write_overlay"] = write_overlay
+
+    def writer_session_id(create=False):
+        """Returns the id the session's writes are recorded under."""
+        if create and "writer_id" not in session:
+            session["writer_id"] = secrets.token_hex(8)
+        return session.get("writer_id")
+
+    @app.before_request
+    def poll_change_feed():
+        if change_feed.interval:
+            change_feed.poll()
+
+    def cached_page(surrogate_keys, version=None):
+        """Serves a route's rendered HTML from the page cache when possible.
+
+        Only anonymous GET requests without pending flash messages are
+        cached, since those are the only renders shared between visitors.
+
+        Routes with a version also answer `If-None-Match` revalidations
+        without rendering. The ETag combines the route's version token with
+        the user in session, since the rendered page differs between
+        visitors, and is compared weakly, as compressed responses carry it
+        as a weak ETag. Cached pages keep the ETag they were rendered with,
+        so hits are answered without asking the backend for the version.
+
+        Args:
+            surrogate_keys: A function that takes the route's arguments and
+                returns the surrogate keys to tag the rendered page with.
+            version: A function that takes the route's arguments and
+                returns a version token, or None if it cannot be computed.
+        """
+
+        def decorator(view):
+
+            @functools.wraps(view)
+            def wrapper(**kwargs):
+                # A version read back from the Datastore could predate the
+                # session's own unread writes.
+                if (request.method != "GET" or "_flashes" in session or
+                        write_overlay.pending(writer_session_id(),
+                                              kwargs.get("page_name"))):
+                    return app.ensure_sync(view)(**kwargs)
+                cacheable = not current_user.is_authenticated
+                cache_key = request.full_path
+                cached = page_cache.lookup(cache_key) if cacheable else None
+                if cached is not None:
+                    return _conditional_response(cached.html, cached.etag)
+                etag = None
+                token = version(**kwargs) if version is not None else None
+                if token is not None:
+                    etag = hashlib.blake2b(
+                        f"{token}|{current_user.get_id()}".encode(),
+                        digest_size=16).hexdigest()
+                    if request.if_none_match.contains_weak(etag):
+                        return _conditional_response(None, etag)
+                html = app.ensure_sync(view)(**kwargs)
+                if cacheable and isinstance(html, str):
+                    page_cache.set(cache_key, html, surrogate_keys(**kwargs),
+                                   etag)
+                return _conditional_response(html, etag)
+
+            return wrapper
+
+        return decorator
+
+    # Identical in-flight backend computations are shared between requests.
+    single_flight = SingleFlight()
+    rate_limiter = RateLimiter(
+        app.config.get("RATE_LIMITS", {
+            "search": (5, 20),
+            "about": (5, 20)
+        }))
+
+    def rate_limited(route):
+        """Rejects a client's requests to a route beyond its token-bucket limit.
+
+        Clients are told when to retry with a 429 response and a Retry-After
+        header. Logged-in users are limited per username, others per address.
+
+        Args:
+            route: A string with the name the route's limit is configured under.
+        """
+
+        def decorator(view):
+
+            @functools.wraps(view)
+            def wrapper(**kwargs):
+                client = current_user.get_id() or request.remote_addr
+                retry_after = rate_limiter.check(route, client)
+                if retry_after:
+                    response = make_response("Too many requests", 429)
+                    response.headers["Retry-After"] = str(
+                        math.ceil(retry_after))
+                    return response
+                return app.ensure_sync(view)(**kwargs)
+
+            return wrapper
+
+        return decorator
 
     # Initiates login_manager for session handling.
     login_manager = LoginManager()
     login_manager.init_app(app)
     login_manager.login_view = "login"
 
+    # Seconds a user-record lookup is reused before Datastore is asked again.
+    user_lookup_ttl = app.config.get("USER_LOOKUP_TTL", 60)
+
+    @functools.lru_cache(maxsize=1024)
+    def user_exists(username, ttl_bucket):
+        # `ttl_bucket` changes every `user_lookup_ttl` seconds, expiring the entry.
+        return backend.user_exists(username)
+
     @login_manager.user_loader
     def load_user(username):
-        return user
+        ttl_bucket = int(time.monotonic() // user_lookup_ttl)
+        return User(username) if user_exists(username, ttl_bucket) else None
 
     @app.route('/', methods=["GET"])
     @app.route("/home", methods=["GET"])
     def home():
         """Renders the home/landing page when the page is accessed."""
         return render_template("main.html",
-                               active=user.active,
-                               name=user.get_id())
+                               trending=trending.top(trending_size),
+                               active=current_user.is_authenticated,
+                               name=current_user.get_id())
 
     @app.route("/about")
+    @rate_limited("about")
+    @cached_page(lambda: ["authors"])
     def about():
         """Renders authors' images and information."""
-        authors_list = backend.get_authors()
+        authors_list = single_flight.do("authors", backend.get_authors)
         return render_template("about.html",
                                authors_list=authors_list,
-                               active=user.active,
-                               name=user.get_id())
+                               active=current_user.is_authenticated,
+                               name=current_user.get_id())
 
     # when the "pages" button is clicked, we change templates
     @app.route("/pages")
+    @cached_page(
+        lambda:
+        ["worlds", "world:" + request.args.get("world", "All"), "trending"])
     def pages():
         """Renders the page index for wiki pages."""
         selected_world = request.args.get("world", "All")
-        name_list = backend.get_characters_by_world(selected_world)
-        worlds = backend.get_worlds()
         return render_template("pages.html",
-                               name_list=name_list,
-                               worlds=worlds,
+                               name_list=listings.characters(selected_world),
+                               trending=trending.top(trending_size),
+                               worlds=listings.worlds(),
+                               world_counts=listings.counts(),
                                selected_world=selected_world,
-                               active=user.active,
-                               name=user.get_id())
+                               active=current_user.is_authenticated,
+                               name=current_user.get_id())
 
     @app.route("/pages/<page_name>/comment", methods=["GET", "POST"])
     def commenting_page(page_name):
-        if user.active:
-            backend.tracker.add_comment(page_name, user.get_id(),
-                                        request.form["comment"])
+        if current_user.is_authenticated:
+            comments = backend.tracker.add_comment(page_name,
+                                                   current_user.get_id(),
+                                                   request.form["comment"])
+            page_cache.purge("page:" + page_name)
+            if comments is not None:
+                write_overlay.record(writer_session_id(create=True),
+                                     page_name,
+                                     comments=comments)
             flash("Comment posted successfully!")
         else:
             flash("You need to be logged in to leave a comment.")
@@ -97,32 +293,123 @@ def make_endpoints(app, backend):
 
     @app.route("/pages/<page_name>/upvote", methods=["GET", "POST"])
     def upvoting_page(page_name):
-        if user.active:
-            backend.tracker.upvote_page(page_name, user.get_id())
+        if current_user.is_authenticated:
+            upvote = backend.tracker.toggle_upvote(page_name,
+                                                   current_user.get_id())
+            page_cache.purge("page:" + page_name)
+            write_overlay.record(writer_session_id(create=True),
+                                 page_name,
+                                 upvotes=upvote.upvotes)
         else:
             flash("You need to be logged in to upvote a page.")
         return redirect(url_for("show_character_info", page_name=page_name))
 
     @app.route("/pages/<page_name>")
-    def show_character_info(page_name):
+    @cached_page(lambda page_name: ["page:" + page_name],
+                 version=lambda page_name: backend.get_page_version(page_name))
+    async def show_character_info(page_name):
         """Renders specific (clicked) wiki page based on page_name."""
-        page_content = backend.get_wiki_page(page_name)
-        character_name, description, world, = page_content.split('|', 3)
-        page_image = backend.get_image("character-images/", page_name)
-        comments = backend.tracker.get_comments(character_name)
-        comments = comments if comments else {}
-        upvotes = backend.tracker.get_upvotes(character_name)
-        uploader = backend.tracker.get_page_uploader(character_name)
+        # Values the session just wrote are used instead of being read back.
+        written = write_overlay.pop(writer_session_id(), page_name)
+        # The page's backend calls are independent, so they run concurrently.
+        character, comments, upvotes, uploader = await asyncio.gather(
+            async_backend.get_wiki_page(page_name),
+            _resolved(written["comments"]) if "comments" in written else
+            async_backend.tracker.get_comments(page_name),
+            _resolved(written["upvotes"]) if "upvotes" in written else
+            async_backend.tracker.get_upvotes(page_name),
+            async_backend.tracker.get_page_uploader(page_name))
+        if character is None:
+            abort(404)
+        edit_form, delete_form = None, None
+        if can_edit(uploader):
+            edit_form = EditPageForm(info=character.info, world=character.world)
+            delete_form = DeletePageForm()
+        # Content-addressed images are linked so browsers can cache them;
+        # legacy images are inlined.
+        image_url, page_image = None, None
+        if character.image:
+            image_url = url_for("show_image", image_name=character.image)
+        else:
+            page_image = await async_backend.get_image("character-images/",
+                                                       page_name)
         return render_template("page.html",
-                               character_name=character_name,
-                               description=description,
+                               character_name=character.name,
+                               description=character.info,
                                comments=comments,
                                upvotes=upvotes,
                                uploader=uploader,
+                               image_url=image_url,
                                page_image=page_image,
-                               world=world,
-                               active=user.active,
-                               name=user.get_id())
+                               world=character.world,
+                               edit_form=edit_form,
+                               delete_form=delete_form,
+                               active=current_user.is_authenticated,
+                               name=current_user.get_id())
+
+    def can_edit(uploader):
+        """Tells whether the current user may edit a page with an uploader."""
+        return current_user.is_authenticated and (
+            current_user.get_id() == uploader or
+            current_user.get_id() in app.config.get("ADMINS", []))
+
+    def apply_local_change(change):
+        """Applies a change made by this instance before the feed sees it."""
+        listings.apply_change(change)
+        purge_changed_pages(change)
+        update_trending(change)
+
+    @app.route("/pages/<page_name>/edit", methods=["POST"])
+    @login_required
+    def edit_page(page_name):
+        """Edits a page's info or world; only its uploader or admins may."""
+        form = EditPageForm()
+        if not form.validate_on_submit():
+            flash("The form expired, please try again.")
+            return redirect(url_for("show_character_info", page_name=page_name))
+        if not can_edit(backend.tracker.get_page_uploader(page_name)):
+            abort(403)
+        delta = backend.edit_page(page_name,
+                                  info=form.info.data or None,
+                                  world=form.world.data or None,
+                                  editor=current_user.get_id())
+        if delta is None:
+            abort(404)
+        apply_local_change(delta.as_change("edit"))
+        flash("Page updated!")
+        return redirect(url_for("show_character_info", page_name=page_name))
+
+    @app.route("/pages/<page_name>/delete", methods=["POST"])
+    @login_required
+    def delete_page(page_name):
+        """Deletes a page; only its uploader or admins may."""
+        if not DeletePageForm().validate_on_submit():
+            flash("The form expired, please try again.")
+            return redirect(url_for("show_character_info", page_name=page_name))
+        if not can_edit(backend.tracker.get_page_uploader(page_name)):
+            abort(403)
+        delta = backend.delete_page(page_name, user=current_user.get_id())
+        if delta is None:
+            abort(404)
+        apply_local_change(delta.as_change("delete"))
+        flash(f"Deleted {page_name}.")
+        return redirect(url_for("pages"))
+
+    @app.route("/images/<image_name>")
+    def show_image(image_name):
+        """Serves a content-addressed image, cacheable forever."""
+        if not IMAGE_NAME.fullmatch(image_name):
+            abort(404)
+        image_data = backend.get_image_data(image_name)
+        if image_data is None:
+            abort(404)
+        response = make_response(image_data)
+        response.mimetype = content_type(image_name)
+        # Browsers must not guess a type that could run scripts.
+        response.headers["X-Content-Type-Options"] = "nosniff"
+        response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+        response.set_etag(image_name)
+        return response.make_conditional(request)
 
     @app.route("/signup", methods=["GET", "POST"])
     def sign_up():
@@ -135,11 +422,12 @@ def make_endpoints(app, backend):
             if not check:
                 flash("Username already exists. Please choose another one.")
             else:
+                page_cache.purge("users")
                 return redirect(url_for("login"))
         return render_template("register.html",
                                form=form,
-                               active=user.active,
-                               name=user.get_id())
+                               active=current_user.is_authenticated,
+                               name=current_user.get_id())
 
     @app.route("/login", methods=["GET", "POST"])
     def login():
@@ -154,20 +442,17 @@ def make_endpoints(app, backend):
             elif check == False:
                 flash("Wrong credentials. Try again.")
             else:
-                user.username = username
-                user.active = True
-                login_user(user)
+                login_user(User(username))
                 return redirect(url_for("home"))
         return render_template("login.html",
                                form=form,
-                               active=user.active,
-                               name=user.get_id())
+                               active=current_user.is_authenticated,
+                               name=current_user.get_id())
 
     @app.route("/logout", methods=["GET", "POST"])
     @login_required
     def logout():
         """Handles the log out process for logged-in users."""
-        user.active = False
         logout_user()
         return redirect(url_for("login"))
 
@@ -198,14 +483,29 @@ def make_endpoints(app, backend):
                 checker = False
                 flash('Incorrect File Type')
             if checker:
-                backend.upload(user.get_id(), file, name, info, world)
-        worlds = backend.get_worlds()
+                try:
+                    similar_pages = backend.upload(current_user.get_id(), file,
+                                                   name, info, world)
+                except ValueError:
+                    flash('Incorrect File Type')
+                    return redirect(url_for("upload_file"))
+                listings.apply_change({
+                    "action": "upload",
+                    "page": name,
+                    "world": world
+                })
+                page_cache.purge("page:" + name, "world:" + world, "worlds")
+                if similar_pages:
+                    flash("The image looks like the one on: " +
+                          ", ".join(similar_pages))
+        worlds = listings.worlds()
         return render_template("upload.html",
                                worlds=worlds,
-                               active=user.active,
-                               name=user.get_id())
+                               active=current_user.is_authenticated,
+                               name=current_user.get_id())
 
     @app.route("/search", methods=["GET", "POST"])
+    @rate_limited("search")
     def search_results():
         """Renders the search results when a user inputs a query."""
         if request.method == 'POST':
@@ -213,39 +513,69 @@ def make_endpoints(app, backend):
             if query == "":
                 flash("Please enter text in the Search Bar")
             else:
-                matching_names = backend.get_query_pages(query)
-                matching_names = backend.rank_pages(matching_names)
+                matching_names = single_flight.do(
+                    ("search", query),
+                    lambda: backend.rank_pages(backend.get_query_pages(query)))
             return render_template("results.html",
                                    query=query,
-                                   active=user.active,
-                                   name=user.get_id(),
+                                   active=current_user.is_authenticated,
+                                   name=current_user.get_id(),
                                    matching_names=matching_names)
         else:
             return render_template(
                 "results.html",
                 query="",  # Placeholder value
-                active=user.active,
-                name=user.get_id(),
+                active=current_user.is_authenticated,
+                name=current_user.get_id(),
                 matching_names=[None])  # Placeholder value
 
     @app.route('/users')
+    @cached_page(lambda: ["users"])
     def users():
         # Retrieve the list of users here
         users_list = backend.get_all_usernames()
         return render_template('users.html',
                                users=users_list,
-                               active=user.active,
-                               name=user.get_id())
+                               active=current_user.is_authenticated,
+                               name=current_user.get_id())
 
     @app.route('/users/<username>')
-    def user_contributions(username):
-        uploaded_pages = backend.get_uploaded_pages(username)
-        comments = backend.get_user_comments(username, uploaded_pages)
-        total_upvotes = backend.tracker.get_upvotes(username)
+    async def user_contributions(username):
+
+        async def get_contributions():
+            uploaded_pages = await async_backend.get_uploaded_pages(username)
+            comments = await async_backend.get_user_comments(
+                username, uploaded_pages)
+            return uploaded_pages, comments
+
+        (uploaded_pages, comments), total_upvotes = await asyncio.gather(
+            get_contributions(), async_backend.tracker.get_upvotes(username))
         return render_template('contributions.html',
                                username=username,
                                uploaded_pages=uploaded_pages,
                                comments=comments,
                                total_upvotes=total_upvotes,
-                               active=user.active,
-                               name=user.get_id())
+                               active=current_user.is_authenticated,
+                               name=current_user.get_id())
+
+
+def _conditional_response(html, etag):
+    """Returns rendered HTML, or a 304 if the client has its ETag.
+
+    Pages without an ETag are returned as they are; pages with one are
+    revalidated on every use.
+    """
+    if etag is None:
+        return html
+    if request.if_none_match.contains_weak(etag):
+        response = make_response("", 304)
+    else:
+        response = make_response(html)
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+async def _resolved(value):
+    """Returns a value from a coroutine, to gather it with backend calls."""
+    return value
@@ -1,4 +1,9 @@
-from flaskr import create_app
+import io, re
+from flaskr import create_app, pages
+from flaskr.changes import seq_at
+from flask import Flask
+from unittest.mock import MagicMock
+from flaskr.records import Character, Comment, IndexDelta, UpvoteResult, WorldListing
 import pytest
 
 
@@ -50,7 +55,11 @@ def test_about_page(client):
     assert b"About" in resp.data
 
 
-def test_pages_page(client):
+def test_pages_page(app, client):
+    # No listing has been stored yet, so it is built from the World kind.
+    backend = app.extensions["listings"].backend
+    # The client is wrapped to trace its calls for slow-request capture.
+    backend.client.target.get.return_value = None
     resp = client.get("/pages")
     assert resp.status_code == 200
     assert b"Pages" in resp.data
@@ -86,3 +95,371 @@ def test_users_page(client):
     resp = client.get("/users")
     assert resp.status_code == 200
     assert b"Users" in resp.data
+
+
+def test_about_page_is_cached(app, client):
+    first = client.get("/about")
+    second = client.get("/about")
+    assert first.data == second.data
+    assert len(app.extensions["page_cache"]) == 1
+
+    app.extensions["page_cache"].purge("authors")
+    assert len(app.extensions["page_cache"]) == 0
+
+
+@pytest.fixture
+def mock_backend():
+    backend = MagicMock()
+    backend.get_wiki_page.return_value = Character("Mario", "Plumber",
+                                                   "Super Mario Bros.")
+    backend.get_image.return_value = ""
+    backend.tracker.get_comments.return_value = []
+    backend.tracker.get_upvotes.return_value = 0
+    backend.tracker.get_page_uploader.return_value = "sebagabs"
+    backend.get_page_version.return_value = "v1"
+    return backend
+
+
+@pytest.fixture
+def mock_client(mock_backend):
+    app = Flask("flaskr")
+    app.config.from_mapping(SECRET_KEY="dev",
+                            TESTING=True,
+                            WTF_CSRF_ENABLED=False)
+    pages.make_endpoints(app, mock_backend)
+    return app.test_client()
+
+
+def test_character_page_conditional_get(mock_client, mock_backend):
+    resp = mock_client.get("/pages/Mario")
+    assert resp.status_code == 200
+    assert b"Plumber" in resp.data
+    etag = resp.headers["ETag"]
+
+    # Cached pages are served, and revalidated, from the page cache alone.
+    mock_backend.reset_mock()
+    resp = mock_client.get("/pages/Mario", headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+    assert resp.data == b""
+    resp = mock_client.get("/pages/Mario")
+    assert resp.status_code == 200
+    assert resp.headers["ETag"] == etag
+    mock_backend.get_wiki_page.assert_not_called()
+    mock_backend.get_page_version.assert_not_called()
+
+    # A write purges the page along with its ETag.
+    mock_backend.get_page_version.return_value = "v2"
+    mock_client.application.extensions["page_cache"].purge("page:Mario")
+    resp = mock_client.get("/pages/Mario", headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+    assert resp.headers["ETag"] != etag
+
+
+def test_uncached_conditional_get(mock_client, mock_backend):
+    # Logged-in renders are not cached, so their version is computed.
+    mock_backend.sign_in.return_value = True
+    mock_client.post("/login",
+                     data={
+                         "username": "sebagabs",
+                         "password": "hunter2"
+                     })
+    etag = mock_client.get("/pages/Mario").headers["ETag"]
+    mock_backend.get_wiki_page.reset_mock()
+    resp = mock_client.get("/pages/Mario", headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+    mock_backend.get_wiki_page.assert_not_called()
+
+
+def test_login_is_per_session(mock_client, mock_backend):
+    mock_backend.sign_in.return_value = True
+    resp = mock_client.post("/login",
+                            data={
+                                "username": "sebagabs",
+                                "password": "hunter2"
+                            })
+    assert resp.status_code == 302
+
+    resp = mock_client.get("/home")
+    assert b"| sebagabs |" in resp.data
+    mock_backend.user_exists.assert_called_once_with("sebagabs")
+
+    # Another visitor's session is not logged in.
+    other_client = mock_client.application.test_client()
+    resp = other_client.get("/home")
+    assert b"sebagabs" not in resp.data
+    assert b"Log In" in resp.data
+
+    resp = mock_client.get("/logout")
+    assert resp.status_code == 302
+    resp = mock_client.get("/home")
+    assert b"sebagabs" not in resp.data
+
+
+def test_search_is_rate_limited(mock_backend):
+    app = Flask("flaskr")
+    app.config.from_mapping(SECRET_KEY="dev",
+                            TESTING=True,
+                            RATE_LIMITS={"search": (0.1, 2)})
+    pages.make_endpoints(app, mock_backend)
+    client = app.test_client()
+
+    assert client.get("/search").status_code == 200
+    assert client.get("/search").status_code == 200
+    resp = client.get("/search")
+    assert resp.status_code == 429
+    assert resp.headers["Retry-After"] == "10"
+
+    # Other routes are not limited.
+    assert client.get("/home").status_code == 200
+
+
+def test_user_contributions(mock_client, mock_backend):
+    mock_backend.get_uploaded_pages.return_value = ["Ness"]
+    mock_backend.get_user_comments.return_value = {
+        "Ness": [Comment(0, "sebagabs", "I love Ness.")]
+    }
+    mock_backend.tracker.get_upvotes.return_value = 4
+
+    resp = mock_client.get("/users/sebagabs")
+    assert resp.status_code == 200
+    assert b"I love Ness." in resp.data
+    assert b"Total Upvotes: 4" in resp.data
+    mock_backend.get_user_comments.assert_called_once_with("sebagabs", ["Ness"])
+
+
+def test_template_whitespace_is_trimmed(app, client):
+    resp = client.get("/")
+    untrimmed = app.jinja_env.overlay(trim_blocks=False, lstrip_blocks=False)
+    with app.test_request_context("/"):
+        html = untrimmed.get_template("main.html").render(active=False,
+                                                          name=None)
+    assert b"Welcome" in resp.data
+    assert len(resp.data) < len(html.encode())
+
+
+def test_change_feed_purges_cached_pages(mock_client, mock_backend):
+    app = mock_client.application
+    mock_backend.change_log.latest_seq.return_value = seq_at(100)
+    mock_backend.change_log.read_since.return_value = []
+    app.extensions["change_feed"].poll(force=True)
+
+    mock_client.get("/pages/Mario")
+    assert len(app.extensions["page_cache"]) == 1
+
+    # A comment written by another instance purges the cached page.
+    mock_backend.change_log.read_since.return_value = [{
+        "seq": seq_at(101),
+        "action": "comment",
+        "page": "Mario"
+    }]
+    app.extensions["change_feed"].poll(force=True)
+    assert len(app.extensions["page_cache"]) == 0
+
+
+def test_home_page_shows_trending_pages(mock_client, mock_backend):
+    mock_backend.change_log.latest_seq.return_value = seq_at(100)
+    mock_backend.change_log.read_recent.return_value = []
+    mock_backend.change_log.read_since.return_value = [{
+        "seq": seq_at(101),
+        "action": "upvote",
+        "page": "Ness"
+    }, {
+        "seq": seq_at(102),
+        "action": "comment",
+        "page": "Lucas"
+    }]
+    mock_client.application.extensions["change_feed"].poll(force=True)
+    mock_client.application.extensions["change_feed"].poll(force=True)
+
+    resp = mock_client.get("/home")
+    assert b"Trending Pages" in resp.data
+    assert resp.data.index(b"Ness") < resp.data.index(b"Lucas")
+
+
+def test_character_page_links_content_addressed_image(mock_client,
+                                                      mock_backend):
+    image_name = "a" * 64 + ".png"
+    mock_backend.get_wiki_page.return_value = Character("Mario", "Plumber",
+                                                        "Super Mario Bros.",
+                                                        image_name)
+
+    resp = mock_client.get("/pages/Mario")
+    assert f'src="/images/{image_name}"'.encode() in resp.data
+    mock_backend.get_image.assert_not_called()
+
+
+def test_show_image(mock_client, mock_backend):
+    image_name = "a" * 64 + ".png"
+    mock_backend.get_image_data.return_value = b"sprite"
+
+    resp = mock_client.get("/images/" + image_name)
+    assert resp.status_code == 200
+    assert resp.data == b"sprite"
+    assert resp.mimetype == "image/png"
+    assert "immutable" in resp.headers["Cache-Control"]
+    assert resp.headers["X-Content-Type-Options"] == "nosniff"
+
+    resp = mock_client.get("/images/" + image_name,
+                           headers={"If-None-Match": f'"{image_name}"'})
+    assert resp.status_code == 304
+
+    assert mock_client.get("/images/Mario.png").status_code == 404
+    # Only image extensions are served, so no stored bytes render as a page.
+    assert mock_client.get("/images/" + "a" * 64 + ".html").status_code == 404
+    mock_backend.get_image_data.return_value = None
+    assert mock_client.get("/images/" + image_name).status_code == 404
+
+
+def test_redirect_after_write_shows_own_write(mock_client, mock_backend):
+    mock_backend.sign_in.return_value = True
+    mock_client.post("/login",
+                     data={
+                         "username": "sebagabs",
+                         "password": "hunter2"
+                     })
+    mock_backend.tracker.toggle_upvote.return_value = UpvoteResult(True, 7)
+    mock_backend.tracker.add_comment.return_value = [
+        Comment(0, "sebagabs", "Wahoo!")
+    ]
+
+    mock_client.post("/pages/Mario/upvote")
+    mock_client.post("/pages/Mario/comment", data={"comment": "Wahoo!"})
+    resp = mock_client.get("/pages/Mario", headers={"If-None-Match": '"stale"'})
+    assert resp.status_code == 200
+    assert b"Upvotes: 7" in resp.data
+    assert b"Wahoo!" in resp.data
+    mock_backend.tracker.get_upvotes.assert_not_called()
+    mock_backend.tracker.get_comments.assert_not_called()
+    mock_backend.get_page_version.assert_not_called()
+
+    # Later renders read the page again.
+    resp = mock_client.get("/pages/Mario")
+    assert b"Upvotes: 0" in resp.data
+    mock_backend.tracker.get_comments.assert_called_once_with("Mario")
+
+    # Other sessions never see another session's overlay.
+    mock_client.post("/pages/Mario/upvote")
+    resp = mock_client.application.test_client().get("/pages/Mario")
+    assert b"Upvotes: 0" in resp.data
+
+
+def test_pages_are_listed_from_precomputed_listing(mock_client, mock_backend):
+    mock_backend.get_world_listing.return_value = WorldListing(
+        {
+            "Super Mario Bros.": ["Mario"],
+            "EarthBound": ["Ness"]
+        }, seq_at(104))
+    mock_backend.change_log.read_since.return_value = [{
+        "seq": seq_at(105),
+        "action": "upload",
+        "page": "Luigi",
+        "world": "Super Mario Bros."
+    }]
+
+    resp = mock_client.get("/pages?world=Super Mario Bros.")
+    assert b"Mario" in resp.data
+    assert b"Luigi" in resp.data
+    assert b"Super Mario Bros. (2)" in resp.data
+    assert b"EarthBound (1)" in resp.data
+    mock_backend.change_log.read_since.assert_called_once_with(seq_at(94), 500)
+    mock_backend.get_worlds.assert_not_called()
+    mock_backend.get_characters_by_world.assert_not_called()
+    mock_backend.get_world_listing.assert_called_once()
+
+
+def test_only_uploader_can_edit_or_delete(mock_client, mock_backend):
+    mock_backend.sign_in.return_value = True
+    mock_client.post("/login", data={"username": "Noel", "password": "pw"})
+    resp = mock_client.post("/pages/Mario/edit", data={"info": "Hacked"})
+    assert resp.status_code == 403
+    assert b"Delete page" not in mock_client.get("/pages/Mario").data
+    mock_backend.edit_page.assert_not_called()
+
+
+def test_edit_and_delete_update_listing(mock_client, mock_backend):
+    mock_backend.get_world_listing.return_value = WorldListing(
+        {"Super Mario Bros.": ["Mario", "Luigi"]}, seq_at(104))
+    mock_backend.change_log.read_since.return_value = []
+    mock_backend.sign_in.return_value = True
+    mock_client.post("/login",
+                     data={
+                         "username": "sebagabs",
+                         "password": "hunter2"
+                     })
+    assert b"Delete page" in mock_client.get("/pages/Mario").data
+
+    mock_backend.edit_page.return_value = IndexDelta("Mario", [], ["kingdom"],
+                                                     "Super Mario Bros.",
+                                                     "Mushroom Kingdom")
+    resp = mock_client.post("/pages/Mario/edit",
+                            data={
+                                "info": "",
+                                "world": "Mushroom Kingdom"
+                            })
+    assert resp.status_code == 302
+    mock_backend.edit_page.assert_called_once_with("Mario",
+                                                   info=None,
+                                                   world="Mushroom Kingdom",
+                                                   editor="sebagabs")
+    listings = mock_client.application.extensions["listings"]
+    assert listings.counts() == {"Super Mario Bros.": 1, "Mushroom Kingdom": 1}
+
+    mock_backend.delete_page.return_value = IndexDelta("Mario", ["mario"], [],
+                                                       "Mushroom Kingdom", None)
+    resp = mock_client.post("/pages/Mario/delete")
+    assert resp.headers["Location"].endswith("/pages")
+    assert listings.counts() == {"Super Mario Bros.": 1}
+
+    # Deleted pages are not found.
+    mock_backend.get_wiki_page.return_value = None
+    assert mock_client.get("/pages/Mario").status_code == 404
+
+
+def test_upload_rejects_files_that_are_not_images(mock_client, mock_backend):
+    mock_backend.sign_in.return_value = True
+    mock_backend.allowed_file.return_value = True
+    mock_backend.upload.side_effect = ValueError("Not a PNG, JPEG or GIF image")
+    mock_backend.get_world_listing.return_value = WorldListing({}, seq_at(104))
+    mock_backend.change_log.read_since.return_value = []
+    mock_client.post("/login", data={"username": "Noel", "password": "pw"})
+
+    resp = mock_client.post("/upload",
+                            data={
+                                "file": (io.BytesIO(b"<script></script>"),
+                                         "Mario.png"),
+                                "char_name": "Mario",
+                                "info": "Plumber",
+                                "world": "Super Mario Bros."
+                            },
+                            follow_redirects=True)
+    assert b"Incorrect File Type" in resp.data
+    assert mock_client.application.extensions["listings"].counts() == {}
+
+
+def test_edit_and_delete_require_csrf_token(mock_client, mock_backend):
+    mock_backend.sign_in.return_value = True
+    mock_client.post("/login",
+                     data={
+                         "username": "sebagabs",
+                         "password": "hunter2"
+                     })
+    mock_client.application.config["WTF_CSRF_ENABLED"] = True
+
+    # Forged requests from other sites carry no token.
+    resp = mock_client.post("/pages/Mario/edit", data={"info": "Hacked"})
+    assert resp.status_code == 302
+    mock_client.post("/pages/Mario/delete")
+    mock_backend.edit_page.assert_not_called()
+    mock_backend.delete_page.assert_not_called()
+
+    page = mock_client.get("/pages/Mario").data.decode()
+    token = re.search(r'name="csrf_token" type="hidden" value="([^"]*)"',
+                      page).group(1)
+    mock_backend.edit_page.return_value = None
+    resp = mock_client.post("/pages/Mario/edit",
+                            data={
+                                "info": "Plumber",
+                                "csrf_token": token
+                            })
+    assert resp.status_code == 404
+    mock_backend.edit_page.assert_called_once()
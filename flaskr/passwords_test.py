@@ -0,0 +1,49 @@
+import pytest, hashlib
+from .passwords import PasswordHasher
+
+
+@pytest.fixture
+def hasher():
+    # A low work factor keeps the tests fast.
+    return PasswordHasher('scrypt', 2**10)
+
+
+def test_hash_and_verify(hasher):
+    hashed = hasher.hash('hunter2')
+    assert hashed.startswith('scrypt$1024$')
+    assert hasher.verify('sebagabs', 'hunter2', hashed)
+    assert not hasher.verify('sebagabs', 'hunter3', hashed)
+
+
+def test_hash_uses_random_salts(hasher):
+    assert hasher.hash('hunter2') != hasher.hash('hunter2')
+
+
+def test_pbkdf2():
+    hasher = PasswordHasher('pbkdf2_sha256', 1000)
+    hashed = hasher.hash('hunter2')
+    assert hashed.startswith('pbkdf2_sha256$1000$')
+    assert hasher.verify('sebagabs', 'hunter2', hashed)
+    assert not hasher.verify('sebagabs', 'hunter3', hashed)
+
+
+def test_verify_legacy_hash(hasher):
+    legacy = hashlib.blake2b('sebagabsnbshunter2'.encode()).hexdigest()
+    assert hasher.verify('sebagabs', 'hunter2', legacy)
+    assert not hasher.verify('Noel', 'hunter2', legacy)
+    assert hasher.needs_rehash(legacy)
+
+
+def test_needs_rehash(hasher):
+    assert not hasher.needs_rehash(hasher.hash('hunter2'))
+
+    # Hashes made with other parameters still verify, but need a rehash.
+    stronger = PasswordHasher('scrypt', 2**11)
+    hashed = hasher.hash('hunter2')
+    assert stronger.verify('sebagabs', 'hunter2', hashed)
+    assert stronger.needs_rehash(hashed)
+
+
+def test_unsupported_algorithm():
+    with pytest.raises(ValueError):
+        PasswordHasher('md5')
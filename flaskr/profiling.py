@@ -0,0 +1,270 @@
+from flask import abort, g, jsonify, make_response, request
+from flask_login import current_user
+from typing import NamedTuple
+import collections
+import cProfile
+import io
+import itertools
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+""" Provides opt-in request profiling for the Super Smash Bros. wiki project """
+
+# Query parameter or header that asks for a request to be profiled, with
+# "cprofile" or "sample" as its value ("1" picks the default mode).
+PROFILE_PARAM = 'profile'
+PROFILE_HEADER = 'X-Profile'
+
+PROFILE_MODES = ('sample', 'cprofile')
+
+
+class RequestProfile(NamedTuple):
+    """A profile captured for one request.
+
+    `data` holds marshaled pstats for "cprofile" profiles, and collapsed
+    stacks ("frame;frame;frame count" lines, as read by flamegraph.pl and
+    speedscope) for "sample" profiles.
+    """
+    id: str
+    method: str
+    path: str
+    mode: str
+    started: float
+    duration: float
+    status: int
+    data: bytes
+
+
+class ProfileStore:
+    """A bounded ring buffer of the latest request profiles.
+
+    Attributes:
+        max_profiles: An integer with the number of profiles kept.
+    """
+
+    def __init__(self, max_profiles: int = 20) -> None:
+        self.max_profiles = max_profiles
+        self._profiles = collections.deque(maxlen=max_profiles)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._profiles)
+
+    def next_id(self) -> str:
+        """Returns a new, unique profile id."""
+        return str(next(self._ids))
+
+    def add(self, profile: RequestProfile) -> None:
+        """Stores a profile, dropping the oldest one if the buffer is full."""
+        with self._lock:
+            self._profiles.append(profile)
+
+    def get(self, profile_id: str) -> RequestProfile:
+        """Returns the profile with an id, or None if it was dropped."""
+        with self._lock:
+            for profile in self._profiles:
+                if profile.id == profile_id:
+                    return profile
+        return None
+
+    def list(self) -> list[RequestProfile]:
+        """Returns the stored profiles, newest first."""
+        with self._lock:
+            return list(reversed(self._profiles))
+
+
+class StackSampler:
+    """Samples the stacks of the threads working on a request.
+
+    Unlike cProfile, which only sees the thread it is enabled in, sampling
+    also covers async views and the backend calls they hand to executor
+    threads. A thread is sampled when it is the request's thread or is
+    running code under `root_path`, which leaves out idle workers and
+    other requests blocked outside the app.
+
+    Attributes:
+        interval: A float with the number of seconds between samples.
+        root_path: A string with the directory of the app's code.
+    """
+
+    def __init__(self, interval: float, root_path: str) -> None:
+        self.interval = interval
+        self.root_path = root_path
+        self.samples = collections.Counter()
+        self._request_thread = threading.get_ident()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name='stack-sampler',
+                                        daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> bytes:
+        """Stops sampling and returns the collapsed stacks."""
+        self._stopped.set()
+        self._thread.join()
+        return ''.join(f'{stack} {count}\n'
+                       for stack, count in self.samples.most_common()).encode()
+
+    def _run(self) -> None:
+        own_thread = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                stack = []
+                in_app = thread_id == self._request_thread
+                while frame is not None:
+                    code = frame.f_code
+                    in_app = in_app or code.co_filename.startswith(
+                        self.root_path)
+                    stack.append(f'{code.co_name} '
+                                 f'({os.path.basename(code.co_filename)}:'
+                                 f'{code.co_firstlineno})')
+                    frame = frame.f_back
+                if in_app:
+                    self.samples[';'.join(reversed(stack))] += 1
+
+
+def init_app(app, is_admin=None):
+    """Profiles requests of admins who ask for it.
+
+    A request is profiled when the user is in the ADMINS config and sends
+    "?profile=<mode>" or an "X-Profile: <mode>" header, with mode "sample"
+    (the default) or "cprofile". The profile's id is returned in the
+    response's X-Profile-Id header; the last PROFILE_BUFFER_SIZE profiles
+    are listed at /admin/profiles and downloaded from
+    /admin/profiles/<id>.
+
+    Profiling starts before any other request hook when this is called
+    before the app's other hooks are registered.
+
+    Args:
+        app: The Flask app to profile.
+        is_admin: A function that tells whether the current user is an
+            admin; by default, whether they are logged in as one of ADMINS.
+    """
+    app.config.setdefault('ADMINS', [])
+    app.config.setdefault('PROFILE_BUFFER_SIZE', 20)
+    app.config.setdefault('PROFILE_SAMPLE_INTERVAL', 0.002)
+    if is_admin is None:
+        is_admin = admin_check(app)
+    profiles = ProfileStore(app.config['PROFILE_BUFFER_SIZE'])
+    app.extensions['profiles'] = profiles
+
+    @app.before_request
+    def start_profile():
+        mode = request.args.get(PROFILE_PARAM) or request.headers.get(
+            PROFILE_HEADER)
+        if not mode or not is_admin():
+            return
+        mode = mode if mode in PROFILE_MODES else PROFILE_MODES[0]
+        if mode == 'cprofile':
+            profiler = cProfile.Profile()
+            profiler.enable()
+        else:
+            profiler = StackSampler(app.config['PROFILE_SAMPLE_INTERVAL'],
+                                    app.root_path)
+            profiler.start()
+        g.profile = (profiles.next_id(), mode, time.time(), time.perf_counter(),
+                     profiler)
+
+    @app.after_request
+    def finish_profile(response):
+        profile_id = _finish(profiles, response.status_code)
+        if profile_id:
+            response.headers['X-Profile-Id'] = profile_id
+        return response
+
+    @app.teardown_request
+    def finish_failed_profile(exc):
+        _finish(profiles, 500)
+
+    @app.route('/admin/profiles')
+    def list_profiles():
+        """Lists the stored request profiles, newest first."""
+        if not is_admin():
+            abort(403)
+        return jsonify([{
+            'id': profile.id,
+            'method': profile.method,
+            'path': profile.path,
+            'mode': profile.mode,
+            'started': profile.started,
+            'duration': profile.duration,
+            'status': profile.status,
+        } for profile in profiles.list()])
+
+    @app.route('/admin/profiles/<profile_id>')
+    def download_profile(profile_id):
+        """Downloads a profile as pstats or collapsed stacks.
+
+        "?format=text" renders a cProfile profile as a pstats report
+        instead, sorted by cumulative time.
+        """
+        if not is_admin():
+            abort(403)
+        profile = profiles.get(profile_id)
+        if profile is None:
+            abort(404)
+        if profile.mode == 'cprofile' and request.args.get('format') == 'text':
+            response = make_response(pstats_report(profile.data))
+            response.mimetype = 'text/plain'
+            return response
+        response = make_response(profile.data)
+        if profile.mode == 'cprofile':
+            filename = f'profile-{profile.id}.pstats'
+            response.mimetype = 'application/octet-stream'
+        else:
+            filename = f'profile-{profile.id}.folded'
+            response.mimetype = 'text/plain'
+        response.headers['Content-Disposition'] = (
+            f'attachment; filename="{filename}"')
+        return response
+
+
+def admin_check(app):
+    """Returns a function telling whether the user is logged in as one of ADMINS."""
+    return lambda: (current_user.is_authenticated and current_user.get_id() in
+                    app.config['ADMINS'])
+
+
+def pstats_report(data: bytes, limit: int = 50) -> str:
+    """Renders marshaled pstats as a report of the costliest functions."""
+    stats = pstats.Stats(_MarshaledStats(data), stream=io.StringIO())
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(limit)
+    return stats.stream.getvalue()
+
+
+class _MarshaledStats:
+    """Adapts marshaled pstats data to the profiler interface of `pstats.Stats`."""
+
+    def __init__(self, data: bytes) -> None:
+        self.stats = marshal.loads(data)
+
+    def create_stats(self) -> None:
+        pass
+
+
+def _finish(profiles: ProfileStore, status: int) -> str:
+    """Stops the current request's profiler, if any, and stores its profile."""
+    profile = g.pop('profile', None)
+    if profile is None:
+        return None
+    profile_id, mode, started, start_time, profiler = profile
+    if mode == 'cprofile':
+        profiler.disable()
+        profiler.create_stats()
+        data = marshal.dumps(profiler.stats)
+    else:
+        data = profiler.stop()
+    profiles.add(
+        RequestProfile(profile_id, request.method, request.full_path, mode,
+                       started,
+                       time.perf_counter() - start_time, status, data))
+    return profile_id
@@ -0,0 +1,83 @@
+import pytest, marshal, pstats, time
+from flask import Flask
+from .profiling import ProfileStore, RequestProfile, init_app, pstats_report
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    app.config.from_mapping(TESTING=True, PROFILE_BUFFER_SIZE=2)
+    app.admin = True
+    init_app(app, is_admin=lambda: app.admin)
+
+    @app.route("/search")
+    def search():
+        return str(sum(i * i for i in range(50000)))
+
+    return app
+
+
+def test_requests_are_not_profiled_by_default(app):
+    resp = app.test_client().get("/search")
+    assert "X-Profile-Id" not in resp.headers
+    assert len(app.extensions["profiles"]) == 0
+
+
+def test_only_admins_can_profile(app):
+    app.admin = False
+    client = app.test_client()
+    resp = client.get("/search?profile=cprofile")
+    assert "X-Profile-Id" not in resp.headers
+    assert client.get("/admin/profiles").status_code == 403
+
+
+def test_cprofile(app):
+    client = app.test_client()
+    resp = client.get("/search", headers={"X-Profile": "cprofile"})
+    profile_id = resp.headers["X-Profile-Id"]
+
+    [listed] = client.get("/admin/profiles").get_json()
+    assert listed["id"] == profile_id
+    assert listed["path"] == "/search?"
+    assert listed["mode"] == "cprofile"
+    assert listed["status"] == 200
+
+    resp = client.get(f"/admin/profiles/{profile_id}")
+    assert "profile-1.pstats" in resp.headers["Content-Disposition"]
+    stats = marshal.loads(resp.data)
+    assert any(function == "search" for _, _, function in stats)
+
+    resp = client.get(f"/admin/profiles/{profile_id}?format=text")
+    assert b"cumulative" in resp.data
+    assert b"search" in resp.data
+
+
+def test_sampling_profile(app):
+    app.config["PROFILE_SAMPLE_INTERVAL"] = 0.001
+
+    @app.route("/slow")
+    def slow():
+        deadline = time.perf_counter() + 0.05
+        while time.perf_counter() < deadline:
+            pass
+        return "done"
+
+    client = app.test_client()
+    resp = client.get("/slow?profile=1")
+    resp = client.get(f"/admin/profiles/{resp.headers['X-Profile-Id']}")
+    assert resp.mimetype == "text/plain"
+    assert b"slow (profiling_test.py" in resp.data
+    stack, count = resp.data.splitlines()[0].rsplit(b" ", 1)
+    assert int(count) > 0
+
+
+def test_profile_store_is_bounded(app):
+    client = app.test_client()
+    ids = [
+        client.get("/search?profile=cprofile").headers["X-Profile-Id"]
+        for _ in range(3)
+    ]
+    assert [
+        profile["id"] for profile in client.get("/admin/profiles").get_json()
+    ] == ids[:0:-1]
+    assert client.get(f"/admin/profiles/{ids[0]}").status_code == 404
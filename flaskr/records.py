@@ -0,0 +1,68 @@
+from typing import NamedTuple
+""" Provides the record types returned by the backend of the Super Smash Bros. wiki project """
+
+# Records are named tuples: immutable, hashable, and without a per-instance
+# __dict__, so they stay small in caches and indexes.
+
+
+class Character(NamedTuple):
+    """A character's wiki page.
+
+    `image` is the content-addressed name of the character's image, or None
+    for characters whose image is stored under their name.
+    """
+    name: str
+    info: str
+    world: str
+    image: str = None
+
+
+class Comment(NamedTuple):
+    """A comment left on a wiki page, numbered in posting order."""
+    number: int
+    username: str
+    text: str
+
+
+class PageStats(NamedTuple):
+    """Contribution metrics of a wiki page."""
+    upvotes: int
+    comment_count: int
+    uploader: str
+
+
+class UpvoteResult(NamedTuple):
+    """The outcome of toggling a user's upvote on a page."""
+    upvoted: bool
+    upvotes: int
+
+
+class WorldListing(NamedTuple):
+    """The worlds of the wiki and their characters, as of a change-log seq."""
+    worlds: dict
+    seq: str
+
+
+class IndexDelta(NamedTuple):
+    """What an edit or delete of a page changed for indexes and listings.
+
+    Tokens are the lowercased words of the page's name, info and world
+    that the page stopped or started matching. `new_world` is None for a
+    deleted page.
+    """
+    page: str
+    removed_tokens: list
+    added_tokens: list
+    old_world: str
+    new_world: str
+
+    def as_change(self, action: str) -> dict:
+        """Returns the delta as the change-feed change it is logged as."""
+        return {
+            "action": action,
+            "page": self.page,
+            "world": self.new_world,
+            "old_world": self.old_world,
+            "removed_tokens": self.removed_tokens,
+            "added_tokens": self.added_tokens,
+        }
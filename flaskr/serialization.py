@@ -0,0 +1,115 @@
+from .records import Comment
+import click
+import json
+import timeit
+""" Provides serialization of stored wiki data for the Super Smash Bros. wiki project """
+
+# Comments are stored one PageCommentEntry entity each; the encodings here
+# are those of the single PageComment entity per page that older versions
+# kept every comment of a page in, which is still read.
+
+# Compact JSON: no whitespace, and non-ASCII text kept as is.
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+_decoder = json.JSONDecoder()
+
+
+def encode_comments(comments) -> str:
+    """Encodes a page's comments as a PageComment entity held them.
+
+    Comments are stored as a JSON array of [username, text] pairs in
+    posting order, so the comment number is the position in the array
+    and any text round-trips unchanged.
+
+    Args:
+        comments: An iterable of `Comment` records, in posting order.
+
+    Returns:
+        A string with the encoded comments.
+    """
+    return _encoder.encode(
+        [[comment.username, comment.text] for comment in comments])
+
+
+def decode_comments(stored) -> list[Comment]:
+    """Decodes the comments of a page's PageComment entity with a single parse.
+
+    Comments stored by older versions of the wiki, as the str() of a
+    dictionary of {number: {username: text}}, are decoded as well.
+
+    Args:
+        stored: The value of the page's "comments" property.
+
+    Returns:
+        A list of `Comment` records, in posting order.
+    """
+    if isinstance(stored, str) and stored.startswith('['):
+        return [
+            Comment(number, username, text)
+            for number, (username, text) in enumerate(_decoder.decode(stored))
+        ]
+    return _decode_legacy(stored)
+
+
+def _decode_legacy(stored) -> list[Comment]:
+    """Decodes comments stored as the str() of a dictionary."""
+    # Legacy comments had their quotes replaced before storing, so swapping
+    # the dictionary's single quotes for double quotes yields valid JSON.
+    comments = json.loads(str(stored).replace("'", '"'))
+    return [
+        Comment(int(number), username, text)
+        for number, comment in sorted(comments.items(),
+                                      key=lambda item: int(item[0]))
+        for username, text in comment.items()
+    ]
+
+
+def register_commands(app):
+    """Registers the serialization commands on the app's `flask` CLI."""
+
+    @app.cli.command("benchmark-comments")
+    @click.option("--comments",
+                  default=200,
+                  show_default=True,
+                  help="Number of comments on the benchmarked page.")
+    @click.option("--rounds", default=1000, show_default=True)
+    def benchmark_comments(comments, rounds):
+        """Compares reading a page's comments from a legacy PageComment
+        entity and from PageCommentEntry entities, without the Datastore."""
+        from .tracker import Tracker  # The tracker decodes with this module.
+        page_comments = [
+            Comment(number, f"user{number}", "Great character! " * 5)
+            for number in range(comments)
+        ]
+        legacy = {"comments": encode_comments(page_comments)}
+        entries = [{
+            "page": "Mario",
+            "user": comment.username,
+            "text": comment.text,
+            "seq": f"{comment.number:016d}"
+        } for comment in page_comments]
+        for name, client in (("legacy", _StoredComments(legacy, [])),
+                             ("entries", _StoredComments(None, entries))):
+            tracker = Tracker(client, lambda *path: path)
+            seconds = timeit.timeit(lambda: tracker.get_comments("Mario"),
+                                    number=rounds)
+            click.echo(f"{name}: {1e6 * seconds / rounds:.1f} us per page read")
+
+
+class _StoredComments:
+    """A Datastore client holding one page's comments, for benchmarks."""
+
+    def __init__(self, legacy, entries) -> None:
+        self.legacy = legacy
+        self.entries = entries
+
+    def get(self, key):
+        return self.legacy
+
+    def query(self, kind):
+        return self
+
+    def add_filter(self, *args):
+        pass
+
+    def fetch(self):
+        return self.entries
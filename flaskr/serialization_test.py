@@ -0,0 +1,40 @@
+from flask import Flask
+from .records import Comment
+from .serialization import decode_comments, encode_comments, register_commands
+
+
+def test_round_trip_is_lossless():
+    comments = [
+        Comment(0, "sebagabs", "I haven't played \"Street Fighter\"."),
+        Comment(1, "Noel", "{'0': ``}] \\ ñ 🎮"),
+    ]
+    assert decode_comments(encode_comments(comments)) == comments
+
+
+def test_decode_legacy_comments():
+    legacy = str({
+        "0": {
+            "sebagabs": "I love Ness."
+        },
+        "10": {
+            "bryan": "EarthBound sucks!"
+        },
+        "2": {
+            "Noel": "Me too!"
+        }
+    })
+    assert decode_comments(legacy) == [
+        Comment(0, "sebagabs", "I love Ness."),
+        Comment(2, "Noel", "Me too!"),
+        Comment(10, "bryan", "EarthBound sucks!")
+    ]
+
+
+def test_benchmark_command():
+    app = Flask("flaskr")
+    register_commands(app)
+    result = app.test_cli_runner().invoke(
+        args=["benchmark-comments", "--comments", "5", "--rounds", "10"])
+    assert result.exit_code == 0
+    assert "legacy:" in result.output
+    assert "entries:" in result.output
@@ -0,0 +1,220 @@
+from google.cloud import datastore, storage
+from typing import NamedTuple
+import google.auth
+import hashlib
+import hmac
+import os
+import threading
+""" Provides multi-tenant routing and shared clients for the Super Smash Bros. wiki project """
+
+DEFAULT_PROJECT = 'sds-project-nbs-wiki'
+DEFAULT_CONTENT_BUCKET = 'nbs-wiki-content'
+DEFAULT_USERS_BUCKET = 'nbs-usrs-psswrds'
+
+# Per-app memory budgets, with their defaults, split evenly between the
+# wikis served by one process.
+TENANT_BUDGETS = {
+    'PAGE_CACHE_SIZE': 256,
+    'IMAGE_CACHE_MEMORY_BYTES': 32 * 2**20,
+    'IMAGE_CACHE_DISK_BYTES': 512 * 2**20,
+}
+
+
+class Tenant(NamedTuple):
+    """A wiki served alongside others by the same process.
+
+    Its Datastore entities live in their own namespace and its GCS blobs
+    under their own prefix, so tenants never see each other's data. Its
+    admins are users of its own wiki.
+    """
+    name: str
+    namespace: str
+    bucket_prefix: str
+    hosts: tuple
+    admins: tuple = ()
+
+
+def load_tenants(config) -> list[Tenant]:
+    """Reads the tenants of the TENANTS config.
+
+    TENANTS maps each tenant's name to a dictionary with the "hosts" it is
+    served on and, optionally, its "namespace" and "bucket_prefix", which
+    default to the name and the name followed by a slash, and its "admins".
+    """
+    return [
+        Tenant(name, settings.get('namespace', name),
+               settings.get('bucket_prefix', name + '/'),
+               tuple(host.lower()
+                     for host in settings.get('hosts', ())),
+               tuple(settings.get('admins', ())))
+        for name, settings in config.get('TENANTS', {}).items()
+    ]
+
+
+def isolate_sessions(config, tenant: Tenant = None) -> None:
+    """Keeps a tenant's logins and admins to its own wiki.
+
+    Usernames are only unique within a wiki, so a tenant app signs its
+    sessions with a key derived from SECRET_KEY and the tenant's name, and
+    sends them under cookie names of its own: a session from one wiki is
+    never accepted by another. Its ADMINS are the tenant's "admins" rather
+    than those of the default wiki.
+
+    Args:
+        config: The config of the app, updated in place.
+        tenant: The `Tenant` the app serves, or None for the default wiki.
+    """
+    if tenant is None:
+        return
+    secret_key = config['SECRET_KEY']
+    if isinstance(secret_key, str):
+        secret_key = secret_key.encode()
+    config['SECRET_KEY'] = hmac.new(secret_key, tenant.name.encode(),
+                                    hashlib.sha256).hexdigest()
+    for cookie, default in (('SESSION_COOKIE_NAME', 'session'),
+                            ('REMEMBER_COOKIE_NAME', 'remember_token')):
+        config[cookie] = f"{config.get(cookie, default)}-{tenant.name}"
+    config['ADMINS'] = list(tenant.admins)
+
+
+def partition_budgets(config, tenant: Tenant = None) -> None:
+    """Gives an app its fair share of the process's memory budgets.
+
+    Every tenant, and the default wiki, gets an equal share of each of
+    TENANT_BUDGETS, and its own directory under IMAGE_CACHE_DIR. Apps of
+    processes without tenants keep their whole budgets.
+
+    Args:
+        config: The config of the app, updated in place.
+        tenant: The `Tenant` the app serves, or None for the default wiki.
+    """
+    share = len(config.get('TENANTS', {})) + 1
+    if share == 1:
+        return
+    for key, default in TENANT_BUDGETS.items():
+        config[key] = config.get(key, default) // share
+    if config.get('IMAGE_CACHE_DIR'):
+        config['IMAGE_CACHE_DIR'] = os.path.join(
+            config['IMAGE_CACHE_DIR'], tenant.name if tenant else '_default')
+
+
+class PrefixedBucket:
+    """A view of a GCS bucket that keeps blobs under a name prefix.
+
+    Blob names passed to it are relative to the prefix, so the backend
+    works the same with a tenant's view as with the whole bucket.
+
+    Attributes:
+        bucket: The `storage.Bucket` the blobs are stored in.
+        prefix: A string prepended to every blob name.
+    """
+
+    def __init__(self, bucket, prefix: str) -> None:
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def blob(self, blob_name: str, *args, **kwargs):
+        return self.bucket.blob(self.prefix + blob_name, *args, **kwargs)
+
+    def get_blob(self, blob_name: str, *args, **kwargs):
+        return self.bucket.get_blob(self.prefix + blob_name, *args, **kwargs)
+
+    def list_blobs(self, prefix: str = '', **kwargs):
+        return self.bucket.list_blobs(prefix=self.prefix + prefix, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.bucket, name)
+
+
+class ClientPool:
+    """Shares Google Cloud clients between the tenants of a process.
+
+    Credentials are loaded once, tenants share a single Storage client and
+    its connection pool, and each Datastore namespace has one client used
+    by every `Backend`, `Tracker` and `ChangeLog` of that tenant.
+
+    Attributes:
+        project: A string with the Google Cloud project of the Datastore.
+    """
+
+    def __init__(self, project: str = DEFAULT_PROJECT) -> None:
+        self.project = project
+        self._credentials = None
+        self._storage = None
+        self._datastores = {}
+        self._lock = threading.Lock()
+
+    def datastore(self, namespace: str = None) -> datastore.Client:
+        """Returns the Datastore client of a namespace."""
+        with self._lock:
+            client = self._datastores.get(namespace)
+            if client is None:
+                client = datastore.Client(self.project,
+                                          namespace=namespace,
+                                          credentials=self._load_credentials())
+                self._datastores[namespace] = client
+            return client
+
+    def bucket(self, name: str, prefix: str = ''):
+        """Returns a bucket, or a view of its blobs under a prefix."""
+        with self._lock:
+            if self._storage is None:
+                self._storage = storage.Client(
+                    credentials=self._load_credentials())
+            bucket = self._storage.bucket(name)
+        return PrefixedBucket(bucket, prefix) if prefix else bucket
+
+    def _load_credentials(self):
+        """Returns the default credentials. The caller must hold the lock."""
+        if self._credentials is None:
+            self._credentials, _ = google.auth.default()
+        return self._credentials
+
+
+class TenantDispatcher:
+    """Routes WSGI requests to the app of the tenant whose host they are for.
+
+    Tenant apps are created the first time one of their hosts is requested;
+    requests for other hosts go to the default app.
+
+    Attributes:
+        default_app: The WSGI app of the default wiki.
+        tenants: A list of the `Tenant`s served.
+    """
+
+    def __init__(self, default_app, tenants: list[Tenant], make_app) -> None:
+        self.default_app = default_app
+        self.tenants = tenants
+        self._hosts = {
+            host: tenant for tenant in tenants for host in tenant.hosts
+        }
+        self._make_app = make_app
+        self._apps = {}
+        self._lock = threading.Lock()
+
+    def app_for(self, host: str):
+        """Returns the WSGI app serving a host."""
+        tenant = self._hosts.get(host.rsplit(':', 1)[0].lower())
+        if tenant is None:
+            return self.default_app
+        with self._lock:
+            app = self._apps.get(tenant.name)
+            if app is None:
+                app = self._apps[tenant.name] = self._make_app(tenant)
+            return app
+
+    def __call__(self, environ, start_response):
+        return self.app_for(environ.get('HTTP_HOST', ''))(environ,
+                                                          start_response)
+
+
+def init_app(app, make_app) -> None:
+    """Serves the app's TENANTS from it, each with an app of its own.
+
+    Args:
+        app: The Flask app of the default wiki.
+        make_app: A function creating the Flask app of a `Tenant`.
+    """
+    tenants = load_tenants(app.config)
+    if tenants:
+        app.wsgi_app = TenantDispatcher(app.wsgi_app, tenants, make_app)
@@ -0,0 +1,122 @@
+import pytest
+from unittest.mock import MagicMock
+from flaskr import create_app, tenants
+from .tenants import ClientPool, PrefixedBucket, Tenant, load_tenants, partition_budgets
+
+TENANTS = {
+    "zelda": {
+        "hosts": ["Zelda.example.com"]
+    },
+    "pokemon": {
+        "hosts": ["pokemon.example.com"],
+        "namespace": "pkmn",
+        "bucket_prefix": "wikis/pkmn/"
+    },
+}
+
+
+def test_load_tenants_defaults():
+    assert load_tenants({"TENANTS": TENANTS}) == [
+        Tenant("zelda", "zelda", "zelda/", ("zelda.example.com",)),
+        Tenant("pokemon", "pkmn", "wikis/pkmn/", ("pokemon.example.com",)),
+    ]
+    assert load_tenants({}) == []
+
+
+def test_budgets_are_shared_fairly():
+    config = {
+        "TENANTS": TENANTS,
+        "PAGE_CACHE_SIZE": 300,
+        "IMAGE_CACHE_DIR": "/tmp/images"
+    }
+    partition_budgets(config, load_tenants(config)[0])
+    assert config["PAGE_CACHE_SIZE"] == 100
+    assert config["IMAGE_CACHE_MEMORY_BYTES"] == 32 * 2**20 // 3
+    assert config["IMAGE_CACHE_DIR"] == "/tmp/images/zelda"
+
+    # Without tenants, the app keeps its whole budget.
+    config = {"PAGE_CACHE_SIZE": 300}
+    partition_budgets(config)
+    assert config == {"PAGE_CACHE_SIZE": 300}
+
+
+def test_prefixed_bucket():
+    bucket = MagicMock()
+    view = PrefixedBucket(bucket, "zelda/")
+    view.blob("images/a.png")
+    bucket.blob.assert_called_once_with("zelda/images/a.png")
+    view.get_blob("authors/noel.png")
+    bucket.get_blob.assert_called_once_with("zelda/authors/noel.png")
+    view.list_blobs(prefix="authors/")
+    bucket.list_blobs.assert_called_once_with(prefix="zelda/authors/")
+    assert view.name is bucket.name
+
+
+def test_client_pool_shares_clients(monkeypatch):
+    datastore_client = MagicMock(side_effect=lambda *args, **kwargs: MagicMock(
+        namespace=kwargs["namespace"]))
+    storage_client = MagicMock()
+    credentials = MagicMock(return_value=("credentials", "project"))
+    monkeypatch.setattr(tenants.datastore, "Client", datastore_client)
+    monkeypatch.setattr(tenants.storage, "Client", storage_client)
+    monkeypatch.setattr(tenants.google.auth, "default", credentials)
+
+    pool = ClientPool("project")
+    assert pool.datastore("zelda") is pool.datastore("zelda")
+    assert pool.datastore("zelda") is not pool.datastore()
+    assert datastore_client.call_count == 2
+    assert isinstance(pool.bucket("content", "zelda/"), PrefixedBucket)
+    pool.bucket("content")
+    storage_client.assert_called_once_with(credentials="credentials")
+    credentials.assert_called_once()
+
+
+def test_requests_are_routed_by_host():
+    app = create_app({"TESTING": True, "TENANTS": TENANTS})
+    client = app.test_client()
+    dispatcher = app.wsgi_app
+
+    resp = client.get("/about", headers={"Host": "zelda.example.com:8080"})
+    assert resp.status_code == 200
+    zelda = dispatcher.app_for("zelda.example.com")
+    assert zelda is not app
+    assert zelda.extensions["page_cache"] is not app.extensions["page_cache"]
+    assert zelda.extensions["page_cache"].max_entries == 256 // 3
+
+    # The tenant's app is created once; unknown hosts get the default app.
+    assert dispatcher.app_for("ZELDA.example.com") is zelda
+    assert dispatcher.app_for("localhost") is dispatcher.default_app
+
+
+def test_sessions_are_not_shared_between_tenants():
+    app = create_app({
+        "TESTING":
+            True,
+        "SECRET_KEY":
+            "dev",
+        "ADMINS": ["sebagabs"],
+        "TENANTS":
+            dict(TENANTS,
+                 zelda={
+                     "hosts": ["zelda.example.com"],
+                     "admins": ["Noel"]
+                 })
+    })
+    zelda = app.wsgi_app.app_for("zelda.example.com")
+    pokemon = app.wsgi_app.app_for("pokemon.example.com")
+    assert zelda.config["ADMINS"] == ["Noel"]
+    assert pokemon.config["ADMINS"] == []
+    assert app.config["ADMINS"] == ["sebagabs"]
+
+    # A session signed by one wiki, replayed on another, is not logged in.
+    cookie = zelda.session_interface.get_signing_serializer(zelda).dumps(
+        {"_user_id": "Noel"})
+    for host, logged_in in (("zelda.example.com", True), ("pokemon.example.com",
+                                                          False)):
+        client = app.test_client()
+        for name in ("session-zelda", "session-pokemon", "session"):
+            client.set_cookie(host, name, cookie)
+        resp = client.get("/logout", headers={"Host": host})
+        # Logging out needs a login; anonymous users are sent to log in.
+        assert resp.headers["Location"] == ("/login" if logged_in else
+                                            "/login?next=%2Flogout")
@@ -1,28 +1,63 @@
 from google.cloud import datastore
+from .changes import ChangeLog, MAX_MUTATIONS
+from .records import Comment, PageStats, UpvoteResult
+from .serialization import decode_comments
+from .transactions import run_in_transaction
 import json
-from unittest.mock import MagicMock
+import random
+
+# Kinds holding each `PageStats` field: a page's counter shards and, for
+# the upvotes and comments, the single entity older versions kept them in.
+PAGE_STATS_KINDS = {
+    "upvotes": ("UpvoteCount", "Upvote"),
+    "comment_count": ("CommentCount", "PageComment"),
+    "uploader": ("PageUploader",)
+}
+
+# Datastore lookups accept at most 1000 keys.
+MAX_LOOKUP_KEYS = 1000
+
+# Number of shards of each page's upvote and comment counters. A write
+# updates one shard picked at random, so concurrent voters and commenters
+# on a page rarely touch the same entity.
+COUNTER_SHARDS = 8
 
 
 class Tracker:
     """
     Interface to manage tracking of different user contribution and interaction
     metrics through the database. Interacts with the Datastore instance of 
-    the wiki web page.
+    the wiki web page. Mutations run in transactions that read through the
+    transaction and are retried when they conflict with concurrent writes,
+    so votes and comments on a busy page are not lost.
+
+    Each upvote is a PageUpvote entity of its own, keyed by page and user,
+    and each comment a PageCommentEntry entity keyed by its change-log
+    sequence number, so users voting on or commenting on the same page
+    write different entities. The counts shown on a page are kept in
+    sharded UpvoteCount and CommentCount counters. Upvotes and comments
+    stored in a single Upvote or PageComment entity per page by older
+    versions are still read, and only written to remove a legacy upvote.
 
     ---
     Attributes:
         client:
             An instance of `datastore.Client` that represents the connection to
             the Google Cloud Datastore service for the project 'sds-project-nbs-wiki'.
+        change_log:
+            The `ChangeLog` that upvotes and comments are appended to.
     """
 
-    def __init__(self, client=None, key_method=None):
+    def __init__(self, client=None, key_method=None, change_log=None):
         if client is None:
             client = datastore.Client("sds-project-nbs-wiki")
         if key_method is None:
             key_method = client.key
+        if change_log is None:
+            change_log = ChangeLog(client, key_method)
         self.client = client
         self.key = key_method
+        self.change_log = change_log
 
     def add_upload(self, username: str, pagename: str) -> None:
         """
@@ -36,12 +71,15 @@ class Tracker:
             pagename:
                 String containing the name of uploaded page.
         """
-        with self.client.transaction() as trans:
+
+        def record_upload(trans):
             # Add a page to the 'uploads' array of a specific 'username' in the UserUploads kind of database.
             user_key = self.key("UserUploads", username)
-            user_uploads = self.client.get(user_key)
+            user_uploads = self.client.get(user_key, transaction=trans)
             if user_uploads:  # If user has uploaded pages previosly.
-                user_uploads["uploads"].append(pagename)
+                # A retried attempt must not list the page twice.
+                if pagename not in user_uploads["uploads"]:
+                    user_uploads["uploads"].append(pagename)
                 trans.put(user_uploads)
             else:  # If the user is uploading a page for the first time.
                 new_user_upload = datastore.Entity(key=user_key)
@@ -54,6 +92,52 @@ class Tracker:
             new_page_upload.update({"uploader": username})
             trans.put(new_page_upload)
 
+        run_in_transaction(self.client, record_upload, "add_upload")
+
+    def add_uploads(self, uploads: list[tuple[str, str]]) -> None:
+        """
+        Batched version of `add_upload`, for tracking many uploads with a
+        single read and as few writes as possible.
+
+        ---
+        Args:
+            uploads:
+                List of (username, pagename) tuples, one per uploaded page.
+        """
+        if not uploads:
+            return
+        user_pages = {}
+        entities = []
+        for username, pagename in uploads:
+            user_pages.setdefault(username, []).append(pagename)
+            # Add user's username as the 'uploader' field of the page's entity.
+            new_page_upload = datastore.Entity(
+                key=self.key("PageUploader", pagename))
+            new_page_upload.update({"uploader": username})
+            entities.append(new_page_upload)
+
+        user_keys = [
+            self.key("UserUploads", username) for username in user_pages
+        ]
+        existing_uploads = {
+            user_uploads.key.name: user_uploads
+            for user_uploads in self.client.get_multi(user_keys)
+        }
+        for user_key, (username, pagenames) in zip(user_keys,
+                                                   user_pages.items()):
+            user_uploads = existing_uploads.get(username)
+            if user_uploads is None:  # If the user is uploading for the first time.
+                user_uploads = datastore.Entity(key=user_key)
+                user_uploads.update({"uploads": []})
+            for pagename in pagenames:
+                if pagename not in user_uploads["uploads"]:
+                    user_uploads["uploads"].append(pagename)
+            entities.append(user_uploads)
+
+        # Datastore accepts at most 500 entities per commit.
+        for start in range(0, len(entities), 500):
+            self.client.put_multi(entities[start:start + 500])
+
     def get_page_uploader(self, pagename: str) -> str:
         """
         Get the username of the user who uploaded the parameter page.
@@ -87,7 +171,7 @@ class Tracker:
         user_uploads = self.client.get(user_key)
         return user_uploads["uploads"] if user_uploads else None
 
-    def upvote_page(self, pagename: str, username: str) -> None:
+    def upvote_page(self, pagename: str, username: str) -> str:
         """
         Keeps track of user that have upvoted a page.
 
@@ -97,27 +181,59 @@ class Tracker:
                 String containing the name of a wiki page.
             username:
                 String representing username of a user.
+
+        Returns:
+            String with a message describing the upvote or its removal.
         """
-        action = ""
-        with self.client.transaction() as trans:
-            page_key = self.key("Upvote", pagename)
-            page = self.client.get(page_key)
-            if page:
-                if username in page["upvotes"]:  # If user already voted.
-                    page["upvotes"].remove(
-                        username)  # Remove upvote done by user.
-                    action = "You had already upvoted this page. Removed upvote from page."
-                else:
-                    page["upvotes"].append(
-                        username)  # If user hasn't voted, add upvote to page.
-                    action = "Page upvoted!"
-                trans.put(page)
-            else:
-                new_page_upvote = datastore.Entity(key=page_key)
-                new_page_upvote.update({"upvotes": [username]})
-                action = "Page upvoted!"
-                trans.put(new_page_upvote)
-        return action
+        if self.toggle_upvote(pagename, username).upvoted:
+            return "Page upvoted!"
+        return "You had already upvoted this page. Removed upvote from page."
+
+    def toggle_upvote(self, pagename: str, username: str) -> UpvoteResult:
+        """
+        Upvotes a page, or removes the user's upvote if they already had
+        upvoted it.
+
+        ---
+        Args:
+            pagename:
+                String containing the name of a wiki page.
+            username:
+                String representing username of a user.
+
+        Returns:
+            An `UpvoteResult` record with whether the page is now upvoted by
+            the user and its number of upvotes after the write.
+        """
+
+        def toggle(trans):
+            vote_key = self._upvote_key(pagename, username)
+            vote = self.client.get(vote_key, transaction=trans)
+            legacy_key = self.key("Upvote", pagename)
+            legacy = self.client.get(legacy_key, transaction=trans)
+            removed = True
+            if vote:  # If user already voted.
+                trans.delete(vote_key)  # Remove upvote done by user.
+                self._add_to_counter(trans, "UpvoteCount", pagename, -1)
+            elif legacy and username in legacy["upvotes"]:
+                legacy["upvotes"].remove(username)
+                trans.put(legacy)
+            else:  # If user hasn't voted, add upvote to page.
+                vote = datastore.Entity(key=vote_key)
+                vote.update({"page": pagename, "user": username})
+                trans.put(vote)
+                self._add_to_counter(trans, "UpvoteCount", pagename, 1)
+                removed = False
+            self.change_log.append("upvote",
+                                   pagename,
+                                   trans,
+                                   user=username,
+                                   removed=removed)
+            return removed
+
+        removed = run_in_transaction(self.client, toggle, "toggle_upvote")
+        return UpvoteResult(upvoted=not removed,
+                            upvotes=self.get_upvotes(pagename))
 
     def get_upvotes(self, pagename: str) -> int:
         """
@@ -131,11 +247,10 @@ class Tracker:
         Returns:
             Integer representing number of upvotes.
         """
-        page_key = self.key("Upvote", pagename)
-        page = self.client.get(page_key)
-        return len(page["upvotes"]) if page else 0
+        return self.get_pages_stats([pagename], ["upvotes"])[pagename].upvotes
 
-    def add_comment(self, pagename: str, username: str, comment: str) -> None:
+    def add_comment(self, pagename: str, username: str,
+                    comment: str) -> list[Comment]:
         """
         Keeps track of comments left by different users on a page.
 
@@ -147,40 +262,87 @@ class Tracker:
                 String containing the name of uploaded page.
             comment:
                 String containing a user's comment.                 
+
+        Returns:
+            A list of `Comment` records with all comments left on the page,
+            including the new one, or None if no page name was given.
         """
         if not pagename:
-            return
-        with self.client.transaction() as trans:
-            page_key = self.key("PageComment", pagename)
-            page = self.client.get(page_key)
-            if page:  # If page has been commented before.
-                page_comments = json.loads(
-                    str(page["comments"]).replace("\'", "\""))
-                comment_num = str(len(page_comments))
-                page_comments[comment_num] = {
-                    username:
-                        comment.replace("'", "`").replace(
-                            '"', "``"
-                        )  # Characters are being replaced to avoid issues when casting between JSON/string/dictionary.
-                }
-                page["comments"] = str(page_comments)
-                trans.put(page)
-            else:  # Page is receiving its first comment.
-                new_page_comment = datastore.Entity(key=page_key)
-                new_page_comment.update({
-                    "comments":
-                        str({
-                            "0": {
-                                username:
-                                    comment.replace("'", "`").replace(
-                                        '"', "``"
-                                    )  # Characters are being replaced to avoid issues when casting between JSON/string/dictionary.
-                            }
-                        })
-                })
-                trans.put(new_page_comment)
-
-    def get_comments(self, pagename: str):
+            return None
+
+        def append(trans):
+            seq = self.change_log.append("comment",
+                                         pagename,
+                                         trans,
+                                         user=username)
+            # Comments can outgrow the 1500 byte limit of indexed strings.
+            entry = datastore.Entity(key=self.key("PageCommentEntry", seq),
+                                     exclude_from_indexes=("text",))
+            entry.update({
+                "page": pagename,
+                "user": username,
+                "text": comment,
+                "seq": seq
+            })
+            trans.put(entry)
+            self._add_to_counter(trans, "CommentCount", pagename, 1)
+            return entry
+
+        entry = run_in_transaction(self.client, append, "add_comment")
+        return self._comments(pagename, entry)
+
+    def delete_page_records(self, pagename: str, trans) -> None:
+        """
+        Deletes the upvote and comment counts and the uploader of a page,
+        and removes it from its uploader's uploads, as part of a page
+        deletion. The page's upvotes and comments themselves can be too
+        many for one transaction; `delete_page_activity` deletes them once
+        the page is gone.
+
+        ---
+        Args:
+            pagename:
+                String containing the name of the deleted page.
+            trans:
+                The transaction the page is deleted in.
+        """
+        page_key = self.key("PageUploader", pagename)
+        page_uploader = self.client.get(page_key, transaction=trans)
+        if page_uploader:
+            user_uploads = self.client.get(self.key("UserUploads",
+                                                    page_uploader["uploader"]),
+                                           transaction=trans)
+            if user_uploads and pagename in user_uploads["uploads"]:
+                user_uploads["uploads"] = [
+                    upload for upload in user_uploads["uploads"]
+                    if upload != pagename
+                ]
+                trans.put(user_uploads)
+        for kind in ("Upvote", "PageComment", "PageUploader"):
+            trans.delete(self.key(kind, pagename))
+        for kind in ("UpvoteCount", "CommentCount"):
+            for shard_key in self._shard_keys(kind, pagename):
+                trans.delete(shard_key)
+
+    def delete_page_activity(self, pagename: str) -> None:
+        """
+        Deletes the upvotes and comments left on a deleted page.
+
+        ---
+        Args:
+            pagename:
+                String containing the name of the deleted page.
+        """
+        keys = []
+        for kind in ("PageUpvote", "PageCommentEntry"):
+            query = self.client.query(kind=kind)
+            query.add_filter("page", "=", pagename)
+            query.keys_only()
+            keys.extend(entity.key for entity in query.fetch())
+        for start in range(0, len(keys), MAX_MUTATIONS):
+            self.client.delete_multi(keys[start:start + MAX_MUTATIONS])
+
+    def get_comments(self, pagename: str) -> list[Comment]:
         """
         Get all comments left on page with parameter pagename.
         
@@ -190,13 +352,131 @@ class Tracker:
                 String containing the name of a wiki page.
 
         Returns:
-            A dictionary containing key-value pairs of int (comment number)
-            and value (dictionary with username as key and comment as value)
-            of all comments left on the page.
-        """
-        page_key = self.key("PageComment", pagename)
-        page = self.client.get(page_key)
-        return json.loads(
-            str(page["comments"]).replace(
-                "\'",  # Characters are being replaced to avoid issues when casting between JSON/string/dictionary.
-                "\"")) if page else None
+            A list of `Comment` records, in the order they were posted, of
+            all comments left on the page.
+        """
+        return self._comments(pagename)
+
+    def get_comment_count(self, pagename: str) -> int:
+        """
+        Get number of comments left on page with parameter pagename.
+
+        ---
+        Args:
+            pagename:
+                String containing the name of a wiki page.
+
+        Returns:
+            Integer representing number of comments.
+        """
+        return len(self.get_comments(pagename))
+
+    def get_page_stats(self, pagename: str) -> PageStats:
+        """
+        Get the upvotes, comment count and uploader of a page with a single
+        Datastore lookup.
+
+        ---
+        Args:
+            pagename:
+                String containing the name of a wiki page.
+
+        Returns:
+            A `PageStats` record with the page's contribution metrics.
+        """
+        return self.get_pages_stats([pagename])[pagename]
+
+    def get_pages_stats(self,
+                        pagenames: list[str],
+                        fields=PageStats._fields) -> dict[str, PageStats]:
+        """
+        Batched version of `get_page_stats`, for many pages at once, that
+        only looks up the kinds holding the requested fields.
+
+        ---
+        Args:
+            pagenames:
+                List of strings containing names of wiki pages.
+            fields:
+                Names of the `PageStats` fields to look up.
+
+        Returns:
+            Dictionary mapping each page name to a `PageStats` record, with
+            None for the fields that were not requested.
+        """
+        keys = []
+        for pagename in pagenames:
+            for field in fields:
+                counter_kind, *kinds = PAGE_STATS_KINDS[field]
+                if kinds:
+                    keys.extend(self._shard_keys(counter_kind, pagename))
+                else:
+                    kinds = [counter_kind]
+                keys.extend(self.key(kind, pagename) for kind in kinds)
+        entities = {}
+        for start in range(0, len(keys), MAX_LOOKUP_KEYS):
+            for entity in self.client.get_multi(keys[start:start +
+                                                     MAX_LOOKUP_KEYS]):
+                entities[entity.key.kind, entity.key.name] = entity
+
+        def count(kind, pagename):
+            return sum(entities[key.kind, key.name]["count"]
+                       for key in self._shard_keys(kind, pagename)
+                       if (key.kind, key.name) in entities)
+
+        pages_stats = {}
+        for pagename in pagenames:
+            upvotes = entities.get(("Upvote", pagename))
+            comments = entities.get(("PageComment", pagename))
+            uploader = entities.get(("PageUploader", pagename))
+            pages_stats[pagename] = PageStats(
+                upvotes=count("UpvoteCount", pagename) +
+                (len(upvotes["upvotes"]) if upvotes else 0)
+                if "upvotes" in fields else None,
+                comment_count=count("CommentCount", pagename) +
+                (len(decode_comments(comments["comments"])) if comments else 0)
+                if "comment_count" in fields else None,
+                uploader=uploader["uploader"] if uploader else None)
+        return pages_stats
+
+    def _upvote_key(self, pagename: str, username: str):
+        """Returns the key of a user's upvote on a page."""
+        return self.key("PageUpvote",
+                        json.dumps([pagename, username], ensure_ascii=False))
+
+    def _shard_keys(self, kind: str, pagename: str) -> list:
+        """Returns the keys of the shards of a page's counter."""
+        return [
+            self.key(kind, f"{pagename}#{shard}")
+            for shard in range(COUNTER_SHARDS)
+        ]
+
+    def _add_to_counter(self, trans, kind: str, pagename: str,
+                        amount: int) -> None:
+        """Adds an amount to a random shard of a page's counter."""
+        shard_key = random.choice(self._shard_keys(kind, pagename))
+        shard = self.client.get(shard_key, transaction=trans)
+        if shard is None:
+            shard = datastore.Entity(key=shard_key)
+            shard["count"] = 0
+        shard["count"] += amount
+        trans.put(shard)
+
+    def _comments(self, pagename: str, new_entry=None) -> list[Comment]:
+        """Returns the comments on a page, legacy ones first.
+
+        A comment just added is included even if the query, which can lag
+        behind writes, does not return it yet.
+        """
+        legacy = self.client.get(self.key("PageComment", pagename))
+        comments = decode_comments(legacy["comments"]) if legacy else []
+        query = self.client.query(kind="PageCommentEntry")
+        query.add_filter("page", "=", pagename)
+        entries = {entry["seq"]: entry for entry in query.fetch()}
+        if new_entry is not None:
+            entries.setdefault(new_entry["seq"], new_entry)
+        for seq in sorted(entries):
+            comments.append(
+                Comment(len(comments), entries[seq]["user"],
+                        entries[seq]["text"]))
+        return comments
@@ -1,28 +1,116 @@
-import pytest
+import copy, pytest
+from google.api_core import exceptions
 from google.cloud import datastore
 from unittest.mock import MagicMock
-from .tracker import Tracker
+from .tracker import COUNTER_SHARDS, Tracker
+from .records import Comment, PageStats, UpvoteResult
+
+
+# Mock the key method
+def key_mock(*args, **kwargs):
+    key = MagicMock()
+    key.kind = args[0]
+    key.name = args[1]
+    return key
 
 
 # Mocking Datastore client
 @pytest.fixture
 def mock_tracker():
     tracker = Tracker(MagicMock(), MagicMock())
-
-    # Mock the key method
-    def key_mock(*args, **kwargs):
-        key = MagicMock()
-        key.kind = args[0]
-        key.name = args[1]
-        return key
-
     tracker.key = key_mock
     return tracker
 
 
+class FakeDatastore:
+    """An in-memory Datastore client, with entities stored by kind and name.
+
+    Transactions apply their writes when they commit; the first `conflicts`
+    commits are aborted instead.
+    """
+
+    def __init__(self, conflicts=0):
+        self.entities = {}
+        self.conflicts = conflicts
+        self.commits = []
+
+    def store(self, kind, name, properties):
+        entity = datastore.Entity(key=key_mock(kind, name))
+        entity.update(properties)
+        self.entities[kind, name] = entity
+
+    def get(self, key, transaction=None):
+        entity = self.entities.get((key.kind, key.name))
+        if entity is None:
+            return None
+        # Callers can change what they read without changing the store.
+        copied = datastore.Entity(key=entity.key,
+                                  exclude_from_indexes=tuple(
+                                      entity.exclude_from_indexes))
+        copied.update(copy.deepcopy(dict(entity)))
+        return copied
+
+    def get_multi(self, keys, transaction=None):
+        return [entity for entity in map(self.get, keys) if entity is not None]
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self.entities.pop((key.kind, key.name), None)
+
+    def query(self, kind):
+        fake = self
+        query = MagicMock(filters=[])
+        query.add_filter.side_effect = lambda name, op, value: query.filters.append(
+            (name, value))
+        query.fetch.side_effect = lambda **kwargs: [
+            entity for (entity_kind, _), entity in fake.entities.items()
+            if entity_kind == kind and all(
+                entity.get(name) == value for name, value in query.filters)
+        ]
+        return query
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+
+class FakeTransaction:
+
+    def __init__(self, client):
+        self.client = client
+        self.writes = []
+
+    def put(self, entity):
+        self.writes.append((entity.key.kind, entity.key.name, entity))
+
+    def delete(self, key):
+        self.writes.append((key.kind, key.name, None))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if exc_info[0] is not None:
+            return False
+        if self.client.conflicts:
+            self.client.conflicts -= 1
+            raise exceptions.Aborted("contention")
+        for kind, name, entity in self.writes:
+            if entity is None:
+                self.client.entities.pop((kind, name), None)
+            else:
+                self.client.entities[kind, name] = entity
+        self.client.commits.append(self.writes)
+        return False
+
+
+@pytest.fixture
+def fake_tracker():
+    return Tracker(FakeDatastore(), key_mock)
+
+
 def test_add_upload(mock_tracker):
 
-    def get_side_effect(key):
+    def get_side_effect(key, **kwargs):
         if key.kind == "UserUploads":
             if key.name == "sebagabs":
                 return {"uploads": ["Ryu"]}
@@ -67,7 +155,7 @@ def test_add_upload(mock_tracker):
 
 def test_get_page_uploader(mock_tracker):
     # Configure the tracker . . . TODO
-    def get_side_effect(key):
+    def get_side_effect(key, **kwargs):
         if key.name == "Ness":
             return {"uploader": "sebagabs"}
         return None
@@ -83,7 +171,7 @@ def test_get_page_uploader(mock_tracker):
 
 def test_get_pages_uploaded(mock_tracker):
     # Configure the tracker . . . TODO
-    def get_side_effect(key):
+    def get_side_effect(key, **kwargs):
         if key.name == "sebagabs":
             return {"uploads": ["Lucas", "Ness"]}
         return None
@@ -97,128 +185,275 @@ def test_get_pages_uploaded(mock_tracker):
     assert result is None
 
 
-def test_upvote_page(mock_tracker):
-
-    def get_side_effect(key):
-        if key.name == "Ness":
-            return {"upvotes": ["sebagabs"]}
-
-    mock_tracker.client.get.side_effect = get_side_effect
-
-    mock_transaction = MagicMock()
-    mock_transaction.__enter__.return_value = mock_transaction
-
-    # User upvoted Ness page.
-    mock_tracker.client.transaction.return_value = mock_transaction
-    mock_tracker.upvote_page("Ness", "sebagabs")
-
-    uploaded = mock_transaction.put.call_args.args[
-        0]  # First Argument passed in to `put` (a dict)
-    # Either .remove or .append were done, so dict remains empty.
-    assert uploaded["upvotes"] == []
+def test_upvote_page(fake_tracker):
+    result = fake_tracker.upvote_page("Ness", "sebagabs")
+    assert result == "Page upvoted!"
 
-    result = mock_tracker.upvote_page("Ness", "sebagabs")
+    result = fake_tracker.upvote_page("Ness", "sebagabs")
     assert result == "You had already upvoted this page. Removed upvote from page."
 
-    result = mock_tracker.upvote_page("Ness", "Noel")
+    result = fake_tracker.upvote_page("Ness", "Noel")
     assert result == "Page upvoted!"
 
-
-def test_get_upvotes(mock_tracker):
-    # Configure the tracker . . . TODO
-    def get_side_effect(key):
-        if key.name == "Ryu":
-            return {"upvotes": ["sebagabs", "Noel"]}
-        return None
-
-    mock_tracker.client.get.side_effect = get_side_effect
-
-    result = mock_tracker.get_upvotes("Ryu")
+    # Every upvote is appended to the change log in the same transaction.
+    [change] = [
+        entity for kind, _, entity in fake_tracker.client.commits[-1]
+        if kind == "WikiChange"
+    ]
+    assert change["action"] == "upvote"
+    assert change["page"] == "Ness"
+    assert change["user"] == "Noel"
+    assert change["removed"] is False
+
+    result = fake_tracker.toggle_upvote("Ness", "bryan")
+    assert result == UpvoteResult(upvoted=True, upvotes=2)
+    result = fake_tracker.toggle_upvote("Ness", "Noel")
+    assert result == UpvoteResult(upvoted=False, upvotes=1)
+
+
+def test_upvotes_write_separate_entities(fake_tracker):
+    fake_tracker.toggle_upvote("Ness", "sebagabs")
+    fake_tracker.toggle_upvote("Ness", "Noel")
+
+    # Each vote writes its own entity and one counter shard; no entity
+    # holds the page's list of voters.
+    for writes in fake_tracker.client.commits:
+        assert sorted(kind for kind, _, _ in writes) == [
+            "PageUpvote", "UpvoteCount", "WikiChange"
+        ]
+    votes = [
+        entity for (kind, _), entity in fake_tracker.client.entities.items()
+        if kind == "PageUpvote"
+    ]
+    assert sorted(vote["user"] for vote in votes) == ["Noel", "sebagabs"]
+    assert ("Upvote", "Ness") not in fake_tracker.client.entities
+
+
+def test_legacy_upvotes(fake_tracker):
+    fake_tracker.client.store("Upvote", "Ness",
+                              {"upvotes": ["sebagabs", "Noel"]})
+    assert fake_tracker.get_upvotes("Ness") == 2
+
+    # Legacy upvotes can still be removed, and count with new ones.
+    assert fake_tracker.toggle_upvote("Ness", "Noel") == UpvoteResult(False, 1)
+    assert fake_tracker.client.entities["Upvote",
+                                        "Ness"]["upvotes"] == ["sebagabs"]
+    assert fake_tracker.toggle_upvote("Ness", "bryan") == UpvoteResult(True, 2)
+
+
+def test_get_upvotes(fake_tracker):
+    fake_tracker.client.store("UpvoteCount", "Ryu#0", {"count": 3})
+    fake_tracker.client.store("UpvoteCount", f"Ryu#{COUNTER_SHARDS - 1}",
+                              {"count": -1})
+
+    result = fake_tracker.get_upvotes("Ryu")
     assert result == 2
 
-    result = mock_tracker.get_upvotes("Lucario")
+    result = fake_tracker.get_upvotes("Lucario")
     assert result == 0
 
 
-def test_add_comment(mock_tracker):
-
-    def get_side_effect(key):
-        if key.name == "Ness":
-            return {
-                "comments": {
-                    "0": {
-                        "sebagabs": "I love Ness."
-                    },
-                    "1": {
-                        "Noel": "Me too!"
-                    }
-                }
+def test_add_comment(fake_tracker):
+    fake_tracker.client.store("PageComment", "Ness", {
+        "comments": {
+            "0": {
+                "sebagabs": "I love Ness."
+            },
+            "1": {
+                "Noel": "Me too!"
             }
-        return None
-
-    mock_tracker.client.get.side_effect = get_side_effect
-
-    mock_transaction = MagicMock()
-    mock_transaction.__enter__.return_value = mock_transaction
+        }
+    })
 
     # Commenting on a page with previous comments.
-    mock_tracker.client.transaction.return_value = mock_transaction
-    mock_tracker.add_comment("Ness", "bryan", "EarthBound sucks!")
+    result = fake_tracker.add_comment("Ness", "bryan", "EarthBound sucks!")
+    assert result == [
+        Comment(0, "sebagabs", "I love Ness."),
+        Comment(1, "Noel", "Me too!"),
+        Comment(2, "bryan", "EarthBound sucks!")
+    ]
+
+    # The comment is a new entity; the page's legacy comments are untouched.
+    [entry] = [
+        entity for kind, _, entity in fake_tracker.client.commits[-1]
+        if kind == "PageCommentEntry"
+    ]
+    assert entry["text"] == "EarthBound sucks!"
+    assert "text" in entry.exclude_from_indexes
+    assert not any(
+        kind == "PageComment" for kind, _, _ in fake_tracker.client.commits[-1])
 
-    uploaded = mock_transaction.put.call_args.args[
-        0]  # First Argument passed in to `put` (a dict)
-    assert uploaded["comments"] == str({
-        "0": {
-            "sebagabs": "I love Ness."
-        },
-        "1": {
-            "Noel": "Me too!"
-        },
-        "2": {
-            "bryan": "EarthBound sucks!"
-        }
+    # Commenting on a page with no comments; leaving first comment on page.
+    result = fake_tracker.add_comment("Ryu", "sebagabs",
+                                      "I haven't played Street Fighter.")
+    assert result == [
+        Comment(0, "sebagabs", "I haven't played Street Fighter.")
+    ]
+    assert fake_tracker.get_comment_count("Ness") == 3
+
+
+def test_add_comment_returns_comment_not_yet_queryable(mock_tracker):
+    mock_tracker.client.get.return_value = None
+    mock_tracker.client.query.return_value.fetch.return_value = []
+    mock_tracker.change_log = MagicMock()
+    mock_tracker.change_log.append.return_value = "seq"
+
+    result = mock_tracker.add_comment("Ness", "bryan", "PK Fire!")
+    assert result == [Comment(0, "bryan", "PK Fire!")]
+
+
+def test_get_comments(fake_tracker):
+    fake_tracker.client.store("PageComment", "Ness",
+                              {"comments": '[["sebagabs","I love Ness."]]'})
+    fake_tracker.client.store("PageCommentEntry", "0002", {
+        "page": "Ness",
+        "user": "bryan",
+        "text": "PK Fire!",
+        "seq": "0002"
+    })
+    fake_tracker.client.store("PageCommentEntry", "0001", {
+        "page": "Ness",
+        "user": "Noel",
+        "text": "Me too!",
+        "seq": "0001"
+    })
+    fake_tracker.client.store("PageCommentEntry", "0003", {
+        "page": "Lucas",
+        "user": "Noel",
+        "text": "Hi",
+        "seq": "0003"
     })
 
-    # Commenting on a page with no comments; leaving first comment on page.
-    mock_tracker.client.transaction.return_value = mock_transaction
-    mock_tracker.add_comment("Ryu", "sebagabs",
-                             "I haven't played Street Fighter.")
+    result = fake_tracker.get_comments("Ness")
+    assert result == [
+        Comment(0, "sebagabs", "I love Ness."),
+        Comment(1, "Noel", "Me too!"),
+        Comment(2, "bryan", "PK Fire!")
+    ]
+    assert result[1].text == "Me too!"
 
-    uploaded = mock_transaction.put.call_args.args[
-        0]  # First Argument passed in to `put` (a dict)
-    assert uploaded["comments"] == str(
-        {"0": {
-            "sebagabs": "I haven`t played Street Fighter."
-        }})
+    result = fake_tracker.get_comments("Lucario")
+    assert result == []
 
 
-def test_get_comments(mock_tracker):
+def test_get_comment_count(fake_tracker):
+    fake_tracker.add_comment("Ness", "sebagabs", "I love Ness.")
+    fake_tracker.add_comment("Ness", "Noel", "Me too!")
 
-    def get_side_effect(key):
-        if key.name == "Ness":
-            return {
-                "comments": {
-                    "0": {
-                        "sebagabs": "I love Ness."
-                    },
-                    "1": {
-                        "Noel": "Me too!"
-                    }
-                }
-            }
-        return None
+    assert fake_tracker.get_comment_count("Ness") == 2
+    assert fake_tracker.get_comment_count("Lucario") == 0
 
-    mock_tracker.client.get.side_effect = get_side_effect
 
-    result = mock_tracker.get_comments("Ness")
-    assert result == {
-        "0": {
-            "sebagabs": "I love Ness."
-        },
-        "1": {
-            "Noel": "Me too!"
-        }
+def test_add_uploads(mock_tracker):
+    existing_uploads = datastore.Entity(key=MagicMock())
+    existing_uploads.key.name = "sebagabs"
+    existing_uploads["uploads"] = ["Ryu"]
+    mock_tracker.client.get_multi.return_value = [existing_uploads]
+
+    mock_tracker.add_uploads([("sebagabs", "Sheik"), ("sebagabs", "Ryu"),
+                              ("Noel", "Villager")])
+
+    written = mock_tracker.client.put_multi.call_args.args[0]
+    uploaders = {
+        entity.key.name: entity["uploader"]
+        for entity in written
+        if entity.key.kind == "PageUploader"
+    }
+    assert uploaders == {
+        "Sheik": "sebagabs",
+        "Ryu": "sebagabs",
+        "Villager": "Noel"
+    }
+    assert existing_uploads["uploads"] == ["Ryu", "Sheik"]
+    assert written[-1]["uploads"] == ["Villager"]
+
+
+def test_get_page_stats(fake_tracker):
+    fake_tracker.client.store("PageUploader", "Ness", {"uploader": "sebagabs"})
+    fake_tracker.client.store("Upvote", "Ness", {"upvotes": ["sebagabs"]})
+    fake_tracker.client.store("UpvoteCount", "Ness#1", {"count": 1})
+    fake_tracker.client.store("PageComment", "Ness",
+                              {"comments": {
+                                  "0": {
+                                      "sebagabs": "I love Ness."
+                                  }
+                              }})
+    assert fake_tracker.get_page_stats("Ness") == PageStats(2, 1, "sebagabs")
+
+    assert fake_tracker.get_page_stats("Lucario") == PageStats(0, 0, None)
+
+
+def test_get_pages_stats(fake_tracker):
+    fake_tracker.client.get_multi = MagicMock(
+        wraps=fake_tracker.client.get_multi)
+    fake_tracker.client.store("Upvote", "Ness", {"upvotes": ["sebagabs"]})
+    fake_tracker.client.store("UpvoteCount", "Ness#3", {"count": 1})
+    fake_tracker.client.store("PageUploader", "Ness", {"uploader": "sebagabs"})
+    fake_tracker.client.store("PageUploader", "Lucas", {"uploader": "Noel"})
+    assert fake_tracker.get_pages_stats(["Ness", "Lucas"]) == {
+        "Ness": PageStats(2, 0, "sebagabs"),
+        "Lucas": PageStats(0, 0, "Noel")
     }
+    fake_tracker.client.get_multi.assert_called_once()
 
-    result = mock_tracker.get_comments("Lucario")
-    assert result == None
+    # Only the kinds holding the requested fields are looked up.
+    assert fake_tracker.get_pages_stats(["Ness", "Lucas"], ["uploader"]) == {
+        "Ness": PageStats(None, None, "sebagabs"),
+        "Lucas": PageStats(None, None, "Noel")
+    }
+    keys = fake_tracker.client.get_multi.call_args.args[0]
+    assert [key.kind for key in keys] == ["PageUploader", "PageUploader"]
+
+
+def test_conflicting_upvote_is_retried_with_fresh_read():
+    client = FakeDatastore(conflicts=1)
+    client.get = MagicMock(wraps=client.get)
+    tracker = Tracker(client, key_mock)
+    client.store("Upvote", "Ness", {"upvotes": ["sebagabs"]})
+
+    result = tracker.toggle_upvote("Ness", "bryan")
+    # The aborted attempt's writes are not counted.
+    assert result == UpvoteResult(upvoted=True, upvotes=2)
+    assert len(client.commits) == 1
+    # Both attempts read the vote, the legacy upvotes and a counter shard
+    # through their transaction.
+    assert [
+        call.kwargs.get("transaction") is not None
+        for call in client.get.call_args_list[:6]
+    ] == [True] * 6
+
+
+def test_delete_page_records(mock_tracker):
+    stored = {
+        ("PageUploader", "Ness"): {
+            "uploader": "sebagabs"
+        },
+        ("UserUploads", "sebagabs"): {
+            "uploads": ["Ryu", "Ness"]
+        },
+    }
+    mock_tracker.client.get.side_effect = lambda key, **kwargs: stored.get(
+        (key.kind, key.name))
+    trans = MagicMock()
+
+    mock_tracker.delete_page_records("Ness", trans)
+    trans.put.assert_called_once_with({"uploads": ["Ryu"]})
+    deleted = [(call.args[0].kind, call.args[0].name)
+               for call in trans.delete.call_args_list]
+    assert deleted[:3] == [("Upvote", "Ness"), ("PageComment", "Ness"),
+                           ("PageUploader", "Ness")]
+    assert ("UpvoteCount", "Ness#0") in deleted
+    assert ("CommentCount", f"Ness#{COUNTER_SHARDS - 1}") in deleted
+
+
+def test_delete_page_activity(fake_tracker):
+    fake_tracker.toggle_upvote("Ness", "sebagabs")
+    fake_tracker.add_comment("Ness", "Noel", "Me too!")
+    fake_tracker.toggle_upvote("Lucas", "sebagabs")
+
+    fake_tracker.delete_page_activity("Ness")
+    assert fake_tracker.get_comments("Ness") == []
+    remaining = [(kind, entity["page"])
+                 for (kind, _), entity in fake_tracker.client.entities.items()
+                 if kind in ("PageUpvote", "PageCommentEntry")]
+    assert remaining == [("PageUpvote", "Lucas")]
@@ -0,0 +1,96 @@
+from google.api_core import exceptions
+import collections
+import logging
+import random
+import threading
+import time
+""" Provides retried Datastore transactions for the Super Smash Bros. wiki project """
+
+logger = logging.getLogger(__name__)
+
+# Attempts made at a transaction before its conflict is raised.
+MAX_ATTEMPTS = 5
+
+# Seconds the first retry waits at most; each retry doubles it, up to
+# MAX_DELAY.
+BASE_DELAY = 0.05
+MAX_DELAY = 1.0
+
+
+class ContentionStats:
+    """Counts the outcomes of transactions, per operation.
+
+    Each attempt ends in a "commits" or a "conflicts" count; a transaction
+    whose every attempt conflicted also counts under "failures".
+    """
+
+    def __init__(self) -> None:
+        self._counts = collections.defaultdict(collections.Counter)
+        self._lock = threading.Lock()
+
+    def record(self, operation: str, outcome: str) -> None:
+        with self._lock:
+            self._counts[operation][outcome] += 1
+
+    def snapshot(self) -> dict[str, dict[str, int]]:
+        """Returns the counts of each operation's outcomes so far."""
+        with self._lock:
+            return {
+                operation: dict(counts)
+                for operation, counts in self._counts.items()
+            }
+
+
+# Outcomes of every transaction run by this process.
+contention_stats = ContentionStats()
+
+
+def run_in_transaction(client,
+                       function,
+                       operation: str,
+                       max_attempts: int = MAX_ATTEMPTS,
+                       stats: ContentionStats = None,
+                       sleep=time.sleep):
+    """Runs a function in a transaction, retrying it when the commit conflicts.
+
+    Datastore aborts a transaction whose reads were changed by another
+    commit, so `function` must do all its reads through the transaction
+    and be safe to run again: each retry starts a new transaction and
+    reads the current values. Retries wait a random time up to an
+    exponentially growing bound ("full jitter"), so writers of a hot page
+    spread out instead of colliding again.
+
+    Args:
+        client: The `datastore.Client` to open transactions with.
+        function: A function taking the transaction, whose return value
+            is returned once the transaction commits.
+        operation: A string naming the operation in the contention stats.
+        max_attempts: An integer with the number of attempts to make.
+        stats: The `ContentionStats` to count outcomes in; those of the
+            whole process by default.
+        sleep: A function waiting a number of seconds.
+
+    Returns:
+        The value returned by `function` in the attempt that committed.
+
+    Raises:
+        google.api_core.exceptions.Conflict: If every attempt conflicted.
+    """
+    stats = stats or contention_stats
+    for attempt in range(1, max_attempts + 1):
+        try:
+            with client.transaction() as trans:
+                result = function(trans)
+        except exceptions.Conflict:  # Includes Aborted.
+            stats.record(operation, "conflicts")
+            if attempt == max_attempts:
+                stats.record(operation, "failures")
+                logger.warning("%s conflicted %d times, giving up", operation,
+                               attempt)
+                raise
+            sleep(
+                random.uniform(0, min(MAX_DELAY,
+                                      BASE_DELAY * 2**(attempt - 1))))
+        else:
+            stats.record(operation, "commits")
+            return result
@@ -0,0 +1,65 @@
+import pytest
+from google.api_core import exceptions
+from unittest.mock import MagicMock
+from .transactions import MAX_DELAY, ContentionStats, run_in_transaction
+
+
+def conflicting_client(conflicts):
+    """Returns a client whose first `conflicts` commits are aborted."""
+    client = MagicMock()
+    commits = iter([exceptions.Aborted("contention")] * conflicts)
+
+    def commit(*exc_info):
+        if exc_info[0] is None:
+            error = next(commits, None)
+            if error:
+                raise error
+        return False
+
+    client.transaction.return_value.__exit__.side_effect = commit
+    return client
+
+
+def test_commit_on_first_attempt():
+    stats = ContentionStats()
+    function = MagicMock(return_value="done")
+    assert run_in_transaction(conflicting_client(0),
+                              function,
+                              "vote",
+                              stats=stats) == "done"
+    function.assert_called_once()
+    assert stats.snapshot() == {"vote": {"commits": 1}}
+
+
+def test_conflicts_are_retried_with_backoff():
+    stats = ContentionStats()
+    sleeps = []
+    function = MagicMock(return_value="done")
+    assert run_in_transaction(conflicting_client(3),
+                              function,
+                              "vote",
+                              stats=stats,
+                              sleep=sleeps.append) == "done"
+    assert function.call_count == 4
+    assert len(sleeps) == 3
+    assert all(0 <= delay <= MAX_DELAY for delay in sleeps)
+    assert stats.snapshot() == {"vote": {"commits": 1, "conflicts": 3}}
+
+
+def test_conflict_is_raised_after_last_attempt():
+    stats = ContentionStats()
+    with pytest.raises(exceptions.Aborted):
+        run_in_transaction(conflicting_client(10),
+                           MagicMock(),
+                           "vote",
+                           max_attempts=3,
+                           stats=stats,
+                           sleep=lambda delay: None)
+    assert stats.snapshot() == {"vote": {"conflicts": 3, "failures": 1}}
+
+
+def test_other_errors_are_not_retried():
+    function = MagicMock(side_effect=ValueError("bad"))
+    with pytest.raises(ValueError):
+        run_in_transaction(conflicting_client(0), function, "vote")
+    function.assert_called_once()
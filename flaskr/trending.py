@@ -0,0 +1,124 @@
+import bisect
+import threading
+import time
+""" Provides a trending pages leaderboard for the Super Smash Bros. wiki project """
+
+# Score added to a page by each kind of change in the change-feed.
+DEFAULT_WEIGHTS = {'upvote': 1.0, 'comment': 0.5}
+
+# Pages whose decayed score falls below this are dropped from the ranking.
+NEGLIGIBLE_SCORE = 1e-6
+
+
+class TrendingPages:
+    """Ranks pages by time-decayed upvote and comment activity.
+
+    Every event adds its weight to the page's score, and that contribution
+    halves every `half_life` seconds. Rather than decaying every score as
+    time passes, new contributions are scaled up by 2^(t / half_life)
+    relative to a landmark time, which keeps the relative order of pages
+    fixed between events. Scores are rescaled when the landmark gets old,
+    before the scaling factor can overflow.
+
+    Pages are kept in a list sorted by score, updated with binary search
+    on every event, so reading the top pages never scans the wiki.
+
+    Attributes:
+        half_life:
+            A float with the number of seconds for an event's weight to halve.
+        weights:
+            A dictionary mapping change actions to the weight they add.
+    """
+
+    def __init__(self,
+                 half_life: float = 86400.0,
+                 weights: dict = None,
+                 clock=time.time) -> None:
+        self.half_life = half_life
+        self.weights = weights or DEFAULT_WEIGHTS
+        self._clock = clock
+        self._landmark = clock()
+        self._scores = {}  # page name -> score scaled to the landmark
+        self._ranking = []  # sorted (-scaled score, page name) tuples
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._scores)
+
+    def record(self, page_name: str, weight: float, when: float = None) -> None:
+        """Adds a weighted event to a page's score.
+
+        Args:
+            page_name: A string with the name of the page.
+            weight: A float with the weight of the event; negative to undo one.
+            when: A float with the UNIX time of the event, or None for now.
+        """
+        when = self._clock() if when is None else when
+        with self._lock:
+            exponent = (when - self._landmark) / self.half_life
+            if exponent > 64:
+                self._rescale(when)
+                exponent = 0.0
+            old_score = self._scores.get(page_name, 0.0)
+            scale = 2**exponent
+            new_score = old_score + weight * scale
+            if page_name in self._scores:
+                del self._ranking[bisect.bisect_left(self._ranking,
+                                                     (-old_score, page_name))]
+            if new_score >= NEGLIGIBLE_SCORE * scale:
+                self._scores[page_name] = new_score
+                bisect.insort(self._ranking, (-new_score, page_name))
+            else:
+                self._scores.pop(page_name, None)
+
+    def apply_change(self, change: dict) -> None:
+        """Records an upvote or comment change from the change-feed.
+
+        Removed upvotes take back the weight of an upvote made now, and
+        deleted pages leave the ranking.
+
+        Args:
+            change: A dictionary with the "action", "page" and "time" of a
+                change, and whether an upvote was "removed".
+        """
+        if change['action'] == 'delete':
+            self.remove(change['page'])
+            return
+        weight = self.weights.get(change['action'])
+        if weight is None:
+            return
+        if change.get('removed'):
+            weight = -weight
+        when = change.get('time')
+        self.record(change['page'], weight,
+                    when.timestamp() if when is not None else None)
+
+    def remove(self, page_name: str) -> None:
+        """Drops a page from the ranking."""
+        with self._lock:
+            score = self._scores.pop(page_name, None)
+            if score is not None:
+                del self._ranking[bisect.bisect_left(self._ranking,
+                                                     (-score, page_name))]
+
+    def top(self, k: int) -> list[str]:
+        """Returns the names of the k pages with the highest scores."""
+        with self._lock:
+            return [page_name for _, page_name in self._ranking[:k]]
+
+    def score(self, page_name: str) -> float:
+        """Returns the current decayed score of a page."""
+        with self._lock:
+            scaled = self._scores.get(page_name, 0.0)
+            return scaled * 2**(
+                (self._landmark - self._clock()) / self.half_life)
+
+    def _rescale(self, landmark: float) -> None:
+        """Moves the landmark forward. The caller must hold the lock."""
+        factor = 2**((self._landmark - landmark) / self.half_life)
+        self._landmark = landmark
+        # Scaling every score by the same factor keeps the ranking sorted.
+        self._ranking = [(score * factor, page_name)
+                         for score, page_name in self._ranking
+                         if -score * factor >= NEGLIGIBLE_SCORE]
+        self._scores = {page_name: -score for score, page_name in self._ranking}
@@ -0,0 +1,92 @@
+import pytest, datetime
+from .trending import TrendingPages
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def trending(clock):
+    return TrendingPages(half_life=3600, clock=clock)
+
+
+def test_ranks_by_score(trending):
+    trending.record("Mario", 1)
+    trending.record("Link", 1)
+    trending.record("Link", 1)
+    trending.record("Ness", 0.5)
+
+    assert trending.top(2) == ["Link", "Mario"]
+    assert trending.top(10) == ["Link", "Mario", "Ness"]
+    assert trending.score("Link") == pytest.approx(2)
+
+
+def test_recent_activity_outranks_old_activity(trending, clock):
+    trending.record("Mario", 3)
+    clock.now += 2 * 3600
+    assert trending.score("Mario") == pytest.approx(0.75)
+
+    trending.record("Link", 1)
+    assert trending.top(2) == ["Link", "Mario"]
+
+
+def test_removing_weight(trending):
+    trending.record("Mario", 1)
+    trending.record("Link", 2)
+    trending.record("Link", -2)
+
+    assert trending.top(10) == ["Mario"]
+    assert len(trending) == 1
+    assert trending.score("Link") == 0
+
+
+def test_rescales_old_landmark(trending, clock):
+    trending.record("Mario", 1)
+    trending.record("Link", 2)
+    clock.now += 10 * 3600
+    trending.record("Ness", 1)
+    clock.now += 100 * 3600
+    trending.record("Lucas", 1)
+
+    # Mario and Link decayed to nothing once the scores were rescaled.
+    assert trending.top(10) == ["Lucas"]
+    assert trending.score("Lucas") == pytest.approx(1)
+
+
+def test_apply_change(trending, clock):
+    now = datetime.datetime.fromtimestamp(clock.now, datetime.timezone.utc)
+    trending.apply_change({"action": "upvote", "page": "Mario", "time": now})
+    trending.apply_change({"action": "comment", "page": "Ness", "time": now})
+    trending.apply_change({"action": "upload", "page": "Link", "time": now})
+    assert trending.top(10) == ["Mario", "Ness"]
+
+    trending.apply_change({
+        "action": "upvote",
+        "page": "Mario",
+        "time": now,
+        "removed": True
+    })
+    assert trending.top(10) == ["Ness"]
+
+
+def test_deleted_page_leaves_ranking(trending, clock):
+    trending.record("Mario", 2)
+    trending.record("Ness", 1)
+    trending.apply_change({"action": "delete", "page": "Mario"})
+    assert trending.top(10) == ["Ness"]
+    assert len(trending) == 1
+
+    # Deleting a page without a score is a no-op.
+    trending.apply_change({"action": "delete", "page": "Link"})
+    assert trending.top(10) == ["Ness"]